@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+"""
+Bench — chạy thử tải offline cho on_message → gemini_text_reply → save_chat.
+Discord và Gemini đều là bản giả lập chạy cục bộ; không cần token hay API key.
+
+    python bench.py --profile steady
+    python bench.py --profile all --out bench.json
+    python bench.py --profile burst --compare bench.json
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+PROFILES = ("steady", "burst", "many_channels")
+
+
+# ---------------------------
+# Fake Discord
+# ---------------------------
+_ids = itertools.count(1_000_000)
+
+
+class FakeUser:
+    def __init__(self, uid: int, bot: bool = False):
+        self.id = uid
+        self.bot = bot
+        self.name = f"user{uid}"
+
+    def __eq__(self, other):
+        return isinstance(other, FakeUser) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+class FakeMessage:
+    def __init__(self, content: str, author: FakeUser, channel: "FakeChannel"):
+        self.id = next(_ids)
+        self.content = content
+        self.author = author
+        self.channel = channel
+
+    async def reply(self, content: str):
+        return await self.channel.send(content)
+
+    async def edit(self, content: str):
+        await self.channel.io()
+        self.content = content
+        self.channel.edits += 1
+
+    async def add_reaction(self, emoji: str):
+        await self.channel.io()
+
+    async def delete(self):
+        await self.channel.io()
+
+
+class _Typing:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeChannel:
+    def __init__(self, cid: int, name: str, latency: float):
+        self.id = cid
+        self.name = name
+        self.latency = latency
+        self.sent = 0
+        self.edits = 0
+
+    async def io(self):
+        # Discord REST round trip
+        await asyncio.sleep(random.uniform(0.5, 1.5) * self.latency)
+
+    async def send(self, content: str) -> FakeMessage:
+        await self.io()
+        self.sent += 1
+        return FakeMessage(content, FakeUser(0, bot=True), self)
+
+    def typing(self):
+        return _Typing()
+
+    def permissions_for(self, user):
+        return type("Perms", (), {"manage_messages": False})()
+
+
+# ---------------------------
+# Stub Gemini model
+# ---------------------------
+class StubError(Exception):
+    def __init__(self, code: int, msg: str):
+        super().__init__(msg)
+        self.code = code
+
+
+class _Resp:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class StubModel:
+    """Mimics generate_content_async: lognormal latency, random 5xx, scheduled 429 bursts."""
+
+    def __init__(self, median: float = 1.5, sigma: float = 0.5, error_rate: float = 0.02,
+                 burst_every: float = 0.0, burst_length: float = 0.0, reply_chars: int = 600):
+        self.median = median
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self.burst_every = burst_every
+        self.burst_length = burst_length
+        self.reply_chars = reply_chars
+        self.started = time.monotonic()
+        self.calls = 0
+        self.errors = 0
+        self.throttled = 0
+
+    def _latency(self) -> float:
+        return self.median * math.exp(random.gauss(0, self.sigma))
+
+    def _check_errors(self):
+        if self.burst_every > 0:
+            phase = (time.monotonic() - self.started) % self.burst_every
+            if phase < self.burst_length:
+                self.throttled += 1
+                raise StubError(429, "429 Resource has been exhausted (e.g. check quota).")
+        if random.random() < self.error_rate:
+            self.errors += 1
+            raise StubError(503, "503 The service is currently unavailable.")
+
+    def _text(self) -> str:
+        sentence = "Tại hạ chỉ đường: đi về phía đông, qua cầu đá rồi hỏi lão chủ quán. "
+        return (sentence * (self.reply_chars // len(sentence) + 1))[:self.reply_chars]
+
+    async def generate_content_async(self, contents=None, generation_config=None, stream=False, **kwargs):
+        self.calls += 1
+        if not stream:
+            await asyncio.sleep(self._latency())
+            self._check_errors()
+            return _Resp(self._text())
+        await asyncio.sleep(self._latency() * 0.3)  # time to first token
+        self._check_errors()
+        return self._stream(self._text())
+
+    async def _stream(self, text: str):
+        step = 80
+        for i in range(0, len(text), step):
+            await asyncio.sleep(self._latency() * 0.7 * step / max(len(text), 1))
+            yield _Resp(text[i:i + step])
+
+
+# ---------------------------
+# Traffic profiles — yield (offset_seconds, channel_id, user_id, text)
+# ---------------------------
+QUESTIONS = [
+    "Làm sao mở khóa khinh công tầng hai?",
+    "Boss ở Khai Phong đánh thế nào cho dễ?",
+    "Nhiệm vụ ẩn ở Thanh Hà nhận ở đâu?",
+    "Nên chọn vũ khí gì cho người mới chơi?",
+    "Cách kiếm tiền nhanh giai đoạn đầu game?",
+    "Mảnh bản đồ kho báu dùng như thế nào?",
+]
+
+
+def profile_events(name: str, messages: int, rate: float) -> Iterator[Tuple[float, int, int, str]]:
+    rng = random.Random(42)
+    if name == "steady":
+        # constant rate over a handful of channels and users
+        for i in range(messages):
+            yield i / rate, 100 + i % 4, 10_000 + rng.randrange(40), rng.choice(QUESTIONS) + f" (#{i})"
+    elif name == "burst":
+        # patch drop: many users ask nearly the same thing within seconds (4x rate, Poisson arrivals)
+        hot = QUESTIONS[:2]
+        t = 0.0
+        for i in range(messages):
+            t += rng.expovariate(rate * 4)
+            yield t, 100 + i % 2, 20_000 + i, rng.choice(hot)
+    elif name == "many_channels":
+        for i in range(messages):
+            yield i / rate, 5_000 + i, 30_000 + i, rng.choice(QUESTIONS)
+    else:
+        raise ValueError(f"unknown profile {name}")
+
+
+# ---------------------------
+# Runner
+# ---------------------------
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * q
+    lo, hi = math.floor(k), math.ceil(k)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def _stage(bot_metrics, stage: str) -> Dict[str, float]:
+    count, total = bot_metrics.STAGE_SECONDS.totals(stage)
+    return {"count": count, "total_seconds": total, "mean_seconds": total / count if count else 0.0}
+
+
+async def run_profile(args) -> Dict:
+    import bot
+    import metrics as bot_metrics
+
+    model = StubModel(median=args.latency, sigma=args.sigma, error_rate=args.error_rate,
+                      burst_every=args.burst_every, burst_length=args.burst_length)
+    bot.GEMINI_OK = True
+    bot.G_MODEL = model
+    bot.sessions.detect(model)
+    await bot.init_db()
+
+    async def _no_commands(message):
+        return None
+    bot.bot.process_commands = _no_commands
+
+    channels: Dict[int, FakeChannel] = {}
+    latencies: List[float] = []
+
+    async def deliver(offset: float, cid: int, uid: int, text: str, t0: float):
+        await asyncio.sleep(max(0.0, t0 + offset - time.monotonic()))
+        channel = channels.setdefault(cid, FakeChannel(cid, bot.TARGET_CHANNELS[0], args.discord_latency))
+        msg = FakeMessage(text, FakeUser(uid), channel)
+        started = time.monotonic()
+        await bot.on_message(msg)
+        latencies.append(time.monotonic() - started)
+
+    events = list(profile_events(args.profile, args.messages, args.rate))
+    t0 = time.monotonic()
+    await asyncio.gather(*(deliver(*e, t0) for e in events))
+    wall = time.monotonic() - t0
+    await bot.chat_db.aclose()
+
+    return {
+        "profile": args.profile,
+        "version": _version(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("out", "compare")},
+        "messages": len(latencies),
+        "wall_seconds": wall,
+        "messages_per_second": len(latencies) / wall if wall else 0.0,
+        "latency_seconds": {
+            "p50": _percentile(latencies, 0.50),
+            "p95": _percentile(latencies, 0.95),
+            "p99": _percentile(latencies, 0.99),
+            "max": max(latencies) if latencies else 0.0,
+        },
+        "db": {"write": _stage(bot_metrics, "db_write"), "history_fetch": _stage(bot_metrics, "history_fetch")},
+        "api_slot_wait": _stage(bot_metrics, "api_queue"),
+        "api": {"calls": model.calls, "errors_5xx": model.errors, "throttled_429": model.throttled},
+        "discord": {"sent": sum(c.sent for c in channels.values()), "edits": sum(c.edits for c in channels.values())},
+        "scheduler": bot.api_scheduler.stats(),
+        "limiter": bot.api_limiter.stats(),
+        "response_cache": bot.response_cache.stats(),
+        "coalesced": bot._inflight.shared,
+        "hedges": {k: bot.HEDGES.labels(k).value for k in ("fired", "won", "skipped_budget", "skipped_quota")},
+    }
+
+
+def _version() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return "unknown"
+
+
+def compare(current: Dict, baseline: Dict) -> List[str]:
+    """Human-readable deltas for the headline numbers of one profile."""
+    lines = []
+    for label, path in (("msg/s", ("messages_per_second",)), ("p50", ("latency_seconds", "p50")),
+                        ("p95", ("latency_seconds", "p95")), ("p99", ("latency_seconds", "p99")),
+                        ("api calls", ("api", "calls"))):
+        cur, base = current, baseline
+        for key in path:
+            cur, base = cur.get(key, 0), base.get(key, 0)
+        delta = ((cur - base) / base * 100) if base else 0.0
+        lines.append(f"{current['profile']:>14} {label:>9}: {base:10.3f} -> {cur:10.3f} ({delta:+.1f}%)")
+    return lines
+
+
+def _parse_args(argv: Optional[List[str]] = None):
+    p = argparse.ArgumentParser(description="Offline load test for the Ekko bot")
+    p.add_argument("--profile", choices=PROFILES + ("all",), default="steady")
+    p.add_argument("--messages", type=int, default=60)
+    p.add_argument("--rate", type=float, default=5.0, help="messages per second")
+    p.add_argument("--latency", type=float, default=1.5, help="median model latency (s)")
+    p.add_argument("--sigma", type=float, default=0.5, help="lognormal sigma of model latency")
+    p.add_argument("--error-rate", type=float, default=0.02, help="share of 5xx responses")
+    p.add_argument("--burst-every", type=float, default=0.0, help="seconds between 429 bursts (0 = none)")
+    p.add_argument("--burst-length", type=float, default=0.0, help="length of each 429 burst (s)")
+    p.add_argument("--discord-latency", type=float, default=0.05, help="mean Discord REST latency (s)")
+    p.add_argument("--stream", action="store_true", help="enable STREAM_REPLIES")
+    p.add_argument("--out", help="write JSON results here")
+    p.add_argument("--compare", help="baseline JSON from an earlier run")
+    return p.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None):
+    args = _parse_args(argv)
+    if args.profile == "all":
+        # one process per profile so module-level state (caches, limiter) starts fresh
+        results = []
+        for name in PROFILES:
+            cmd = [sys.executable, os.path.abspath(__file__)] + _child_argv(args, name)
+            results.append(json.loads(subprocess.check_output(cmd)))
+        _emit(results, args)
+        return
+
+    tmp = tempfile.mkdtemp(prefix="ekko-bench-")
+    os.environ.setdefault("DB_PATH", os.path.join(tmp, "bench.sqlite"))
+    os.environ.setdefault("COOLDOWN_SECONDS", "0")
+    os.environ.setdefault("TARGET_CHANNELS", "hoi-dap")
+    os.environ["STREAM_REPLIES"] = "1" if args.stream else "0"
+    import logging
+    logging.disable(logging.WARNING)
+    result = asyncio.run(run_profile(args))
+    _emit([result], args)
+
+
+def _child_argv(args, name: str) -> List[str]:
+    argv = ["--profile", name]
+    for key, value in vars(args).items():
+        if key in ("profile", "out", "compare") or value is None:
+            continue
+        flag = "--" + key.replace("_", "-")
+        if isinstance(value, bool):
+            if value:
+                argv.append(flag)
+        else:
+            argv += [flag, str(value)]
+    return argv
+
+
+def _emit(results: List[Dict], args):
+    payload = results[0] if len(results) == 1 else {"profiles": results}
+    text = json.dumps(payload, indent=2, ensure_ascii=False)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        base_by_name = {r["profile"]: r for r in baseline.get("profiles", [baseline])}
+        for r in results:
+            if r["profile"] in base_by_name:
+                for line in compare(r, base_by_name[r["profile"]]):
+                    print(line, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,26 +5,49 @@ Phiên bản này giữ nguyên cấu trúc tổng thể, sửa tất cả lỗi
 """
 
 import os
+import sys
 import time
+# startup phases are measured from here
+_BOOT_STARTED = time.monotonic()
 import asyncio
 import sqlite3
 import datetime
 import logging
 import random
-from typing import List, Optional, Any
+import hashlib
+import importlib.util
+import json
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Deque, Dict, List, NamedTuple, Optional, Any, Sequence, Tuple
 
 import discord
 from discord.ext import commands
 from discord import app_commands
 from dotenv import load_dotenv
 
-# Gemini SDK (chuẩn mới)
-try:
-    import google.generativeai as genai
-    GENAI_AVAILABLE = True
-except Exception:
-    genai = None
-    GENAI_AVAILABLE = False
+from chat_db import ChatDB
+from response_cache import ResponseCache, is_standalone
+from scheduler import FairScheduler, QueueFull, RequestExpired
+from limiter import GeminiLimiter, estimate_tokens
+from user_state import PersonaStore
+from shared_state import Cooldown, open_backend
+import shards
+import knowledge
+import metrics
+from retention import ChatArchiver, parse_retention
+from keep_alive import HealthServer, timed_check
+from hedging import HedgeBudget, LatencyTracker, ModelTier, hedged, parse_tiers
+from sessions import GeminiRequest, SessionManager, clip, drop_own_rows, turn_label
+
+# Gemini SDK (chuẩn mới) — imported on first use (ensure_gemini); the import alone takes seconds
+def _has_module(name: str) -> bool:
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
+
+genai: Optional[Any] = None
+GENAI_AVAILABLE = _has_module("google.generativeai")
 
 # ---------------------------
 # Load ENV
@@ -34,12 +57,99 @@ DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 GEMINI_KEY = os.getenv("GEMINI_API_KEY")
 TARGET_CHANNELS = os.getenv("TARGET_CHANNELS", "hoi-dap").split(",")
 COOLDOWN_SECONDS = int(os.getenv("COOLDOWN_SECONDS", "2"))
+# messages a user may send back to back before COOLDOWN_SECONDS applies
+COOLDOWN_BURST = int(os.getenv("COOLDOWN_BURST", "1"))
+# quick follow-ups from one user in one channel within this window become one request; 0 disables
+DEBOUNCE_SECONDS = float(os.getenv("DEBOUNCE_SECONDS", "1.5"))
+DEBOUNCE_MAX_SECONDS = float(os.getenv("DEBOUNCE_MAX_SECONDS", "6"))
+DEBOUNCE_MAX_PARTS = int(os.getenv("DEBOUNCE_MAX_PARTS", "5"))
+USER_STATE_MAX = int(os.getenv("USER_STATE_MAX", "10000"))
+USER_STATE_TTL = float(os.getenv("USER_STATE_TTL", "3600"))
 DB_PATH = os.getenv("DB_PATH", "ekko_bot.sqlite")
 HISTORY_MESSAGES = int(os.getenv("HISTORY_MESSAGES", "6"))
 MAX_TOKENS = int(os.getenv("MAX_OUTPUT_TOKENS", "1024"))
 CONCURRENCY = int(os.getenv("API_CONCURRENCY", "2"))
 MAX_RETRIES = int(os.getenv("MAX_RETRIES", "3"))
 MODEL_NAME = os.getenv("GEMINI_MODEL", "gemini-1.5-flash-latest")
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "30"))
+# ordered "model:timeout_seconds,..."; attempt n uses tier n, hedges go one tier down
+MODEL_TIERS = parse_tiers(os.getenv("GEMINI_MODEL_TIERS", ""), MODEL_NAME, GEMINI_TIMEOUT)
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "1") == "1"
+# hedge once the call is slower than this percentile of recent calls to the same model
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.9"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "1.5"))
+# at most this many hedges per request on average
+HEDGE_MAX_RATIO = float(os.getenv("HEDGE_MAX_RATIO", "0.1"))
+DB_FLUSH_INTERVAL = float(os.getenv("DB_FLUSH_INTERVAL", "0.5"))
+DB_BATCH_SIZE = int(os.getenv("DB_BATCH_SIZE", "50"))
+HISTORY_CACHE_CHANNELS = int(os.getenv("HISTORY_CACHE_CHANNELS", "1000"))
+REPLY_OWNERS_CACHE = int(os.getenv("REPLY_OWNERS_CACHE", "5000"))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "500"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "21600"))
+RESPONSE_CACHE_PERSIST = os.getenv("RESPONSE_CACHE_PERSIST", "0") == "1"
+# off | standalone | ignore — see response_cache.HISTORY_POLICIES
+RESPONSE_CACHE_HISTORY_POLICY = os.getenv("RESPONSE_CACHE_HISTORY_POLICY", "standalone")
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+COALESCE_REQUESTS = os.getenv("COALESCE_REQUESTS", "1") == "1"
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "45"))
+API_QUEUE_MAX = int(os.getenv("API_QUEUE_MAX", "50"))
+API_QUEUE_PER_USER = int(os.getenv("API_QUEUE_PER_USER", "3"))
+API_CONCURRENCY_MIN = int(os.getenv("API_CONCURRENCY_MIN", "1"))
+API_CONCURRENCY_MAX = int(os.getenv("API_CONCURRENCY_MAX", "8"))
+API_LATENCY_TARGET = float(os.getenv("API_LATENCY_TARGET", "8"))
+# Gemini quota; 0 disables the bucket
+GEMINI_RPM = float(os.getenv("GEMINI_RPM", "60"))
+GEMINI_TPM = float(os.getenv("GEMINI_TPM", "1000000"))
+CIRCUIT_FAIL_THRESHOLD = int(os.getenv("CIRCUIT_FAIL_THRESHOLD", "5"))
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "30"))
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "2000"))
+PROMPT_TURN_MAX_CHARS = int(os.getenv("PROMPT_TURN_MAX_CHARS", "600"))
+# persona-specific models kept around (system_instruction is fixed per model object)
+SESSION_MODELS_MAX = int(os.getenv("SESSION_MODELS_MAX", "16"))
+# context caching for the static prefix; the API refuses prefixes below its minimum size
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("CONTEXT_CACHE_MIN_TOKENS", "32768"))
+CONTEXT_CACHE_TTL = float(os.getenv("CONTEXT_CACHE_TTL", "3600"))
+SUMMARY_ENABLED = os.getenv("SUMMARY_ENABLED", "1") == "1"
+SUMMARY_TRIGGER = int(os.getenv("SUMMARY_TRIGGER", "10"))
+SUMMARY_MAX_CHARS = int(os.getenv("SUMMARY_MAX_CHARS", "1200"))
+KNOWLEDGE_DIR = os.getenv("KNOWLEDGE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "knowledge"))
+KNOWLEDGE_INDEX_PATH = os.getenv("KNOWLEDGE_INDEX_PATH", "knowledge.idx")
+KNOWLEDGE_DIRECT_SCORE = float(os.getenv("KNOWLEDGE_DIRECT_SCORE", "6"))
+KNOWLEDGE_DIRECT_CONFIDENCE = float(os.getenv("KNOWLEDGE_DIRECT_CONFIDENCE", "0.8"))
+# short questions hit 100% confidence on one or two common words; ask for more before skipping Gemini
+KNOWLEDGE_DIRECT_MIN_TERMS = int(os.getenv("KNOWLEDGE_DIRECT_MIN_TERMS", "3"))
+KNOWLEDGE_FALLBACK_CONFIDENCE = float(os.getenv("KNOWLEDGE_FALLBACK_CONFIDENCE", "0.4"))
+KNOWLEDGE_MIN_RATING = int(os.getenv("KNOWLEDGE_MIN_RATING", "2"))
+KNOWLEDGE_REBUILD_HOURS = float(os.getenv("KNOWLEDGE_REBUILD_HOURS", "24"))
+# chats older than this many days are archived then deleted; 0 keeps them forever
+CHAT_RETENTION_DAYS = float(os.getenv("CHAT_RETENTION_DAYS", "0"))
+# per-channel overrides, "channel_id:days,..." (0 = keep that channel forever)
+CHAT_RETENTION_CHANNELS = parse_retention(os.getenv("CHAT_RETENTION_CHANNELS", ""))
+CHAT_ARCHIVE_DIR = os.getenv("CHAT_ARCHIVE_DIR", "archive")
+MAINTENANCE_INTERVAL_HOURS = float(os.getenv("MAINTENANCE_INTERVAL_HOURS", "6"))
+# one-off full VACUUM at the next maintenance pass so an old DB file can shrink incrementally;
+# blocks every read/write for the rewrite and needs ~2x the file size free, so run it in a quiet window
+DB_CONVERT_INCREMENTAL_VACUUM = os.getenv("DB_CONVERT_INCREMENTAL_VACUUM", "0") == "1"
+# "" = one plain Bot; "auto" or a number = AutoShardedBot
+SHARD_COUNT = os.getenv("SHARD_COUNT", "").strip()
+# >1 turns this process into a supervisor for that many shard worker processes
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "1"))
+# set by the supervisor for its workers
+WORKER_INDEX = int(os.getenv("EKKO_WORKER_INDEX", "0"))
+# slash command sync: "auto" (only when the command definitions changed), "always" or "off"
+COMMAND_SYNC = os.getenv("COMMAND_SYNC", "auto").strip().lower()
+SHARD_IDS = shards.parse_shard_ids(os.getenv("EKKO_SHARD_IDS", ""))
+# where cooldowns / Gemini quota / breaker live: "local" or "sqlite:<path>" (shared by workers)
+SHARED_STATE = os.getenv("SHARED_STATE", "local")
+SHARED_SYNC_SECONDS = float(os.getenv("SHARED_SYNC_SECONDS", "1"))
+HTTP_HOST = os.getenv("HTTP_HOST", "0.0.0.0")
+# each shard worker listens on PORT + its index
+HTTP_PORT = int(os.getenv("PORT", "8080")) + WORKER_INDEX
+HEALTH_MAX_LOOP_LAG = float(os.getenv("HEALTH_MAX_LOOP_LAG", "2"))
+HEALTH_DB_TIMEOUT = float(os.getenv("HEALTH_DB_TIMEOUT", "3"))
+# /readyz fails once the Gemini queue is this full (fraction of API_QUEUE_MAX)
+READY_QUEUE_SATURATION = float(os.getenv("READY_QUEUE_SATURATION", "0.9"))
 
 # Persona
 PERSONA_NAME = "Cửu Lưu Manh"
@@ -61,104 +171,475 @@ logger = logging.getLogger("ekko")
 # ---------------------------
 GEMINI_OK = False
 G_MODEL: Optional[Any] = None
-_api_semaphore = asyncio.Semaphore(CONCURRENCY)
+# fair (per channel / per user) replacement for a global semaphore
+api_scheduler = FairScheduler(CONCURRENCY, max_queue=API_QUEUE_MAX, max_per_user=API_QUEUE_PER_USER)
 
-# circuit breaker state
-_circuit_open = False
-_circuit_open_until = 0.0
-_circuit_failures = 0
-CIRCUIT_FAIL_THRESHOLD = 5
-CIRCUIT_OPEN_SECONDS = 30
+shared_state = open_backend(SHARED_STATE, max_keys=USER_STATE_MAX)
 
-if GENAI_AVAILABLE and GEMINI_KEY:
-    try:
-        genai.configure(api_key=GEMINI_KEY)
-        # create model lazily (some SDKs allow reusing object, some prefer creating per-call)
+# AIMD concurrency + RPM/TPM buckets + circuit breaker; drives the scheduler's limit
+api_limiter = GeminiLimiter(
+    CONCURRENCY,
+    min_limit=API_CONCURRENCY_MIN,
+    max_limit=API_CONCURRENCY_MAX,
+    rpm=GEMINI_RPM,
+    tpm=GEMINI_TPM,
+    fail_threshold=CIRCUIT_FAIL_THRESHOLD,
+    open_seconds=CIRCUIT_OPEN_SECONDS,
+    latency_target=API_LATENCY_TARGET,
+    on_limit_change=api_scheduler.set_limit,
+    shared=shared_state if shared_state.name != "local" else None,
+)
+api_scheduler.set_limit(api_limiter.limit)
+
+# ---------------------------
+# Metrics (served on /metrics by the health server) + sampled traces (TRACE_PATH / TRACE_SAMPLE_RATE)
+# ---------------------------
+GEMINI_ATTEMPT_SECONDS = metrics.Histogram(
+    "ekko_gemini_attempt_seconds", "Latency of each Gemini API attempt", ["attempt", "outcome"])
+FIRST_VISIBLE_SECONDS = metrics.Histogram(
+    "ekko_first_visible_seconds", "Time from message receipt to first reply text on Discord")
+RETRIES = metrics.Counter("ekko_gemini_retries_total", "Gemini attempts retried after a failure")
+FALLBACKS = metrics.Counter("ekko_fallbacks_total", "Replies served by the local persona fallback", ["reason"])
+HEDGES = metrics.Counter("ekko_gemini_hedges_total", "Hedged Gemini requests", ["outcome"])
+EVENT_LOOP_LAG = metrics.Gauge("ekko_event_loop_lag_seconds", "How late a periodic event-loop timer fires")
+STARTUP_SECONDS = metrics.Gauge(
+    "ekko_startup_seconds", "Seconds from process start to each startup phase", ["phase"])
+
+metrics.CallbackMetric("ekko_api_slots", "Gemini slots in use / allowed", "gauge",
+                       lambda: {("active",): api_scheduler.active, ("limit",): api_scheduler.limit}, ["state"])
+metrics.CallbackMetric("ekko_api_queue_depth", "Requests waiting for a Gemini slot", "gauge",
+                       lambda: {(): api_scheduler.depth})
+metrics.CallbackMetric("ekko_api_queue_wait_seconds", "Queue wait for a Gemini slot", "gauge",
+                       lambda: {("last",): api_scheduler.last_wait, ("avg",): api_scheduler.avg_wait,
+                                ("max",): api_scheduler.max_wait}, ["stat"])
+metrics.CallbackMetric("ekko_api_requests_dropped_total", "Requests shed (queue full) or expired in queue", "counter",
+                       lambda: {("shed",): api_scheduler.shed, ("expired",): api_scheduler.expired}, ["reason"])
+metrics.CallbackMetric("ekko_circuit_open", "1 while the Gemini circuit breaker is open", "gauge",
+                       lambda: {(): int(api_limiter.circuit_open)})
+metrics.CallbackMetric("ekko_circuit_opens_total", "Times the Gemini circuit breaker opened", "counter",
+                       lambda: {(): api_limiter.circuit_opens})
+metrics.CallbackMetric("ekko_gemini_errors_total", "Gemini errors by kind", "counter",
+                       lambda: {("throttled",): api_limiter.throttled, ("server",): api_limiter.server_errors}, ["kind"])
+metrics.CallbackMetric("ekko_response_cache_total", "Response cache lookups", "counter",
+                       lambda: {("hit",): response_cache.hits, ("miss",): response_cache.misses}, ["result"])
+metrics.CallbackMetric("ekko_coalesced_requests_total", "Requests that joined an identical in-flight call", "counter",
+                       lambda: {(): _inflight.shared})
+metrics.CallbackMetric("ekko_user_state_entries", "Per-user entries held in memory", "gauge",
+                       lambda: {("shared_state",): shared_state.size(), ("persona",): user_personas.stats()["cached"]}, ["kind"])
+metrics.CallbackMetric("ekko_db_size", "Sizes from the last maintenance pass (bytes / rows)", "gauge",
+                       lambda: {(k,): v for k, v in chat_archiver.last_sizes.items()}, ["what"])
+metrics.CallbackMetric("ekko_db_archived_rows_total", "Chat rows moved to the archive", "counter",
+                       lambda: {(): chat_archiver.archived})
+metrics.CallbackMetric("ekko_debounced_messages_total", "Messages merged into an earlier message's request", "counter",
+                       lambda: {(): debouncer.joined})
+metrics.CallbackMetric("ekko_context_cache_hits_total", "Gemini calls served from a cached prompt prefix", "counter",
+                       lambda: {(): sessions.cache_hits})
+metrics.CallbackMetric("ekko_db_pending_writes", "Chat rows queued but not yet committed", "gauge",
+                       lambda: {(): chat_db.pending_writes})
+
+async def _shared_state_loop():
+    # breaker state opened by other workers
+    while True:
         try:
-            G_MODEL = genai.GenerativeModel(MODEL_NAME)
+            await api_limiter.sync_shared()
         except Exception:
-            G_MODEL = None
+            logger.exception("Shared state sync failed")
+        await asyncio.sleep(SHARED_SYNC_SECONDS)
+
+async def _event_loop_lag_monitor(interval: float = 0.5):
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.set(max(0.0, time.monotonic() - started - interval))
+
+def _startup_phase(phase: str):
+    seconds = time.monotonic() - _BOOT_STARTED
+    STARTUP_SECONDS.labels(phase).set(seconds)
+    logger.info("Startup: %s after %.2fs", phase, seconds)
+
+_gemini_init: Optional[asyncio.Future] = None
+_gemini_failed = False
+
+def _load_gemini():
+    # runs on a worker thread so the import doesn't stall the event loop
+    import google.generativeai as sdk
+    sdk.configure(api_key=GEMINI_KEY)
+    try:
+        model = sdk.GenerativeModel(MODEL_NAME)
+    except Exception:
+        model = None
+    return sdk, model
+
+async def ensure_gemini() -> bool:
+    """Import and configure the Gemini SDK on first use; True once it is usable."""
+    global _gemini_init, _gemini_failed, genai, G_MODEL, GEMINI_OK
+    if GEMINI_OK or _gemini_failed or not (GENAI_AVAILABLE and GEMINI_KEY):
+        return GEMINI_OK
+    if _gemini_init is None:
+        _gemini_init = asyncio.get_running_loop().run_in_executor(None, _load_gemini)
+    try:
+        sdk, model = await asyncio.shield(_gemini_init)
+    except Exception as e:
+        if not _gemini_failed:
+            _gemini_failed = True
+            logger.exception("Gemini configure failed: %s", e)
+        return False
+    if not GEMINI_OK:
+        genai, G_MODEL = sdk, model
+        sessions.genai = sdk
+        sessions.detect(G_MODEL)
         GEMINI_OK = True
         logger.info("Gemini configured: %s", MODEL_NAME)
-    except Exception as e:
-        logger.exception("Gemini configure failed: %s", e)
-        GEMINI_OK = False
-else:
+        _startup_phase("gemini_ready")
+    return True
+
+if not (GENAI_AVAILABLE and GEMINI_KEY):
     logger.info("Gemini disabled (SDK missing or API key not set)")
 
 # ---------------------------
 # DB helpers
 # ---------------------------
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
+# schema migrations, applied in order and tracked with PRAGMA user_version
+MIGRATIONS = [
+    "CREATE INDEX IF NOT EXISTS idx_chats_channel_id ON chats (channel_id, id)",
+    "CREATE TABLE IF NOT EXISTS response_cache (key TEXT PRIMARY KEY, response TEXT, expires_at REAL)",
+    "CREATE TABLE IF NOT EXISTS channel_summaries (channel_id INTEGER PRIMARY KEY, summary TEXT, last_chat_id INTEGER, updated_at TEXT)",
+    "ALTER TABLE chats ADD COLUMN message_id INTEGER",
+    "ALTER TABLE chats ADD COLUMN rating INTEGER DEFAULT 0",
+    "CREATE INDEX IF NOT EXISTS idx_chats_message_id ON chats (message_id)",
+    "CREATE TABLE IF NOT EXISTS user_personas (user_id INTEGER PRIMARY KEY, persona TEXT, updated_at REAL)",
+    # 8-9 used to force the full VACUUM that enables incremental vacuum; it is now opt-in
+    # (DB_CONVERT_INCREMENTAL_VACUUM), new files get the mode in _migrate
+    "SELECT 1",
+    "SELECT 1",
+    "CREATE TABLE IF NOT EXISTS reply_messages (message_id INTEGER PRIMARY KEY, reply_id INTEGER, channel_id INTEGER, user_id INTEGER, created_at REAL)",
+    "CREATE INDEX IF NOT EXISTS idx_reply_messages_reply_id ON reply_messages (reply_id)",
+    "CREATE TABLE IF NOT EXISTS bot_meta (key TEXT PRIMARY KEY, value TEXT)",
+    "CREATE TABLE IF NOT EXISTS reply_votes (reply_id INTEGER, user_id INTEGER, PRIMARY KEY (reply_id, user_id))",
+]
+
+def _migrate(conn: sqlite3.Connection):
     c = conn.cursor()
-    c.execute(
-        """
-        CREATE TABLE IF NOT EXISTS chats (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            channel_id INTEGER,
-            role TEXT,
-            persona TEXT,
-            content TEXT,
-            timestamp TEXT
+    if not c.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone():
+        # the VACUUM that switches the mode is free on an empty file; old files opt in (retention.py)
+        conn.executescript("PRAGMA auto_vacuum = INCREMENTAL; VACUUM;")
+    # under the write lock: another process migrating the same file makes us wait,
+    # then user_version already says its steps are done
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS chats (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                channel_id INTEGER,
+                role TEXT,
+                persona TEXT,
+                content TEXT,
+                timestamp TEXT
+            )
+            """
         )
-        """
-    )
-    conn.commit()
-    conn.close()
+        version = c.execute("PRAGMA user_version").fetchone()[0]
+        for i, stmt in enumerate(MIGRATIONS[version:], start=version + 1):
+            c.execute(stmt)
+            c.execute(f"PRAGMA user_version = {i}")
+            logger.info("DB migration %d applied", i)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+def migrate_db():
+    """Blocking migration for a process without the bot loop (the shard supervisor)."""
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        _migrate(conn)
+    finally:
+        conn.close()
+
+# one long-lived WAL connection on its own thread; chat rows are write-behind
+chat_db = ChatDB(DB_PATH, flush_interval=DB_FLUSH_INTERVAL, batch_size=DB_BATCH_SIZE)
+chat_db.on_flush = lambda rows, seconds: metrics.STAGE_SECONDS.labels("db_write").observe(seconds)
+DB_READY = False
+
+async def init_db():
+    """Create the schema and apply pending migrations on the DB thread, ahead of any queued write."""
+    global DB_READY
+    await chat_db.call(_migrate)
+    DB_READY = True
+    _startup_phase("db_ready")
 
-init_db()
+async def meta_get(key: str) -> Optional[str]:
+    rows = await db_all("SELECT value FROM bot_meta WHERE key = ?", (key,))
+    return rows[0][0] if rows else None
+
+async def meta_set(key: str, value: str):
+    await db_exec("INSERT OR REPLACE INTO bot_meta (key, value) VALUES (?, ?)", (key, value))
 
 async def db_exec(query: str, params=()):
-    loop = asyncio.get_running_loop()
-    def _run():
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute(query, params)
-        conn.commit()
-        conn.close()
-    await loop.run_in_executor(None, _run)
+    return await chat_db.execute(query, params)
 
 async def db_all(query: str, params=()):
-    loop = asyncio.get_running_loop()
-    def _run():
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute(query, params)
-        rows = c.fetchall()
-        conn.close()
-        return rows
-    return await loop.run_in_executor(None, _run)
+    return await chat_db.fetchall(query, params)
+
+# ---------------------------
+# History ring buffer (per channel, LRU over channels)
+# ---------------------------
+class HistoryCache:
+    """Last `size` (role, persona, content) rows per channel, at most `max_channels` channels."""
+
+    def __init__(self, size: int, max_channels: int):
+        self.size = size
+        self.max_channels = max(1, max_channels)
+        self._channels: "OrderedDict[int, Deque[Tuple]]" = OrderedDict()
+        # channel_id -> rows saved while a cold load is in flight
+        self._loading: Dict[int, List[Tuple]] = {}
+
+    def get(self, channel_id: int, limit: int) -> Optional[List[Tuple]]:
+        buf = self._channels.get(channel_id)
+        if buf is None or limit > self.size:
+            return None
+        self._channels.move_to_end(channel_id)
+        return list(buf)[-limit:] if limit > 0 else []
+
+    def begin_load(self, channel_id: int) -> Optional[List[Tuple]]:
+        # the DB read must be queued right after this call: writes queued later
+        # are not in its result and get replayed from the returned list
+        if channel_id in self._loading:
+            return None
+        token: List[Tuple] = []
+        self._loading[channel_id] = token
+        return token
+
+    def finish_load(self, channel_id: int, token: Optional[List[Tuple]], rows: List[Tuple]):
+        if token is None or self._loading.get(channel_id) is not token:
+            return
+        del self._loading[channel_id]
+        self._channels[channel_id] = deque(list(rows) + token, maxlen=self.size)
+        self._channels.move_to_end(channel_id)
+        while len(self._channels) > self.max_channels:
+            self._channels.popitem(last=False)
+
+    def append(self, channel_id: int, row: Tuple):
+        token = self._loading.get(channel_id)
+        if token is not None:
+            token.append(row)
+        buf = self._channels.get(channel_id)
+        if buf is not None:
+            buf.append(row)
+
+    def invalidate(self, channel_id: int):
+        self._channels.pop(channel_id, None)
+        self._loading.pop(channel_id, None)
+
+history_cache = HistoryCache(HISTORY_MESSAGES, HISTORY_CACHE_CHANNELS)
+
+# ---------------------------
+# Reply ownership (every chunk of a bot reply -> the user who asked)
+# ---------------------------
+class ReplyOwners:
+    """message_id -> (reply_id, channel_id, user_id), reply_id being the reply's first chunk.
+    LRU in front of the reply_messages table; writes are write-behind like chat rows."""
+
+    def __init__(self, db: ChatDB, max_entries: int):
+        self.db = db
+        self.max_entries = max(1, max_entries)
+        self._owners: "OrderedDict[int, Tuple[int, int, int]]" = OrderedDict()
+        self._groups: Dict[int, List[int]] = {}
+
+    def _remember(self, reply_id: int, channel_id: int, user_id: int, message_ids: List[int]):
+        self._groups[reply_id] = list(message_ids)
+        for mid in message_ids:
+            self._owners[mid] = (reply_id, channel_id, user_id)
+            self._owners.move_to_end(mid)
+        while len(self._owners) > self.max_entries:
+            mid, (rid, _, _) = self._owners.popitem(last=False)
+            self._groups.pop(rid, None)
+
+    def record(self, message_ids: List[int], channel_id: int, user_id: int):
+        if not message_ids:
+            return
+        reply_id = message_ids[0]
+        self._remember(reply_id, channel_id, user_id, message_ids)
+        now = time.time()
+        for mid in message_ids:
+            self.db.enqueue(
+                "INSERT OR REPLACE INTO reply_messages (message_id, reply_id, channel_id, user_id, created_at) VALUES (?, ?, ?, ?, ?)",
+                (mid, reply_id, channel_id, user_id, now))
+
+    async def lookup(self, message_id: int) -> Optional[Tuple[int, int, int]]:
+        owner = self._owners.get(message_id)
+        if owner is not None:
+            self._owners.move_to_end(message_id)
+            return owner
+        # load the whole reply so later reactions on any of its chunks hit the cache
+        loaded = await self._load(
+            "reply_id = (SELECT reply_id FROM reply_messages WHERE message_id = ?)", (message_id,))
+        return loaded[0] if loaded else None
+
+    async def group(self, reply_id: int) -> List[int]:
+        ids = self._groups.get(reply_id)
+        if ids is not None:
+            return list(ids)
+        loaded = await self._load("reply_id = ?", (reply_id,))
+        return loaded[1] if loaded else [reply_id]
+
+    async def _load(self, where: str, params: tuple) -> Optional[Tuple[Tuple[int, int, int], List[int]]]:
+        """((reply_id, channel_id, user_id), message_ids) of one reply from the table, now cached."""
+        rows = await self.db.fetchall(
+            f"SELECT message_id, reply_id, channel_id, user_id FROM reply_messages WHERE {where} ORDER BY message_id",
+            params)
+        if not rows:
+            return None
+        owner = tuple(rows[0][1:])
+        ids = [r[0] for r in rows]
+        self._remember(*owner, ids)
+        return owner, ids
+
+    def forget(self, reply_id: int):
+        for mid in self._groups.pop(reply_id, []):
+            self._owners.pop(mid, None)
+        self.db.enqueue("DELETE FROM reply_messages WHERE reply_id = ?", (reply_id,))
+
+    async def prune(self, older_than_days: float) -> int:
+        if older_than_days <= 0:
+            return 0
+        cutoff = time.time() - older_than_days * 86400
+        return await self.db.execute("DELETE FROM reply_messages WHERE created_at < ?", (cutoff,))
 
-async def save_chat(user_id: int, channel_id: int, role: str, persona: str, content: str):
+reply_owners = ReplyOwners(chat_db, REPLY_OWNERS_CACHE)
+
+response_cache = ResponseCache(
+    max_entries=RESPONSE_CACHE_SIZE,
+    ttl=RESPONSE_CACHE_TTL,
+    db=chat_db if RESPONSE_CACHE_PERSIST else None,
+    history_policy=RESPONSE_CACHE_HISTORY_POLICY,
+)
+
+async def save_chat(user_id: int, channel_id: int, role: str, persona: str, content: str,
+                    message_id: Optional[int] = None):
     ts = datetime.datetime.utcnow().isoformat()
-    await db_exec(
-        "INSERT INTO chats (user_id, channel_id, role, persona, content, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
-        (user_id, channel_id, role, persona, content, ts)
+    chat_db.enqueue(
+        "INSERT INTO chats (user_id, channel_id, role, persona, content, timestamp, message_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (user_id, channel_id, role, persona, content, ts, message_id)
     )
+    history_cache.append(channel_id, (role, persona, content))
 
 async def fetch_history(channel_id: int, limit=HISTORY_MESSAGES):
+    cached = history_cache.get(channel_id, limit)
+    if cached is not None:
+        return cached
+    token = history_cache.begin_load(channel_id)
     rows = await db_all(
         "SELECT role, persona, content FROM chats WHERE channel_id = ? ORDER BY id DESC LIMIT ?",
-        (channel_id, limit)
+        (channel_id, max(limit, history_cache.size))
     )
-    return list(reversed(rows))
+    rows = list(reversed(rows))
+    history_cache.finish_load(channel_id, token, rows)
+    return rows[-limit:] if limit > 0 else []
+
+async def reset_user_history(user_id: int, channel_id: int):
+    await db_exec("DELETE FROM chats WHERE user_id = ? AND channel_id = ?", (user_id, channel_id))
+    history_cache.invalidate(channel_id)
+    # the rolling summary may quote what was just forgotten
+    channel_summaries.invalidate(channel_id)
+
+def _on_archived(channel_ids):
+    for channel_id in channel_ids:
+        history_cache.invalidate(channel_id)
+
+chat_archiver = ChatArchiver(
+    chat_db,
+    CHAT_ARCHIVE_DIR,
+    default_days=CHAT_RETENTION_DAYS,
+    per_channel=CHAT_RETENTION_CHANNELS,
+    keep_min_rating=KNOWLEDGE_MIN_RATING,
+    on_archived=_on_archived,
+    convert_auto_vacuum=DB_CONVERT_INCREMENTAL_VACUUM,
+)
+
+async def _maintenance_loop():
+    while True:
+        try:
+            with metrics.stage("maintenance"):
+                await reply_owners.prune(CHAT_RETENTION_DAYS)
+                sizes = await chat_archiver.run_once()
+                # votes whose answer was archived
+                await db_exec("DELETE FROM reply_votes WHERE reply_id NOT IN"
+                              " (SELECT message_id FROM chats WHERE message_id IS NOT NULL)")
+            logger.info("DB maintenance done: %.1f MB file, %d chat rows",
+                        sizes.get("db_file_bytes", 0) / 1e6, sizes.get("rows_chats", 0))
+        except Exception:
+            logger.exception("DB maintenance failed")
+        await asyncio.sleep(MAINTENANCE_INTERVAL_HOURS * 3600)
 
 # ---------------------------
-# Cooldown
+# Cooldown + persona (bounded per-user state)
 # ---------------------------
-_user_last = {}
+_cooldown = Cooldown(COOLDOWN_SECONDS, burst=COOLDOWN_BURST, backend=shared_state)
+# personas live in the shared DB file; other workers see a change after USER_STATE_TTL at most
+user_personas = PersonaStore(chat_db, PERSONA_NAME, max_users=USER_STATE_MAX, ttl=USER_STATE_TTL)
 
-def is_on_cooldown(uid: int):
-    now = time.time()
-    last = _user_last.get(uid)
-    if last and now - last < COOLDOWN_SECONDS:
-        return True, COOLDOWN_SECONDS - (now - last)
-    return False, 0
+async def is_on_cooldown(uid: int):
+    return await _cooldown.check(uid)
 
-def set_cooldown(uid: int):
-    _user_last[uid] = time.time()
+async def set_cooldown(uid: int):
+    await _cooldown.hit(uid)
+
+# ---------------------------
+# Debounce: a question typed over several quick messages gets one reply
+# ---------------------------
+class _Batch:
+    __slots__ = ("parts", "started", "last")
+
+    def __init__(self, text: str):
+        self.parts = [text]
+        self.started = self.last = time.monotonic()
+
+class Debouncer:
+    """Per (user, channel) window; each new fragment extends it, up to max_wait / max_parts."""
+
+    def __init__(self, window: float, max_wait: float, max_parts: int):
+        self.window = window
+        self.max_wait = max(window, max_wait)
+        self.max_parts = max(1, max_parts)
+        self._open: Dict[Tuple[int, int], _Batch] = {}
+        self.joined = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    def open(self, key: Tuple[int, int], text: str):
+        self._open[key] = _Batch(text)
+
+    def join(self, key: Tuple[int, int], text: str) -> bool:
+        """Add text to an open batch; False if there is none (or it is full)."""
+        batch = self._open.get(key)
+        # past max_wait the batch is being answered (or its handler died): start a new one
+        if batch is None or len(batch.parts) >= self.max_parts or time.monotonic() - batch.started > self.max_wait:
+            return False
+        batch.parts.append(text)
+        batch.last = time.monotonic()
+        self.joined += 1
+        return True
+
+    async def collect(self, key: Tuple[int, int]) -> List[str]:
+        """Wait until the user stops typing, then close the batch and return its fragments in order."""
+        batch = self._open[key]
+        try:
+            while len(batch.parts) < self.max_parts:
+                wait = min(batch.last + self.window, batch.started + self.max_wait) - time.monotonic()
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+        finally:
+            self._open.pop(key, None)
+        return list(batch.parts)
+
+debouncer = Debouncer(DEBOUNCE_SECONDS, DEBOUNCE_MAX_SECONDS, DEBOUNCE_MAX_PARTS)
 
 # ---------------------------
 # Kiếm hiệp error messages (random)
@@ -174,20 +655,39 @@ KIEM_HIEP_ERRORS_HARD = [
     "🍶 Có cao thủ đánh lén vào máy chủ! Để tại hạ trấn áp rồi hồi âm.",
     "🍶 Tâm pháp đứt gẫy — phải liệu cơm gắp mắm một chút, chờ tại hạ đã.",
 ]
+# request sat in the queue past its deadline
+KIEM_HIEP_EXPIRED = [
+    "🍶 Khách xếp hàng dài quá, câu của đại hiệp nguội mất rồi. Hỏi lại giúp tại hạ nhé!",
+    "🍶 Trà đã nguội mà chưa tới lượt — đại hiệp hỏi lại, tại hạ đáp ngay.",
+]
 
 # ---------------------------
 # Prompt builder
 # ---------------------------
-def build_prompt(system_text: str, history: List, user_text: str) -> str:
-    parts = [system_text]
-    if history:
-        parts.append("-- Hội thoại gần đây --")
-        for role, persona, content in history:
-            label = "Đại hiệp" if role == "user" else (persona or "Bot")
-            parts.append(f"[{label}] {content}")
-    parts.append("-- Yêu cầu hiện tại --")
-    parts.append(user_text)
-    return "\n".join(parts)
+def build_prompt(system_text: str, history: List, user_text: str, summary: str = "",
+                 budget: int = PROMPT_TOKEN_BUDGET) -> str:
+    """Persona + current request always go in; summary and the newest turns fill the token budget."""
+    head = [system_text]
+    tail = ["-- Yêu cầu hiện tại --", user_text]
+    used = estimate_tokens("\n".join(head + tail))
+    if summary:
+        block = ["-- Tóm tắt hội thoại trước --", summary]
+        cost = estimate_tokens("\n".join(block))
+        if used + cost <= budget:
+            head += block
+            used += cost
+    turns = []
+    for role, persona, content in reversed(history or []):
+        line = f"[{turn_label(role, persona)}] {clip(content, PROMPT_TURN_MAX_CHARS)}"
+        cost = estimate_tokens(line) + 1
+        if used + cost > budget:
+            break
+        turns.append(line)
+        used += cost
+    if turns:
+        head.append("-- Hội thoại gần đây --")
+        head += reversed(turns)
+    return "\n".join(head + tail)
 
 # ---------------------------
 # Helper: parse various Gemini response shapes
@@ -218,14 +718,79 @@ def _extract_text_from_response(resp: Any) -> Optional[str]:
         logger.exception('Error extracting text from response')
     return None
 
+# ---------------------------
+# Local knowledge (BM25 over knowledge/ + 👍-rated answers), mmapped from disk
+# ---------------------------
+knowledge_index: Optional[knowledge.KnowledgeIndex] = None
+
+RATED_ANSWERS_SQL = (
+    "SELECT b.content, (SELECT u.content FROM chats u WHERE u.channel_id = b.channel_id AND u.user_id = b.user_id"
+    " AND u.role = 'user' AND u.id < b.id ORDER BY u.id DESC LIMIT 1)"
+    " FROM chats b WHERE b.role = 'bot' AND b.rating >= ? ORDER BY b.rating DESC, b.id DESC LIMIT 2000"
+)
+
+async def refresh_knowledge():
+    global knowledge_index
+    rated = await db_all(RATED_ANSWERS_SQL, (KNOWLEDGE_MIN_RATING,))
+    rated_docs = [
+        {"title": question or "", "text": answer.replace("Tại hạ nói: ", "", 1), "source": "chats"}
+        for answer, question in rated if answer
+    ]
+    extra = hashlib.sha1(repr(rated).encode("utf-8")).hexdigest()
+    signature = knowledge.corpus_signature(KNOWLEDGE_DIR, extra)
+
+    def _docs():
+        return knowledge.load_corpus(KNOWLEDGE_DIR) + rated_docs
+
+    loop = asyncio.get_running_loop()
+    index = await loop.run_in_executor(None, knowledge.open_or_build, KNOWLEDGE_INDEX_PATH, _docs, signature)
+    old, knowledge_index = knowledge_index, index
+    if old is not None and old is not index:
+        old.close()
+    if index is not None:
+        logger.info("Knowledge index ready: %d docs", index.n_docs)
+
+async def _knowledge_loop():
+    while True:
+        try:
+            await refresh_knowledge()
+        except Exception:
+            logger.exception("Knowledge index refresh failed")
+        await asyncio.sleep(KNOWLEDGE_REBUILD_HOURS * 3600)
+
+def knowledge_lookup(user_text: str, min_confidence: float, min_score: float = 0.0,
+                     direct: bool = False) -> Optional[Dict[str, str]]:
+    """direct=True is for answering without Gemini: meta docs are skipped and the
+    question must share at least KNOWLEDGE_DIRECT_MIN_TERMS words with the doc."""
+    if knowledge_index is None:
+        return None
+    hits = knowledge_index.search(user_text, k=1)
+    if not hits:
+        return None
+    hit = hits[0]
+    if hit.confidence < min_confidence or hit.score < min_score:
+        return None
+    if direct and (hit.doc.get("direct") is False or hit.matched < KNOWLEDGE_DIRECT_MIN_TERMS):
+        return None
+    return hit.doc
+
+def knowledge_reply(doc: Dict[str, str], lead: str = "🍶 Tàng thư có ghi") -> str:
+    title = f" — **{doc['title']}**" if doc.get("title") else ""
+    return f"{lead}{title}:\n{knowledge.snippet(doc['text'], 1500)}"
+
 # ---------------------------
 # Local persona fallback (improved)
 # ---------------------------
-async def _local_persona_fallback(system_text: str, user_text: str) -> str:
+async def _local_persona_fallback(system_text: str, user_text: str, reason: str = "error") -> str:
+    FALLBACKS.labels(reason).inc()
     safe_user = (user_text or "").strip()
     if not safe_user:
         return random.choice(KIEM_HIEP_ERRORS)
 
+    doc = knowledge_lookup(safe_user, KNOWLEDGE_FALLBACK_CONFIDENCE)
+    if doc is not None:
+        return knowledge_reply(doc, "🍶 Máy chủ đang nghẽn, nhưng tàng thư có ghi")
+
     # If user asked a short question, try to give a short actionable hint so it's more useful
     if any(q in safe_user for q in ['?', 'gì', 'ai', 'ở đâu', 'như thế nào', 'nào', 'không']):
         return random.choice([
@@ -238,114 +803,670 @@ async def _local_persona_fallback(system_text: str, user_text: str) -> str:
         f"🍶 Ồ ho, {safe_user}? Nói rõ thêm để tại hạ phân tích cho tường tận.",
     ])
 
+def _chunk_text(chunk: Any) -> Optional[str]:
+    # streamed chunks raise on .text when they carry no parts (e.g. safety/finish chunks)
+    try:
+        return chunk.text
+    except Exception:
+        return None
+
+async def _open_stream(tier: ModelTier, request: GeminiRequest) -> Tuple[Any, str]:
+    """Start a streamed call on tier and wait for its first text: (chunk iterator, first piece).
+    The wait is what the tier timeout and hedging apply to; "" means the stream ended empty."""
+    async def _first():
+        model, contents = sessions.prepare(tier.model, request)
+        resp = await model.generate_content_async(
+            contents=contents,
+            generation_config={"max_output_tokens": MAX_TOKENS, "temperature": 0.7},
+            stream=True,
+        )
+        chunks = resp.__aiter__()
+        async for chunk in chunks:
+            piece = _chunk_text(chunk)
+            if piece:
+                return chunks, piece
+        return chunks, ""
+    return await _timed_tier(tier, "stream", _first())
+
+_STREAM_END = object()
+
+class StreamResult(NamedTuple):
+    text: str
+    first_chunk: float  # seconds until the first text arrived
+    model: str          # tier that answered (a hedge may win)
+    complete: bool      # False when the stream was cut off at the deadline
+
+async def _gemini_stream(request: GeminiRequest, on_chunk: Callable[[str], Awaitable[None]],
+                         attempt: int, deadline: float) -> StreamResult:
+    """Stream the attempt's tier; a hedge may start on the next tier until the first chunk arrives.
+    The rest of the stream must finish by the request deadline (or the tier timeout, if later)."""
+    started = time.monotonic()
+    tier = _attempt_tier(attempt)
+    (chunks, piece), answered = await _hedge_tiers(request, attempt, "stream", lambda t: _open_stream(t, request))
+    first_chunk = time.monotonic() - started
+    complete = True
+    parts: List[str] = []
+    end = max(deadline, started + tier.timeout)
+    try:
+        while piece is not _STREAM_END:
+            # chunks without text (safety ratings, finish metadata) are skipped, not taken as the end
+            if piece:
+                parts.append(piece)
+                try:
+                    await on_chunk("".join(parts).strip())
+                except Exception:
+                    logger.exception("Stream chunk callback failed")
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            try:
+                piece = _chunk_text(await asyncio.wait_for(chunks.__anext__(), remaining))
+            except StopAsyncIteration:
+                piece = _STREAM_END
+    except asyncio.TimeoutError:
+        if not parts:
+            raise
+        # the player already sees this text; keep it rather than retrying from scratch
+        logger.warning("Stream cut off after %.1fs with %d chars", time.monotonic() - started, len("".join(parts)))
+        complete = False
+    return StreamResult("".join(parts), first_chunk, answered.model, complete)
+
+# ---------------------------
+# Model tiers + hedged calls
+# ---------------------------
+_tier_models: Dict[str, Any] = {}
+_tier_latency: Dict[Tuple[str, str], LatencyTracker] = {}
+hedge_budget = HedgeBudget(HEDGE_MAX_RATIO)
+
+def _model_for(name: str):
+    if name == MODEL_NAME:
+        return G_MODEL
+    if name not in _tier_models:
+        try:
+            _tier_models[name] = genai.GenerativeModel(name) if genai is not None else None
+        except Exception:
+            logger.exception("Could not create model %s", name)
+            _tier_models[name] = None
+    return _tier_models[name]
+
+sessions = SessionManager(genai, _model_for, MODEL_NAME, PROMPT_TOKEN_BUDGET, PROMPT_TURN_MAX_CHARS,
+                          max_models=SESSION_MODELS_MAX, cache_min_tokens=CONTEXT_CACHE_MIN_TOKENS,
+                          cache_ttl=CONTEXT_CACHE_TTL)
+# capabilities are detected by ensure_gemini; a swapped-in model (tests, bench) calls sessions.detect itself
+
+def _tier_tracker(name: str, kind: str) -> LatencyTracker:
+    # "generate" = whole reply, "stream" = time to first chunk
+    tracker = _tier_latency.get((name, kind))
+    if tracker is None:
+        tracker = _tier_latency[(name, kind)] = LatencyTracker()
+    return tracker
+
+def _attempt_tier(attempt: int) -> ModelTier:
+    return MODEL_TIERS[min(attempt - 1, len(MODEL_TIERS) - 1)]
+
+async def _timed_tier(tier: ModelTier, kind: str, coro: Awaitable) -> Any:
+    """coro under the tier timeout; its latency feeds the tier's hedge percentile."""
+    started = time.monotonic()
+    try:
+        result = await asyncio.wait_for(coro, tier.timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        # timed out or lost a hedge: at least this slow, and leaving it out skews the percentile low
+        _tier_tracker(tier.model, kind).observe(time.monotonic() - started)
+        raise
+    if result:
+        _tier_tracker(tier.model, kind).observe(time.monotonic() - started)
+    return result
+
+async def _generate_once(model_name: str, request: GeminiRequest) -> Optional[str]:
+    """One non-streaming call through whichever SDK call style was detected at startup."""
+    caps = sessions.caps
+    if caps.async_generate:
+        model, contents = sessions.prepare(model_name, request)
+        resp = await model.generate_content_async(
+            contents=contents,
+            generation_config={"max_output_tokens": MAX_TOKENS, "temperature": 0.7}
+        )
+    elif caps.generate_text:
+        maybe_resp = genai.generate_text(model=model_name, input=request.prompt, max_output_tokens=MAX_TOKENS, temperature=0.7)
+        resp = await maybe_resp if asyncio.iscoroutine(maybe_resp) else maybe_resp
+    elif caps.create_response:
+        maybe_resp = genai.create_response(model=model_name, prompt=request.prompt)
+        resp = await maybe_resp if asyncio.iscoroutine(maybe_resp) else maybe_resp
+    else:
+        raise RuntimeError("Gemini SDK offers no supported call style")
+    text = _extract_text_from_response(resp)
+    if not text:
+        logger.debug("Full resp repr: %s", repr(resp))
+    return text
+
+async def _call_tier(tier: ModelTier, request: GeminiRequest) -> Optional[str]:
+    return await _timed_tier(tier, "generate", _generate_once(tier.model, request))
+
+async def _generate(request: GeminiRequest, attempt: int) -> Tuple[Optional[str], str]:
+    """(text, model that answered)."""
+    text, answered = await _hedge_tiers(request, attempt, "generate", lambda t: _call_tier(t, request))
+    return text, answered.model
+
+async def _hedge_tiers(request: GeminiRequest, attempt: int, kind: str,
+                       call: Callable[[ModelTier], Awaitable[Any]]) -> Tuple[Any, ModelTier]:
+    """Call the attempt's tier; past its latency percentile, race a hedge on the next tier.
+    Returns (result, tier that produced it)."""
+    tier = _attempt_tier(attempt)
+    backup = MODEL_TIERS[min(attempt, len(MODEL_TIERS) - 1)]
+    delay = None
+    if HEDGE_ENABLED:
+        hedge_budget.on_request()
+        delay = _tier_tracker(tier.model, kind).percentile(HEDGE_PERCENTILE)
+        if delay is not None:
+            delay = max(HEDGE_MIN_DELAY, delay)
+
+    async def _may_hedge() -> bool:
+        if not hedge_budget.try_spend():
+            HEDGES.labels("skipped_budget").inc()
+            return False
+        # the extra request needs quota right now; never wait for it
+        try:
+            admitted = await api_limiter.admit(request.tokens, time.monotonic())
+        except Exception as e:
+            logger.error("Shared quota backend failed, not hedging: %r", e)
+            admitted = False
+        if not admitted:
+            hedge_budget.refund()
+            HEDGES.labels("skipped_quota").inc()
+            return False
+        HEDGES.labels("fired").inc()
+        logger.info("Hedging %s after %.2fs with %s", tier.model, delay, backup.model)
+        return True
+
+    result, winner = await hedged(lambda: call(tier), lambda: call(backup), delay, _may_hedge)
+    if winner == "backup":
+        HEDGES.labels("won").inc()
+        return result, backup
+    return result, tier
+
+# ---------------------------
+# Single-flight: identical in-flight questions share one API call
+# ---------------------------
+class SingleFlight:
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Task] = {}
+        self.leaders = 0
+        self.shared = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._calls.get(key)
+        if task is not None:
+            self.shared += 1
+            logger.info("Coalesced with in-flight request (%d shared so far)", self.shared)
+        else:
+            self.leaders += 1
+            # own task so a cancelled caller doesn't cancel the others
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda t, k=key: self._forget(k, t))
+        return await asyncio.shield(task)
+
+    def _forget(self, key: str, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()  # mark retrieved even if every caller went away
+
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+_inflight = SingleFlight()
+
+def _coalesce_key(user_text: str, persona_key: str) -> Optional[str]:
+    # same rule as the response cache: only questions that don't lean on channel history
+    if not COALESCE_REQUESTS:
+        return None
+    if RESPONSE_CACHE_HISTORY_POLICY != "ignore" and not is_standalone(user_text):
+        return None
+    return ResponseCache.key(user_text, persona_key, MODEL_NAME)
+
 # ---------------------------
 # Gemini caller với retry/backoff + circuit-breaker
-# tries multiple SDK call styles for compatibility
 # ---------------------------
-async def gemini_text_reply(system_text: str, user_text: str, channel_id: int) -> str:
-    global _circuit_open, _circuit_open_until, _circuit_failures
-    # circuit open check
-    if _circuit_open and time.time() < _circuit_open_until:
+async def gemini_text_reply(system_text: str, user_text: str, channel_id: int, persona_key: str = PERSONA_NAME,
+                            on_chunk: Optional[Callable[[str], Awaitable[None]]] = None,
+                            user_id: int = 0, deadline: Optional[float] = None,
+                            own_rows: Sequence[str] = ()) -> str:
+    """on_chunk, if given, receives the accumulated text while the model streams.
+    deadline is a time.monotonic() value; past it the request is dropped instead of sent.
+    own_rows are the chat rows saved for this request; they are left out of the history."""
+    if deadline is None:
+        deadline = time.monotonic() + REQUEST_DEADLINE_SECONDS
+    # response cache goes first: a cached answer beats both the API and the fallback
+    cache_key = None
+    if response_cache.cacheable(user_text):
+        cache_key = response_cache.key(user_text, persona_key, MODEL_TIERS[0].model)
+        cached = await response_cache.get(cache_key)
+        if cached is not None:
+            stats = response_cache.stats()
+            logger.info("Response cache hit (hit rate %.0f%%, %d calls saved)", stats["hit_rate"] * 100, stats["api_calls_saved"])
+            return cached
+
+    # confident local match: answer from the knowledge index without calling Gemini
+    doc = knowledge_lookup(user_text, KNOWLEDGE_DIRECT_CONFIDENCE, KNOWLEDGE_DIRECT_SCORE, direct=True)
+    if doc is not None:
+        logger.info("Answered from knowledge index: %s", doc.get("title"))
+        return knowledge_reply(doc)
+
+    flight_key = _coalesce_key(user_text, persona_key)
+    if flight_key is not None:
+        return await _inflight.do(
+            flight_key,
+            lambda: _gemini_call(system_text, user_text, channel_id, cache_key, on_chunk, user_id, deadline, own_rows))
+    return await _gemini_call(system_text, user_text, channel_id, cache_key, on_chunk, user_id, deadline, own_rows)
+
+def _observe_attempt(attempt: int, outcome: str, attempt_started: float):
+    duration = time.monotonic() - attempt_started
+    GEMINI_ATTEMPT_SECONDS.labels(str(attempt) if attempt < 3 else "3+", outcome).observe(duration)
+    metrics.add_span("api_call", time.time() - duration, duration, attempt=attempt, outcome=outcome)
+
+async def _gemini_call(system_text: str, user_text: str, channel_id: int, cache_key: Optional[str],
+                       on_chunk: Optional[Callable[[str], Awaitable[None]]], user_id: int, deadline: float,
+                       own_rows: Sequence[str] = ()) -> str:
+    # circuit open check (half-opens by itself once the open period is over)
+    if not api_limiter.allow():
         logger.info("Circuit open — returning persona fallback")
-        return await _local_persona_fallback(system_text, user_text)
-    elif _circuit_open and time.time() >= _circuit_open_until:
-        # try half-open
-        _circuit_open = False
-        _circuit_failures = 0
+        return await _local_persona_fallback(system_text, user_text, "circuit_open")
 
     # If Gemini not configured, use local fallback
-    if not GEMINI_OK or (GENAI_AVAILABLE and G_MODEL is None):
+    if not await ensure_gemini() or (genai is not None and G_MODEL is None):
         logger.info("Gemini unavailable — using local persona fallback")
-        return await _local_persona_fallback(system_text, user_text)
+        return await _local_persona_fallback(system_text, user_text, "unavailable")
 
-    history = await fetch_history(channel_id)
-    prompt = build_prompt(system_text, history, user_text)
+    with metrics.stage("history_fetch"):
+        history = drop_own_rows(await fetch_history(channel_id), own_rows)
+        summary = await channel_summaries.get(channel_id) if SUMMARY_ENABLED else ""
+    with metrics.stage("prompt_build"):
+        request = sessions.build(system_text, history, user_text, summary)
+        if not sessions.caps.async_generate:
+            # the legacy text APIs only take one flat prompt
+            prompt = build_prompt(system_text, history, user_text, summary)
+            request = request._replace(prompt=prompt, tokens=estimate_tokens(prompt))
 
     last_exc = None
-    async with _api_semaphore:
+    started = time.monotonic()
+    prompt_tokens = request.tokens
+    use_stream = on_chunk is not None and STREAM_REPLIES and sessions.caps.async_generate
+    try:
+        with metrics.stage("api_queue"):
+            await api_scheduler.acquire(user_id, channel_id, deadline)
+    except QueueFull:
+        return random.choice(KIEM_HIEP_ERRORS_HARD)
+    except RequestExpired:
+        logger.info("Request for user %s expired in queue", user_id)
+        return random.choice(KIEM_HIEP_EXPIRED)
+    try:
         for attempt in range(1, MAX_RETRIES + 1):
             try:
-                logger.info("Gemini attempt %s (attempt %d)", MODEL_NAME, attempt)
-
-                resp = None
-                # Try preferred async model method if available
-                try:
-                    if G_MODEL is not None and hasattr(G_MODEL, 'generate_content_async'):
-                        resp = await G_MODEL.generate_content_async(
-                            contents=[{"role": "user", "parts": [prompt]}],
-                            generation_config={"max_output_tokens": MAX_TOKENS, "temperature": 0.7}
-                        )
-                    else:
-                        # Fallback to top-level helper
-                        maybe = getattr(genai, 'generate_text', None)
-                        if maybe:
-                            maybe_resp = maybe(model=MODEL_NAME, input=prompt, max_output_tokens=MAX_TOKENS, temperature=0.7)
-                            resp = await maybe_resp if asyncio.iscoroutine(maybe_resp) else maybe_resp
-                        else:
-                            # Another fallback: genai.create_response if exists
-                            creator = getattr(genai, 'create_response', None)
-                            if creator:
-                                maybe_resp = creator(model=MODEL_NAME, prompt=prompt)
-                                resp = await maybe_resp if asyncio.iscoroutine(maybe_resp) else maybe_resp
-
-                except Exception as inner_e:
-                    logger.warning("Primary Gemini call failed: %s", repr(inner_e))
-                    # keep resp as None and try alternative below
-
-                # parse
-                text = _extract_text_from_response(resp)
-                if not text:
-                    # if resp is None or not parsed, try to log and attempt a simpler call
-                    logger.debug("Full resp repr: %s", repr(resp))
-                    # attempt a simple generate_text call if not tried
+                admitted = await api_limiter.admit(prompt_tokens, deadline)
+            except Exception as e:
+                # the shared quota store failing says nothing about Gemini: keep it off the circuit
+                logger.error("Shared quota backend failed: %r", e)
+                return await _local_persona_fallback(system_text, user_text, "quota_backend")
+            if not admitted:
+                logger.info("Rate limit wait would pass the deadline — dropping request")
+                return random.choice(KIEM_HIEP_EXPIRED)
+            logger.info("Gemini attempt %s (attempt %d)", _attempt_tier(attempt).model, attempt)
+            attempt_started = time.monotonic()
+            try:
+                latency = None
+                complete = True
+                if use_stream:
                     try:
-                        gen_text = getattr(genai, 'generate_text', None)
-                        if gen_text:
-                            maybe_resp = gen_text(model=MODEL_NAME, input=prompt, max_output_tokens=MAX_TOKENS)
-                            resp2 = await maybe_resp if asyncio.iscoroutine(maybe_resp) else maybe_resp
-                            text = _extract_text_from_response(resp2)
-                    except Exception as e2:
-                        logger.warning("Fallback generate_text failed: %s", repr(e2))
+                        text, latency, answered, complete = await _gemini_stream(request, on_chunk, attempt, deadline)
+                    except Exception:
+                        # retries go through the plain call below
+                        use_stream = False
+                        raise
+                else:
+                    text, answered = await _generate(request, attempt)
 
                 if text:
-                    _circuit_failures = 0
-                    return str(text).strip()
+                    reply = str(text).strip()
+                    api_limiter.record_tokens(estimate_tokens(reply))
+                    if not complete:
+                        # a stalled stream is neither a healthy call nor a full answer: show it, never cache it
+                        _observe_attempt(attempt, "cut_off", attempt_started)
+                        return reply
+                    # a stream's length depends on the answer, not on API health: judge it by its first chunk
+                    api_limiter.on_success(latency if latency is not None else time.monotonic() - attempt_started)
+                    _observe_attempt(attempt, "ok", attempt_started)
+                    response_cache.record_api_latency(time.monotonic() - started)
+                    # the key names the primary tier; a lower tier's answer must not be served in its place
+                    if cache_key and answered == MODEL_TIERS[0].model:
+                        response_cache.put(cache_key, reply)
+                    return reply
 
                 last_exc = Exception('Empty response')
                 logger.warning('Gemini returned empty response on attempt %d', attempt)
+                _observe_attempt(attempt, "empty", attempt_started)
 
             except Exception as e:
                 last_exc = e
-                _circuit_failures += 1
-                logger.warning('Gemini fail %s (attempt %d): %s', MODEL_NAME, attempt, repr(e))
+                kind = api_limiter.on_failure(e)
+                _observe_attempt(attempt, kind, attempt_started)
+                logger.warning('Gemini fail %s (attempt %d, %s): %s', MODEL_NAME, attempt, kind, repr(e))
 
             # failure handling
-            if _circuit_failures >= CIRCUIT_FAIL_THRESHOLD:
-                _circuit_open = True
-                _circuit_open_until = time.time() + CIRCUIT_OPEN_SECONDS
-                logger.error('Circuit opened for %s seconds', CIRCUIT_OPEN_SECONDS)
-                return await _local_persona_fallback(system_text, user_text)
+            if api_limiter.circuit_open:
+                return await _local_persona_fallback(system_text, user_text, "circuit_open")
 
             if attempt == MAX_RETRIES:
                 logger.error('Gemini final fail: %s', repr(last_exc))
-                return await _local_persona_fallback(system_text, user_text)
+                return await _local_persona_fallback(system_text, user_text, "retries_exhausted")
 
             # exponential backoff with jitter
             backoff = min(1.0 * (2 ** (attempt - 1)), 10)
             jitter = random.uniform(0, 0.5)
+            if time.monotonic() + backoff + jitter > deadline:
+                logger.info('Deadline reached after attempt %d — not retrying', attempt)
+                return await _local_persona_fallback(system_text, user_text, "deadline")
+            RETRIES.inc()
             await asyncio.sleep(backoff + jitter)
+    finally:
+        api_scheduler.release()
 
     return await _local_persona_fallback(system_text, user_text)
 
+# ---------------------------
+# Rolling channel summaries — turns older than the history window are
+# compacted off the critical path and stored in SQLite
+# ---------------------------
+SUMMARY_PROMPT = (
+    "Tóm tắt ngắn gọn cuộc hội thoại dưới đây thành vài gạch đầu dòng, "
+    "giữ lại câu hỏi của người chơi, thông tin game đã nêu và kết luận. "
+    "Không quá {limit} ký tự, không thêm lời dẫn.\n"
+    "-- Tóm tắt cũ --\n{old}\n-- Hội thoại mới --\n{turns}"
+)
+SUMMARY_BATCH_ROWS = 100
+
+class ChannelSummaries:
+    def __init__(self, max_channels: int):
+        self.max_channels = max(1, max_channels)
+        self._cache: "OrderedDict[int, str]" = OrderedDict()
+        self._since_check: "OrderedDict[int, int]" = OrderedDict()
+        self._running: Dict[int, asyncio.Task] = {}  # keeps the task referenced
+
+    async def get(self, channel_id: int) -> str:
+        if channel_id in self._cache:
+            self._cache.move_to_end(channel_id)
+            return self._cache[channel_id]
+        rows = await db_all("SELECT summary FROM channel_summaries WHERE channel_id = ?", (channel_id,))
+        summary = rows[0][0] if rows else ""
+        self._remember(channel_id, summary)
+        return summary
+
+    def invalidate(self, channel_id: int):
+        self._cache.pop(channel_id, None)
+        chat_db.enqueue("DELETE FROM channel_summaries WHERE channel_id = ?", (channel_id,))
+
+    def schedule(self, channel_id: int):
+        """Called after every saved exchange; checks the DB only every SUMMARY_TRIGGER calls."""
+        seen = self._since_check.pop(channel_id, 0) + 1
+        if seen < SUMMARY_TRIGGER or channel_id in self._running:
+            self._since_check[channel_id] = seen
+            while len(self._since_check) > self.max_channels:
+                self._since_check.popitem(last=False)
+            return
+        task = asyncio.create_task(self._update(channel_id))
+        self._running[channel_id] = task
+        task.add_done_callback(lambda t: self._running.pop(channel_id, None))
+
+    def _remember(self, channel_id: int, summary: str):
+        self._cache[channel_id] = summary
+        self._cache.move_to_end(channel_id)
+        while len(self._cache) > self.max_channels:
+            self._cache.popitem(last=False)
+
+    async def _update(self, channel_id: int):
+        try:
+            rows = await db_all("SELECT summary, last_chat_id FROM channel_summaries WHERE channel_id = ?", (channel_id,))
+            old, last_id = rows[0] if rows else ("", 0)
+            # newest row that has left the history window
+            cutoff = await db_all(
+                "SELECT id FROM chats WHERE channel_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?",
+                (channel_id, HISTORY_MESSAGES)
+            )
+            if not cutoff or cutoff[0][0] <= (last_id or 0):
+                return
+            turns = await db_all(
+                "SELECT id, role, persona, content FROM chats WHERE channel_id = ? AND id > ? AND id <= ? ORDER BY id LIMIT ?",
+                (channel_id, last_id or 0, cutoff[0][0], SUMMARY_BATCH_ROWS)
+            )
+            if len(turns) < SUMMARY_TRIGGER:
+                return
+            summary = await self._summarize(channel_id, old or "", turns)
+            ts = datetime.datetime.utcnow().isoformat()
+            chat_db.enqueue(
+                "INSERT OR REPLACE INTO channel_summaries (channel_id, summary, last_chat_id, updated_at) VALUES (?, ?, ?, ?)",
+                (channel_id, summary, turns[-1][0], ts)
+            )
+            self._remember(channel_id, summary)
+            logger.info("Channel %s summary updated (%d turns compacted)", channel_id, len(turns))
+        except Exception:
+            logger.exception("Summary update failed for channel %s", channel_id)
+
+    async def _summarize(self, channel_id: int, old: str, turns: List[Tuple]) -> str:
+        lines = []
+        for _, role, persona, content in turns:
+            lines.append(f"[{turn_label(role, persona)}] {clip(content, PROMPT_TURN_MAX_CHARS)}")
+        text = None
+        if await ensure_gemini() and G_MODEL is not None and sessions.caps.async_generate and api_limiter.allow():
+            prompt = SUMMARY_PROMPT.format(limit=SUMMARY_MAX_CHARS, old=old or "(trống)", turns="\n".join(lines))
+            # low priority: queued under user 0 with a long deadline, same quota as replies
+            deadline = time.monotonic() + 300
+            try:
+                async with api_scheduler.slot(0, channel_id, deadline):
+                    if await api_limiter.admit(estimate_tokens(prompt), deadline):
+                        started = time.monotonic()
+                        resp = await G_MODEL.generate_content_async(
+                            contents=[{"role": "user", "parts": [prompt]}],
+                            generation_config={"max_output_tokens": SUMMARY_MAX_CHARS // 3, "temperature": 0.2}
+                        )
+                        text = _extract_text_from_response(resp)
+                        api_limiter.on_success(time.monotonic() - started)
+            except (QueueFull, RequestExpired):
+                pass
+            except Exception as e:
+                api_limiter.on_failure(e)
+                logger.warning("Gemini summary failed, using extractive summary: %s", repr(e))
+        if not text:
+            # extractive fallback: keep what the players asked
+            asked = [clip(c, 160) for _, role, _, c in turns if role == "user"]
+            text = "\n".join(filter(None, [old] + [f"- {q}" for q in asked]))
+            text = text[-SUMMARY_MAX_CHARS:]
+        return clip(str(text).strip(), SUMMARY_MAX_CHARS)
+
+channel_summaries = ChannelSummaries(HISTORY_CACHE_CHANNELS)
+
+# ---------------------------
+# Streaming replies — post on first chunk, then edit in place
+# ---------------------------
+REPLY_CHUNK = 1800
+_SENTENCE_ENDS = ('\n', '. ', '! ', '? ', '… ')
+
+def split_reply(text: str, limit: int = REPLY_CHUNK) -> List[str]:
+    """Split text into pages of at most `limit` chars, preferring sentence boundaries."""
+    pages = []
+    while len(text) > limit:
+        window = text[:limit]
+        cut = max(window.rfind(end) + len(end) for end in _SENTENCE_ENDS)
+        if cut <= limit // 2:
+            cut = window.rfind(' ') + 1
+        if cut <= 0:
+            cut = limit
+        pages.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    pages.append(text)
+    return pages
+
+class StreamingReply:
+    """Keeps a set of Discord messages in sync with a growing reply text."""
+
+    def __init__(self, channel, started: float, interval: float = STREAM_EDIT_INTERVAL):
+        self.channel = channel
+        self.started = started
+        self.interval = interval
+        self.messages: List[Any] = []
+        self.first_visible: Optional[float] = None
+        self._shown: List[str] = []
+        self._text = ""
+        self._last_flush = 0.0
+        self._pending: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    async def update(self, text: str):
+        self._text = text
+        if not self.messages:
+            await self._flush()
+            return
+        if self._pending is not None:
+            return  # a delayed flush will pick up the newest text
+        wait = self.interval - (time.monotonic() - self._last_flush)
+        if wait <= 0:
+            await self._flush()
+        else:
+            self._pending = asyncio.create_task(self._flush_later(wait))
+
+    async def finish(self, text: str):
+        self._text = text
+        if self._pending is not None:
+            self._pending.cancel()
+            self._pending = None
+        await self._flush()
+
+    async def _flush_later(self, wait: float):
+        await asyncio.sleep(wait)
+        self._pending = None
+        await self._flush()
+
+    async def _flush(self):
+        async with self._lock:
+            self._last_flush = time.monotonic()
+            pages = [p for p in split_reply(self._text) if p]
+            for i, page in enumerate(pages):
+                if i < len(self.messages):
+                    if self._shown[i] != page:
+                        await self.messages[i].edit(content=page)
+                        self._shown[i] = page
+                    continue
+                sent = await self.channel.send(page)
+                if self.first_visible is None:
+                    self.first_visible = time.monotonic()
+                    logger.info("Streaming: first visible text after %.2fs", self.first_visible - self.started)
+                    FIRST_VISIBLE_SECONDS.observe(self.first_visible - self.started)
+                self.messages.append(sent)
+                self._shown.append(page)
+                try:
+                    await sent.add_reaction('🗑️')
+                except Exception:
+                    pass
+            # final text can be shorter than what was streamed (e.g. fallback after a broken stream)
+            while len(self.messages) > max(len(pages), 1):
+                extra = self.messages.pop()
+                self._shown.pop()
+                try:
+                    await extra.delete()
+                except Exception:
+                    pass
+
+# ---------------------------
+# Health / readiness (keep_alive.HealthServer, on the bot's own loop)
+# ---------------------------
+def _db_writable(conn: sqlite3.Connection) -> str:
+    # takes the write lock without writing anything
+    conn.execute("BEGIN IMMEDIATE")
+    conn.rollback()
+    return "ok"
+
+async def health_checks():
+    lag = EVENT_LOOP_LAG.labels().value
+    return {
+        "gateway": (bot.is_ready() and not bot.is_closed(),
+                    {"latency": None if bot.latency != bot.latency else round(bot.latency, 3)}),
+        "event_loop_lag": (lag <= HEALTH_MAX_LOOP_LAG, round(lag, 3)),
+        "db": await timed_check(chat_db.call(_db_writable), HEALTH_DB_TIMEOUT),
+    }
+
+async def ready_checks():
+    saturated = api_scheduler.depth >= max(1, int(api_scheduler.max_queue * READY_QUEUE_SATURATION))
+    return {
+        "gateway": (bot.is_ready() and not bot.is_closed(), None),
+        "db": (DB_READY, "migrated" if DB_READY else "migrating"),
+        "circuit": (not api_limiter.circuit_open, "open" if api_limiter.circuit_open else "closed"),
+        "queue": (not saturated, {"depth": api_scheduler.depth, "max": api_scheduler.max_queue}),
+    }
+
 # ---------------------------
 # Discord Bot
 # ---------------------------
 intents = discord.Intents.default()
 intents.message_content = True
 intents.reactions = True
-bot = commands.Bot(command_prefix="!", intents=intents)
+
+# AutoShardedBot when SHARD_COUNT is set; a worker only runs the shards it was given
+_BotBase = commands.AutoShardedBot if SHARD_COUNT else commands.Bot
+
+class EkkoBot(_BotBase):
+    # not "http": discord.Client.http is the REST/gateway client
+    health_server: Optional[HealthServer] = None
+
+    def _background(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._tasks.append(task)
+        return task
+
+    async def setup_hook(self):
+        self._tasks: List[asyncio.Task] = []
+        # probes answer while migrations run; /readyz reports db=migrating until then
+        self.health_server = HealthServer(HTTP_HOST, HTTP_PORT, health_checks, ready_checks)
+        try:
+            await self.health_server.start()
+        except OSError:
+            logger.exception("Health server could not bind %s:%d", HTTP_HOST, HTTP_PORT)
+        chat_db.start()
+        await init_db()
+        # warm the SDK import while the gateway connects; the first request would do it anyway
+        self._background(ensure_gemini())
+        response_cache.purge_expired()
+        self._background(_knowledge_loop())
+        self._background(_event_loop_lag_monitor())
+        if WORKER_INDEX == 0:
+            # one archiver per DB file
+            self._background(_maintenance_loop())
+        if api_limiter.shared is not None:
+            self._background(_shared_state_loop())
+        if WORKER_INDEX == 0:
+            # setup_hook runs once per process, so gateway reconnects never resync
+            await sync_commands()
+
+    async def close(self):
+        try:
+            if self.health_server is not None:
+                await self.health_server.stop()
+                self.health_server = None
+            await super().close()
+        finally:
+            # background loops go first so none of them touches the DB after it closes
+            tasks = getattr(self, "_tasks", [])
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            tasks.clear()
+            # drain the write-behind queue before the loop goes away
+            await chat_db.aclose()
+            shared_state.close()
+
+_shard_kwargs = {}
+if SHARD_COUNT and SHARD_COUNT != "auto":
+    _shard_kwargs = {"shard_count": int(SHARD_COUNT), "shard_ids": SHARD_IDS}
+bot = EkkoBot(command_prefix="!", intents=intents, **_shard_kwargs)
 app_tree = bot.tree
-_user_persona = {}
 
 @app_tree.command(name="help", description="Hướng dẫn dùng bot Ekko")
 async def slash_help(interaction: discord.Interaction):
@@ -356,14 +1477,14 @@ async def slash_help(interaction: discord.Interaction):
 
 @app_tree.command(name="reset", description="Xóa lịch sử chat")
 async def slash_reset(interaction: discord.Interaction):
-    await db_exec("DELETE FROM chats WHERE user_id = ? AND channel_id = ?", (interaction.user.id, interaction.channel.id))
-    _user_persona.pop(interaction.user.id, None)
+    await reset_user_history(interaction.user.id, interaction.channel.id)
+    user_personas.clear(interaction.user.id)
     await interaction.response.send_message("🍶 Đã quên chuyện cũ.", ephemeral=True)
 
 @app_tree.command(name="set-persona", description="Đổi persona")
 @app_commands.describe(persona_key="Tên persona")
 async def slash_set_persona(interaction: discord.Interaction, persona_key: str):
-    _user_persona[interaction.user.id] = persona_key
+    user_personas.set(interaction.user.id, persona_key)
     await interaction.response.send_message(f"🍶 Tại hạ đã đổi phong cách sang **{persona_key}**.", ephemeral=True)
 
 @app_tree.command(name="history", description="Xem 6 tin nhắn gần nhất")
@@ -374,17 +1495,41 @@ async def slash_history(interaction: discord.Interaction):
     text = "\n".join([f"**{r[0]}**: {r[2]}" for r in rows])
     await interaction.response.send_message(text, ephemeral=True)
 
-@bot.event
-async def on_ready():
+def command_tree_hash() -> str:
+    commands_json = [c.to_dict() for c in sorted(app_tree.get_commands(), key=lambda c: c.name)]
+    return hashlib.sha256(json.dumps(commands_json, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+async def sync_commands():
+    """Sync the slash commands only when their definitions differ from the last successful sync."""
+    if COMMAND_SYNC == "off":
+        return
+    digest = command_tree_hash()
+    key = f"command_tree_hash:{bot.application_id}"
+    if COMMAND_SYNC != "always" and await meta_get(key) == digest:
+        logger.info("Slash commands unchanged — skipping sync")
+        return
     try:
-        await bot.tree.sync()
+        await app_tree.sync()
+        await meta_set(key, digest)
         logger.info("Slash commands synced.")
     except Exception as e:
         logger.exception("Slash sync failed: %s", e)
+
+_first_ready = True
+_first_message = True
+
+@bot.event
+async def on_ready():
+    global _first_ready
+    if _first_ready:
+        _first_ready = False
+        _startup_phase("gateway_ready")
     logger.info(f"Logged in as {bot.user}")
 
 @bot.event
 async def on_message(message: discord.Message):
+    # latency metrics and the request deadline count from here, debounce wait included
+    received = time.monotonic()
     if message.author == bot.user:
         return
     channel_name = getattr(message.channel, 'name', None)
@@ -398,27 +1543,57 @@ async def on_message(message: discord.Message):
         await message.channel.send("Dùng `/help` để xem hướng dẫn.")
         return
     if lower.startswith("!reset"):
-        await db_exec("DELETE FROM chats WHERE user_id = ? AND channel_id = ?", (message.author.id, message.channel.id))
-        _user_persona.pop(message.author.id, None)
+        await reset_user_history(message.author.id, message.channel.id)
+        user_personas.clear(message.author.id)
         await message.channel.send("🍶 Đã quên chuyện cũ.")
         return
 
-    on_cd, remain = is_on_cooldown(message.author.id)
+    user_text = message.content.strip() if message.content else ""
+    key = (message.author.id, message.channel.id)
+    if user_text and debouncer.join(key, user_text):
+        # the first fragment's handler answers for the whole batch
+        persona_key = await user_personas.get(message.author.id)
+        await save_chat(message.author.id, message.channel.id, 'user', persona_key, user_text)
+        return
+
+    on_cd, remain = await is_on_cooldown(message.author.id)
     if on_cd:
         await message.reply(f"🍶 Đại hiệp khoan vội! Chờ {int(remain)+1}s để tại hạ điều tức.")
         return
 
-    user_text = message.content.strip() if message.content else ""
     if not user_text:
         return
 
-    persona_key = _user_persona.get(message.author.id, PERSONA_NAME)
+    if debouncer.enabled:
+        debouncer.open(key, user_text)
+    persona_key = await user_personas.get(message.author.id)
     await save_chat(message.author.id, message.channel.id, 'user', persona_key, user_text)
-    set_cooldown(message.author.id)
+    await set_cooldown(message.author.id)
+
+    with metrics.tracer.trace("on_message", channel_id=message.channel.id, user_id=message.author.id):
+        with metrics.stage("total"):
+            parts = [user_text]
+            if debouncer.enabled:
+                with metrics.stage("debounce"):
+                    parts = await debouncer.collect(key)
+            await answer_message(message, parts, persona_key, received)
+
+async def answer_message(message: discord.Message, parts: List[str], persona_key: str, received: float):
+    """Reply to the user's fragments (already saved as chat rows) in the message's channel.
+    received is the time.monotonic() at which on_message got the message."""
+    global _first_message
+    user_text = "\n".join(parts)
+    stream = StreamingReply(message.channel, received) if STREAM_REPLIES else None
+
+    async def _on_chunk(partial: str):
+        await stream.update(f"Tại hạ nói: {partial}")
 
     async with message.channel.typing():
         try:
-            reply = await gemini_text_reply(PERSONA_SYSTEM, user_text, message.channel.id)
+            reply = await gemini_text_reply(PERSONA_SYSTEM, user_text, message.channel.id, persona_key,
+                                            on_chunk=_on_chunk if stream is not None else None,
+                                            user_id=message.author.id,
+                                            deadline=received + REQUEST_DEADLINE_SECONDS, own_rows=parts)
             if not reply.startswith('🍶'):
                 # keep persona prefix
                 reply = f"Tại hạ nói: {reply}"
@@ -427,49 +1602,124 @@ async def on_message(message: discord.Message):
             reply = "⚠️ Lỗi không xác định."
 
     # send reply, split if too long
-    if len(reply) > 2000:
-        for i in range(0, len(reply), 1800):
-            part = reply[i:i+1800]
-            sent = await message.channel.send(part)
+    sent_ids: List[int] = []
+    with metrics.stage("discord_send"):
+        if stream is not None and stream.messages:
+            try:
+                await stream.finish(reply)
+            except Exception:
+                logger.exception("Streaming finish failed")
+            sent_ids = [m.id for m in stream.messages]
+        elif len(reply) > 2000:
+            for i in range(0, len(reply), 1800):
+                part = reply[i:i+1800]
+                sent = await message.channel.send(part)
+                if not sent_ids:
+                    FIRST_VISIBLE_SECONDS.observe(time.monotonic() - received)
+                sent_ids.append(sent.id)
+                try:
+                    await sent.add_reaction('🗑️')
+                except Exception:
+                    pass
+        else:
+            sent = await message.channel.send(reply)
+            sent_ids.append(sent.id)
+            FIRST_VISIBLE_SECONDS.observe(time.monotonic() - received)
+            logger.info("First visible text after %.2fs", time.monotonic() - received)
             try:
                 await sent.add_reaction('🗑️')
             except Exception:
                 pass
-    else:
-        sent = await message.channel.send(reply)
-        try:
-            await sent.add_reaction('🗑️')
-        except Exception:
-            pass
 
-    await save_chat(message.author.id, message.channel.id, 'bot', persona_key, reply)
+    if _first_message:
+        _first_message = False
+        _startup_phase("first_message")
+    reply_owners.record(sent_ids, message.channel.id, message.author.id)
+    await save_chat(message.author.id, message.channel.id, 'bot', persona_key, reply,
+                    message_id=sent_ids[0] if sent_ids else None)
+    if SUMMARY_ENABLED:
+        channel_summaries.schedule(message.channel.id)
 
 @bot.event
 async def on_reaction_add(reaction, user):
     if user.bot:
         return
     msg = reaction.message
-    if msg.author != bot.user or str(reaction.emoji) != '🗑️':
+    if msg.author != bot.user:
+        return
+    emoji = str(reaction.emoji)
+    if emoji not in ('👍', '🗑️'):
+        return
+    owner = await reply_owners.lookup(msg.id)
+    if emoji == '👍':
+        # chats rows carry the first chunk's id
+        await record_vote(owner[0] if owner else msg.id, user.id, True)
         return
 
-    perm = msg.channel.permissions_for(user)
-    if perm.manage_messages:
+    if not msg.channel.permissions_for(user).manage_messages and (owner is None or owner[2] != user.id):
+        return
+    if owner is None:
         await msg.delete()
         return
+    await delete_reply(msg.channel, owner[0])
 
-    rows = await db_all("SELECT user_id FROM chats WHERE channel_id = ? ORDER BY id DESC LIMIT 6", (msg.channel.id,))
-    if user.id in [r[0] for r in rows]:
-        await msg.delete()
+@bot.event
+async def on_reaction_remove(reaction, user):
+    if user.bot or reaction.message.author != bot.user or str(reaction.emoji) != '👍':
+        return
+    owner = await reply_owners.lookup(reaction.message.id)
+    await record_vote(owner[0] if owner else reaction.message.id, user.id, False)
+
+async def record_vote(reply_id: int, user_id: int, up: bool):
+    """rating = distinct 👍 voters other than the asker; rated answers feed the knowledge index."""
+    if up:
+        await db_exec("INSERT OR IGNORE INTO reply_votes (reply_id, user_id) VALUES (?, ?)", (reply_id, user_id))
+    else:
+        await db_exec("DELETE FROM reply_votes WHERE reply_id = ? AND user_id = ?", (reply_id, user_id))
+    await db_exec(
+        "UPDATE chats SET rating = (SELECT COUNT(*) FROM reply_votes v WHERE v.reply_id = chats.message_id"
+        " AND v.user_id != chats.user_id) WHERE message_id = ? AND role = 'bot'", (reply_id,))
+
+async def delete_reply(channel, reply_id: int):
+    """Delete every chunk of a reply: one bulk call, single deletes if the bot can't bulk delete."""
+    ids = await reply_owners.group(reply_id)
+    reply_owners.forget(reply_id)
+    try:
+        await channel.delete_messages([discord.Object(id=mid) for mid in ids])
+        return
+    except (discord.Forbidden, discord.HTTPException, AttributeError):
+        # no manage_messages for the bot, or chunks older than 14 days
+        pass
+    for mid in ids:
+        try:
+            await channel.get_partial_message(mid).delete()
+        except discord.NotFound:
+            pass
+        except Exception:
+            logger.exception("Could not delete reply chunk %s", mid)
 
 # ---------------------------
 # Run
 # ---------------------------
+def _run_supervisor() -> int:
+    count = int(SHARD_COUNT) if SHARD_COUNT.isdigit() else shards.recommended_shards(DISCORD_TOKEN or "")
+    if not count:
+        count = SHARD_WORKERS
+        logger.warning("Shard count unknown, using one shard per worker (%d)", count)
+    env = dict(os.environ)
+    if SHARED_STATE == "local":
+        # workers must share quota, cooldowns and the breaker
+        env["SHARED_STATE"] = "sqlite:" + os.path.splitext(DB_PATH)[0] + "_shared.sqlite"
+        logger.info("Workers share state via %s", env["SHARED_STATE"])
+    # once, before any worker starts; workers then find user_version current
+    migrate_db()
+    return shards.run_supervisor(count, SHARD_WORKERS, env)
+
+_startup_phase("imported")
+
 if __name__ == '__main__':
-    try:
-        from keep_alive import keep_alive
-        keep_alive()
-    except Exception:
-        logger.info('keep_alive not present')
+    if SHARD_WORKERS > 1 and "EKKO_WORKER_INDEX" not in os.environ:
+        sys.exit(_run_supervisor())
 
     if not DISCORD_TOKEN:
         logger.warning('Missing DISCORD_TOKEN')
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+ChatDB — một kết nối SQLite (WAL) sống lâu trên thread riêng.
+Ghi kiểu write-behind: các INSERT được gom lại và commit theo lô;
+đọc đi qua cùng kết nối nên luôn thấy những gì đã ghi trước đó.
+"""
+
+import atexit
+import asyncio
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, List, Optional, Tuple
+
+logger = logging.getLogger("ekko.db")
+
+_STOP = object()
+
+
+class ChatDB:
+    def __init__(self, path: str, flush_interval: float = 0.5, batch_size: int = 50):
+        self.path = path
+        self.flush_interval = max(0.0, flush_interval)
+        self.batch_size = max(1, batch_size)
+        self._ops: "queue.Queue[Any]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._closed = False
+        self._error: Optional[BaseException] = None
+        self._pending = 0
+        # optional hook: on_flush(rows, seconds), called on the DB thread
+        self.on_flush: Optional[Callable[[int, float], None]] = None
+
+    # ---------------------------
+    # lifecycle
+    # ---------------------------
+    def start(self):
+        with self._lock:
+            if self._thread is not None or self._closed:
+                return
+            self._thread = threading.Thread(target=self._run, name="ekko-db", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def close(self):
+        """Drain the write queue, commit and close the connection (blocking)."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            thread = self._thread
+        if thread is None:
+            return
+        self._ops.put(_STOP)
+        thread.join()
+
+    async def aclose(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.close)
+
+    @property
+    def pending_writes(self) -> int:
+        return self._pending
+
+    # ---------------------------
+    # API
+    # ---------------------------
+    def _check(self):
+        # caller holds self._lock
+        if self._error is not None:
+            raise RuntimeError(f"ChatDB failed to open: {self._error}") from self._error
+        if self._closed:
+            raise RuntimeError("ChatDB is closed")
+
+    def enqueue(self, query: str, params=()):
+        """Write-behind: queue a statement, it will be committed with the next batch."""
+        self.start()
+        with self._lock:
+            self._check()
+            self._pending += 1
+            self._ops.put(("write", query, params, None))
+
+    def run(self, fn: Callable[[sqlite3.Connection], Any]) -> Future:
+        """Run fn(conn) on the DB thread after pending writes are flushed."""
+        self.start()
+        fut: Future = Future()
+        with self._lock:
+            self._check()
+            self._ops.put(("call", fn, None, fut))
+        return fut
+
+    async def call(self, fn: Callable[[sqlite3.Connection], Any]):
+        return await asyncio.wrap_future(self.run(fn))
+
+    async def execute(self, query: str, params=()) -> int:
+        def _run(conn: sqlite3.Connection):
+            with conn:
+                return conn.execute(query, params).rowcount
+        return await self.call(_run)
+
+    async def fetchall(self, query: str, params=()) -> List[Tuple]:
+        def _run(conn: sqlite3.Connection):
+            return conn.execute(query, params).fetchall()
+        return await self.call(_run)
+
+    # ---------------------------
+    # DB thread
+    # ---------------------------
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _flush(self, conn: sqlite3.Connection, batch: List[Tuple[str, Any]]):
+        if not batch:
+            return
+        started = time.perf_counter()
+        try:
+            with conn:
+                for query, params in batch:
+                    conn.execute(query, params)
+        except Exception:
+            # one bad row must not drop the whole batch — retry row by row
+            logger.exception("Batch flush failed (%d rows), retrying one by one", len(batch))
+            for query, params in batch:
+                try:
+                    with conn:
+                        conn.execute(query, params)
+                except Exception:
+                    logger.exception("Dropped write: %s", query)
+        finally:
+            with self._lock:
+                self._pending -= len(batch)
+            if self.on_flush is not None:
+                try:
+                    self.on_flush(len(batch), time.perf_counter() - started)
+                except Exception:
+                    logger.exception("on_flush hook failed")
+            batch.clear()
+
+    def _fail(self, exc: BaseException):
+        """The connection could not be opened: fail everything queued and refuse new work."""
+        logger.error("ChatDB could not open %s: %s", self.path, exc)
+        with self._lock:
+            # set under the lock so no enqueue/run can slip in after the drain below
+            self._error = exc
+        dropped = 0
+        while True:
+            try:
+                op = self._ops.get_nowait()
+            except queue.Empty:
+                break
+            if op is _STOP:
+                continue
+            kind, arg, params, fut = op
+            if kind == "write":
+                dropped += 1
+            elif fut.set_running_or_notify_cancel():
+                fut.set_exception(RuntimeError(f"ChatDB failed to open: {exc}"))
+        with self._lock:
+            self._pending -= dropped
+
+    def _run(self):
+        try:
+            conn = self._connect()
+        except Exception as e:
+            self._fail(e)
+            return
+        batch: List[Tuple[str, Any]] = []
+        deadline = 0.0
+        try:
+            while True:
+                timeout = None if not batch else max(0.0, deadline - time.monotonic())
+                try:
+                    op = self._ops.get(timeout=timeout)
+                except queue.Empty:
+                    self._flush(conn, batch)
+                    continue
+                if op is _STOP:
+                    break
+                kind, arg, params, fut = op
+                if kind == "write":
+                    if not batch:
+                        deadline = time.monotonic() + self.flush_interval
+                    batch.append((arg, params))
+                    if len(batch) >= self.batch_size:
+                        self._flush(conn, batch)
+                    continue
+                # reads/calls see every write queued before them
+                self._flush(conn, batch)
+                if not fut.set_running_or_notify_cancel():
+                    continue
+                try:
+                    fut.set_result(arg(conn))
+                except BaseException as e:
+                    fut.set_exception(e)
+        finally:
+            # drain whatever is still queued so shutdown loses nothing
+            while True:
+                try:
+                    op = self._ops.get_nowait()
+                except queue.Empty:
+                    break
+                if op is _STOP:
+                    continue
+                kind, arg, params, fut = op
+                if kind == "write":
+                    batch.append((arg, params))
+                elif fut.set_running_or_notify_cancel():
+                    fut.set_exception(RuntimeError("ChatDB is closed"))
+            self._flush(conn, batch)
+            conn.close()
+            logger.info("ChatDB closed")
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Hedging — gửi thêm một request dự phòng khi request chính chậm hơn phân vị độ trễ đã đo,
+có thể sang model tier rẻ/nhanh hơn; cái nào xong trước thì dùng, cái còn lại bị hủy.
+Số request dự phòng bị giới hạn theo tỉ lệ (HedgeBudget) để không nhân đôi quota.
+"""
+
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger("ekko.hedging")
+
+
+class ModelTier(NamedTuple):
+    model: str
+    timeout: float
+
+
+def parse_tiers(spec: str, default_model: str, default_timeout: float) -> List[ModelTier]:
+    """'model-a:20,model-b:8' -> ordered tiers; a missing timeout uses default_timeout."""
+    tiers = []
+    for part in (spec or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        name, _, timeout = part.partition(":")
+        try:
+            tiers.append(ModelTier(name.strip(), float(timeout) if timeout else default_timeout))
+        except ValueError:
+            logger.warning("Ignoring bad model tier %r (want model:seconds)", part)
+    return tiers or [ModelTier(default_model, default_timeout)]
+
+
+class LatencyTracker:
+    """Sliding window of recent latencies with a percentile lookup."""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self._samples: Deque[float] = deque(maxlen=max(1, window))
+        self.min_samples = min_samples
+
+    def observe(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class HedgeBudget:
+    """Each request earns `ratio` of a hedge, banked up to `burst`; a hedge spends one."""
+
+    def __init__(self, ratio: float, burst: float = 5.0):
+        self.ratio = ratio
+        self.burst = burst
+        self._credit = burst
+
+    def on_request(self):
+        self._credit = min(self.burst, self._credit + self.ratio)
+
+    def try_spend(self) -> bool:
+        if self._credit >= 1.0:
+            self._credit -= 1.0
+            return True
+        return False
+
+    def refund(self):
+        self._credit = min(self.burst, self._credit + 1.0)
+
+
+async def hedged(primary: Callable[[], Awaitable[Any]], backup: Callable[[], Awaitable[Any]],
+                 delay: Optional[float], may_hedge: Callable[[], Awaitable[bool]]) -> Tuple[Any, str]:
+    """Run primary; if it is still running after `delay` and may_hedge() agrees, race backup.
+    Returns (result, "primary" | "backup"). The loser is cancelled; if the first to finish
+    failed, the other one still gets its chance."""
+    first = asyncio.ensure_future(primary())
+    if delay is None:
+        return await first, "primary"
+    tasks = {first: "primary"}
+    try:
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done or not await may_hedge():
+            return await first, "primary"
+        tasks[asyncio.ensure_future(backup())] = "backup"
+        pending = set(tasks)
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result(), tasks[task]
+                error = error or task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
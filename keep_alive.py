@@ -1,21 +1,86 @@
-from flask import Flask
-from threading import Thread
+# -*- coding: utf-8 -*-
+"""
+HealthServer — HTTP nhẹ (aiohttp) chạy ngay trên event loop của bot, thay cho Flask + thread riêng.
+/ (keep-alive), /healthz (gateway, độ trễ event loop, DB ghi được), /readyz (circuit, hàng đợi), /metrics.
+Event loop bị treo thì chính server này cũng không trả lời, nên probe sẽ timeout đúng lúc cần.
+"""
+
+import asyncio
+import json
 import logging
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from aiohttp import web
+
+import metrics
+
+logger = logging.getLogger("ekko.http")
+
+# name -> (ok, detail)
+Checks = Dict[str, Tuple[bool, object]]
+
+
+class HealthServer:
+    def __init__(self, host: str, port: int,
+                 health: Callable[[], Awaitable[Checks]],
+                 ready: Callable[[], Awaitable[Checks]]):
+        self.host = host
+        self.port = port
+        self.health = health
+        self.ready = ready
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/", self._home)
+        app.router.add_get("/healthz", self._healthz)
+        app.router.add_get("/readyz", self._readyz)
+        app.router.add_get("/metrics", self._metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info("Health server listening on %s:%d", self.host, self.port)
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    # ---------------------------
+    # handlers
+    # ---------------------------
+    async def _home(self, request: web.Request) -> web.Response:
+        return web.Response(text="I'm alive!")
+
+    async def _metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render(),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
 
-# Tắt bớt log của Flask để đỡ rối mắt console
-log = logging.getLogger('werkzeug')
-log.setLevel(logging.ERROR)
+    async def _healthz(self, request: web.Request) -> web.Response:
+        return await self._report(self.health)
 
-app = Flask('')
+    async def _readyz(self, request: web.Request) -> web.Response:
+        return await self._report(self.ready)
 
-@app.route('/')
-def home():
-    return "I'm alive!"
+    async def _report(self, fn: Callable[[], Awaitable[Checks]]) -> web.Response:
+        try:
+            checks = await fn()
+        except Exception as e:
+            logger.exception("Health check failed")
+            checks = {"check": (False, repr(e))}
+        ok = all(passed for passed, _ in checks.values())
+        body = {"ok": ok, "checks": {name: {"ok": passed, "detail": detail}
+                                     for name, (passed, detail) in checks.items()}}
+        return web.Response(text=json.dumps(body, ensure_ascii=False, default=str),
+                            status=200 if ok else 503, content_type="application/json")
 
-def run():
-    # Chạy server ở port 8080
-    app.run(host='0.0.0.0', port=8080)
 
-def keep_alive():
-    t = Thread(target=run)
-    t.start()
+async def timed_check(coro: Awaitable, timeout: float) -> Tuple[bool, object]:
+    """Run a probe coroutine; a timeout or exception counts as failed."""
+    try:
+        detail = await asyncio.wait_for(coro, timeout)
+        return True, detail
+    except asyncio.TimeoutError:
+        return False, f"timed out after {timeout}s"
+    except Exception as e:
+        return False, repr(e)
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""
+KnowledgeIndex — chỉ mục BM25 cục bộ cho kiến thức Where Winds Meet.
+Nguồn: file markdown/JSON trong thư mục knowledge/ + câu trả lời được chấm 👍 trong bảng chats.
+Chỉ mục được build sẵn ra đĩa và mmap khi khởi động, tra cứu không cần nạp toàn bộ vào RAM.
+"""
+
+import bisect
+import glob
+import hashlib
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import struct
+import sys
+import unicodedata
+from array import array
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger("ekko.knowledge")
+
+MAGIC = b"EKKOIDX1"
+K1 = 1.2
+B = 0.75
+
+# folded (no diacritics) Vietnamese + English function words
+STOPWORDS = {
+    "la", "cua", "va", "co", "khong", "gi", "nao", "the", "nhu", "o", "dau", "toi", "minh",
+    "ban", "thi", "ma", "de", "cho", "voi", "nhung", "cac", "mot", "nay", "do", "duoc", "lam",
+    "sao", "ah", "a", "vay", "oi", "nhe", "di", "roi", "ra", "vao", "trong", "khi", "neu",
+    "hiep", "huu",
+    "is", "are", "an", "of", "to", "in", "how", "what", "where", "i",
+}
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+# a section containing this line is only used as context / fallback, never as a direct answer
+_NO_DIRECT_RE = re.compile(r"^\s*<!--\s*direct:\s*false\s*-->\s*$", re.IGNORECASE)
+
+
+def fold(text: str) -> str:
+    """Lowercase and strip Vietnamese diacritics ('Khinh Công' -> 'khinh cong')."""
+    text = (text or "").lower().replace("đ", "d")
+    text = unicodedata.normalize("NFD", text)
+    return "".join(ch for ch in text if unicodedata.category(ch) != "Mn")
+
+
+def tokenize(text: str) -> List[str]:
+    """Folded syllables plus adjacent-syllable bigrams (Vietnamese words are mostly 2 syllables)."""
+    words = [w for w in _TOKEN_RE.findall(fold(text)) if w not in STOPWORDS]
+    return words + [f"{a}_{b}" for a, b in zip(words, words[1:])]
+
+
+# ---------------------------
+# Corpus
+# ---------------------------
+def _section(title: str, lines: List[str], path: str) -> Optional[Dict[str, Any]]:
+    body = [line for line in lines if not _NO_DIRECT_RE.match(line)]
+    if not title or not "".join(body).strip():
+        return None
+    doc: Dict[str, Any] = {"title": title, "text": "\n".join(body).strip(), "source": path}
+    if len(body) != len(lines):
+        doc["direct"] = False
+    return doc
+
+
+def load_corpus(directory: str) -> List[Dict[str, Any]]:
+    """Markdown files are split on headings; JSON files hold a list of {title, text} entries.
+    A '<!-- direct: false -->' line (JSON: "direct": false) keeps a doc out of direct answers.
+    Files whose name starts with '_' are ignored."""
+    docs = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.md"))):
+        if os.path.basename(path).startswith("_"):
+            continue
+        with open(path, encoding="utf-8") as f:
+            title, lines = None, []
+            for line in f.read().splitlines():
+                if line.startswith("#"):
+                    doc = _section(title, lines, path)
+                    if doc:
+                        docs.append(doc)
+                    title, lines = line.lstrip("#").strip(), []
+                else:
+                    lines.append(line)
+            doc = _section(title, lines, path)
+            if doc:
+                docs.append(doc)
+    for path in sorted(glob.glob(os.path.join(directory, "*.json"))):
+        if os.path.basename(path).startswith("_"):
+            continue
+        with open(path, encoding="utf-8") as f:
+            for entry in json.load(f):
+                text = entry.get("text") or entry.get("answer")
+                title = entry.get("title") or entry.get("question") or ""
+                if text:
+                    doc = {"title": title, "text": text, "source": path}
+                    if entry.get("direct") is False:
+                        doc["direct"] = False
+                    docs.append(doc)
+    return docs
+
+
+def corpus_signature(directory: str, extra: str = "") -> str:
+    h = hashlib.sha1(extra.encode("utf-8"))
+    for path in sorted(glob.glob(os.path.join(directory, "*.md")) + glob.glob(os.path.join(directory, "*.json"))):
+        st = os.stat(path)
+        h.update(f"{path}:{st.st_size}:{int(st.st_mtime)}".encode("utf-8"))
+    return h.hexdigest()
+
+
+# ---------------------------
+# On-disk index
+# layout: MAGIC | u32 header_len | JSON header | sections (4-byte aligned)
+#   terms      sorted utf-8 terms, term_offsets u32[n_terms+1]
+#   idf        f32[n_terms]
+#   post_start u32[n_terms+1] into post_docs / post_weights
+#   post_docs  u32[n_postings], post_weights f32[n_postings] (precomputed BM25 term weight)
+#   docs       JSON per doc, doc_offsets u32[n_docs+1]
+# ---------------------------
+def _pad(buf: bytearray):
+    buf.extend(b"\0" * (-len(buf) % 4))
+
+
+def build_index(docs: List[Dict[str, str]], path: str, signature: str = ""):
+    tfs = []
+    for doc in docs:
+        # titles count twice: they are what people ask about
+        tfs.append(Counter(tokenize(doc.get("title", "")) * 2 + tokenize(doc["text"])))
+    n = len(docs)
+    avgdl = (sum(sum(tf.values()) for tf in tfs) / n) if n else 1.0
+    postings: Dict[str, List[Tuple[int, float]]] = defaultdict(list)
+    for doc_id, tf in enumerate(tfs):
+        dl = sum(tf.values())
+        for term, freq in tf.items():
+            postings[term].append((doc_id, freq * (K1 + 1) / (freq + K1 * (1 - B + B * dl / avgdl))))
+
+    terms = sorted(postings, key=lambda t: t.encode("utf-8"))
+    term_blob = bytearray()
+    term_offsets = array("I", [0])
+    idf = array("f")
+    post_start = array("I", [0])
+    post_docs = array("I")
+    post_weights = array("f")
+    for term in terms:
+        term_blob.extend(term.encode("utf-8"))
+        term_offsets.append(len(term_blob))
+        plist = postings[term]
+        w_idf = math.log(1 + (n - len(plist) + 0.5) / (len(plist) + 0.5))
+        idf.append(w_idf)
+        for doc_id, w in plist:
+            post_docs.append(doc_id)
+            post_weights.append(w * w_idf)
+        post_start.append(len(post_docs))
+    doc_blob = bytearray()
+    doc_offsets = array("I", [0])
+    for doc in docs:
+        doc_blob.extend(json.dumps(doc, ensure_ascii=False).encode("utf-8"))
+        doc_offsets.append(len(doc_blob))
+
+    body = bytearray()
+    sections = {}
+    for name, data in (("terms", term_blob), ("term_offsets", term_offsets), ("idf", idf),
+                       ("post_start", post_start), ("post_docs", post_docs),
+                       ("post_weights", post_weights), ("docs", doc_blob), ("doc_offsets", doc_offsets)):
+        raw = data.tobytes() if isinstance(data, array) else bytes(data)
+        sections[name] = [len(body), len(raw)]
+        body.extend(raw)
+        _pad(body)
+    header = json.dumps({
+        "n_docs": n, "n_terms": len(terms), "signature": signature,
+        "byteorder": sys.byteorder, "sections": sections,
+    }).encode("utf-8")
+    header += b" " * (-(len(MAGIC) + 4 + len(header)) % 4)
+
+    # per-process temp name: several workers may rebuild at once
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<I", len(header)))
+        f.write(header)
+        f.write(body)
+    os.replace(tmp, path)
+    logger.info("Knowledge index built: %d docs, %d terms -> %s", n, len(terms), path)
+
+
+class Hit(NamedTuple):
+    score: float
+    confidence: float  # idf-weighted share of the query terms the doc contains
+    doc: Dict[str, Any]
+    matched: int       # distinct query words (no stopwords, no bigrams) found in the doc
+
+
+class KnowledgeIndex:
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a knowledge index")
+        (hlen,) = struct.unpack_from("<I", self._mm, len(MAGIC))
+        start = len(MAGIC) + 4
+        self.header = json.loads(self._mm[start:start + hlen].decode("utf-8"))
+        if self.header.get("byteorder") != sys.byteorder:
+            self.close()
+            raise ValueError(f"{path} was built on a different byte order")
+        self._base = start + hlen
+        self.n_docs = self.header["n_docs"]
+        self.n_terms = self.header["n_terms"]
+        self.signature = self.header.get("signature", "")
+        mv = memoryview(self._mm)
+        self._views = [mv]
+        self._terms = self._section(mv, "terms")
+        self._term_offsets = self._section(mv, "term_offsets", "I")
+        self._idf = self._section(mv, "idf", "f")
+        self._post_start = self._section(mv, "post_start", "I")
+        self._post_docs = self._section(mv, "post_docs", "I")
+        self._post_weights = self._section(mv, "post_weights", "f")
+        self._docs = self._section(mv, "docs")
+        self._doc_offsets = self._section(mv, "doc_offsets", "I")
+        self._max_idf = math.log(1 + (self.n_docs + 0.5) / 0.5) if self.n_docs else 1.0
+
+    def _section(self, mv: memoryview, name: str, fmt: Optional[str] = None) -> memoryview:
+        off, length = self.header["sections"][name]
+        view = mv[self._base + off:self._base + off + length]
+        if fmt:
+            view = view.cast(fmt)
+        self._views.append(view)
+        return view
+
+    def close(self):
+        # memoryviews must be released before the mmap can close
+        for view in reversed(getattr(self, "_views", [])):
+            view.release()
+        self._views = []
+        if getattr(self, "_mm", None) is not None:
+            self._mm.close()
+            self._mm = None
+        self._file.close()
+
+    # ---------------------------
+    # lookup
+    # ---------------------------
+    def _term(self, i: int) -> bytes:
+        return bytes(self._terms[self._term_offsets[i]:self._term_offsets[i + 1]])
+
+    def _find(self, term: str) -> int:
+        key = term.encode("utf-8")
+        lo = bisect.bisect_left(_TermSeq(self), key)
+        return lo if lo < self.n_terms and self._term(lo) == key else -1
+
+    def doc(self, doc_id: int) -> Dict[str, str]:
+        raw = bytes(self._docs[self._doc_offsets[doc_id]:self._doc_offsets[doc_id + 1]])
+        return json.loads(raw.decode("utf-8"))
+
+    def search(self, query: str, k: int = 3) -> List[Hit]:
+        """Top k docs by BM25. Short queries reach full confidence easily; callers answering
+        without the model should also look at hit.matched."""
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms or not self.n_docs:
+            return []
+        scores: Dict[int, float] = defaultdict(float)
+        matched: Dict[int, float] = defaultdict(float)
+        words: Dict[int, int] = defaultdict(int)
+        total_idf = 0.0
+        for term in terms:
+            i = self._find(term)
+            if i < 0:
+                total_idf += self._max_idf
+                continue
+            w_idf = self._idf[i]
+            total_idf += w_idf
+            for p in range(self._post_start[i], self._post_start[i + 1]):
+                d = self._post_docs[p]
+                scores[d] += self._post_weights[p]
+                matched[d] += w_idf
+                if "_" not in term:
+                    words[d] += 1
+        top = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)[:k]
+        return [Hit(score, matched[d] / total_idf if total_idf else 0.0, self.doc(d), words[d]) for d, score in top]
+
+
+class _TermSeq:
+    """Sequence view over the sorted term table so bisect can search the mmap directly."""
+
+    def __init__(self, index: KnowledgeIndex):
+        self.index = index
+
+    def __len__(self):
+        return self.index.n_terms
+
+    def __getitem__(self, i: int) -> bytes:
+        return self.index._term(i)
+
+
+def open_or_build(path: str, docs_fn, signature: str) -> Optional[KnowledgeIndex]:
+    """Open the index at path, rebuilding it first when the corpus signature changed."""
+    try:
+        index = KnowledgeIndex(path)
+        if index.signature == signature:
+            return index
+        index.close()
+    except (OSError, ValueError, KeyError):
+        pass
+    docs = docs_fn()
+    if not docs:
+        return None
+    build_index(docs, path, signature)
+    return KnowledgeIndex(path)
+
+
+def snippet(text: str, limit: int) -> str:
+    """Leading whole sentences of text, at most limit chars."""
+    out = ""
+    for sentence in re.split(r"(?<=[.!?\n])\s+", text.strip()):
+        if out and len(out) + len(sentence) + 1 > limit:
+            break
+        out = f"{out} {sentence}".strip()
+    return out if len(out) <= limit else out[:limit].rstrip() + "…"
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+GeminiLimiter — gom concurrency thích ứng (AIMD), token bucket RPM/TPM
+và circuit breaker vào một object, thay cho các biến global _circuit_*.
+Khi có shared backend, quota RPM/TPM và trạng thái circuit được chia sẻ giữa các worker;
+concurrency (AIMD) vẫn tính riêng từng worker.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Callable, Dict, List, Optional, Set
+
+from shared_state import Bucket, StateBackend
+
+logger = logging.getLogger("ekko.limiter")
+
+
+def estimate_tokens(text: str) -> int:
+    # ~3 chars per token is a safe upper-side guess for Vietnamese + English mixes
+    return max(1, len(text or "") // 3)
+
+
+def classify_error(exc: BaseException) -> str:
+    """'throttled' (429 / quota), 'server' (5xx, timeouts) or 'other'."""
+    code = getattr(exc, "code", None)
+    if callable(code):
+        try:
+            code = code()
+        except Exception:
+            code = None
+    code = getattr(code, "value", code)
+    if isinstance(code, tuple):  # grpc StatusCode.value is (int, str)
+        code = code[0]
+    name = type(exc).__name__
+    msg = str(exc)
+    if code == 429 or name in ("ResourceExhausted", "TooManyRequests") or "429" in msg or "quota" in msg.lower():
+        return "throttled"
+    if (isinstance(code, int) and code >= 500) or name in (
+            "ServiceUnavailable", "InternalServerError", "DeadlineExceeded", "TimeoutError"):
+        return "server"
+    if isinstance(exc, asyncio.TimeoutError):
+        return "server"
+    return "other"
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity if capacity is not None else per_minute
+        self.tokens = self.capacity
+        self._stamp = time.monotonic()
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def wait_time(self, n: float) -> float:
+        """Seconds until n tokens are available (0 = now)."""
+        if not self.enabled:
+            return 0.0
+        self._refill()
+        n = min(n, self.capacity)
+        return 0.0 if self.tokens >= n else (n - self.tokens) / self.rate
+
+    def take(self, n: float):
+        if self.enabled:
+            self._refill()
+            self.tokens -= min(n, self.capacity)
+
+    def drain(self):
+        if self.enabled:
+            self._refill()
+            self.tokens = min(self.tokens, 0.0)
+
+
+class GeminiLimiter:
+    def __init__(self, initial: int, min_limit: int = 1, max_limit: int = 8,
+                 rpm: float = 0, tpm: float = 0,
+                 fail_threshold: int = 5, open_seconds: float = 30,
+                 latency_target: float = 8.0,
+                 on_limit_change: Optional[Callable[[int], None]] = None,
+                 shared: Optional[StateBackend] = None):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self._limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self.rpm = TokenBucket(rpm)
+        self.tpm = TokenBucket(tpm)
+        self.fail_threshold = fail_threshold
+        self.open_seconds = open_seconds
+        self.latency_target = latency_target
+        self.on_limit_change = on_limit_change
+        # cross-process quota + breaker; None keeps everything in this process
+        self.shared = shared
+        self._tasks: Set[asyncio.Task] = set()
+        self.failures = 0  # consecutive
+        self.open_until = 0.0
+        # metrics
+        self.successes = 0
+        self.throttled = 0
+        self.server_errors = 0
+        self.circuit_opens = 0
+        self.avg_latency = 0.0
+
+    # ---------------------------
+    # concurrency (AIMD)
+    # ---------------------------
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def _set_limit(self, value: float):
+        before = self.limit
+        self._limit = min(max(value, self.min_limit), self.max_limit)
+        if self.limit != before:
+            logger.info("Gemini concurrency limit %d -> %d", before, self.limit)
+            if self.on_limit_change is not None:
+                self.on_limit_change(self.limit)
+
+    # ---------------------------
+    # circuit breaker
+    # ---------------------------
+    @property
+    def circuit_open(self) -> bool:
+        return time.monotonic() < self.open_until
+
+    def allow(self) -> bool:
+        if self.circuit_open:
+            return False
+        if self.open_until:
+            # half-open: let traffic through, one more failure re-opens
+            self.open_until = 0.0
+            self.failures = max(0, self.fail_threshold - 1)
+        return True
+
+    def _open(self):
+        self.open_until = time.monotonic() + self.open_seconds
+        self.circuit_opens += 1
+        logger.error("Circuit opened for %s seconds", self.open_seconds)
+        if self.shared is not None:
+            self._background(self.shared.put("gemini:circuit_open_until", time.time() + self.open_seconds,
+                                             self.open_seconds))
+
+    async def sync_shared(self):
+        """Adopt a circuit opened by another worker."""
+        if self.shared is None:
+            return
+        until = await self.shared.get("gemini:circuit_open_until")
+        remaining = (until or 0.0) - time.time()
+        if remaining > 0 and time.monotonic() + remaining > self.open_until + 0.5:
+            self.open_until = time.monotonic() + remaining
+            logger.warning("Circuit opened by another worker for %.0f more seconds", remaining)
+
+    # ---------------------------
+    # rate limits
+    # ---------------------------
+    async def admit(self, tokens: int, deadline: float) -> bool:
+        """Wait for one request + `tokens` of quota; False if that would pass the deadline."""
+        while True:
+            if self.shared is not None:
+                wait = await self.shared.acquire(self._shared_buckets(1, tokens))
+                if wait <= 0:
+                    return True
+            else:
+                wait = max(self.rpm.wait_time(1), self.tpm.wait_time(tokens))
+                if wait <= 0:
+                    self.rpm.take(1)
+                    self.tpm.take(tokens)
+                    return True
+            if time.monotonic() + wait > deadline:
+                return False
+            await asyncio.sleep(wait)
+
+    def record_tokens(self, extra: int):
+        """Charge tokens only known after the call (the model's output)."""
+        if self.shared is not None:
+            self._background(self.shared.charge(self._shared_buckets(0, extra)[1:]))
+        else:
+            self.tpm.take(extra)
+
+    def _shared_buckets(self, requests: int, tokens: int) -> List[Bucket]:
+        return [Bucket("gemini:rpm", self.rpm.rate, self.rpm.capacity, requests),
+                Bucket("gemini:tpm", self.tpm.rate, self.tpm.capacity, tokens)]
+
+    def _background(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+
+    def _task_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Shared limiter update failed: %r", task.exception())
+
+    # ---------------------------
+    # feedback
+    # ---------------------------
+    def on_success(self, latency: float):
+        self.successes += 1
+        self.failures = 0
+        self.avg_latency = latency if not self.avg_latency else 0.8 * self.avg_latency + 0.2 * latency
+        if latency > self.latency_target:
+            self._set_limit(self._limit * 0.9)
+        else:
+            self._set_limit(self._limit + 1.0 / max(self._limit, 1.0))
+
+    def on_failure(self, exc: BaseException) -> str:
+        kind = classify_error(exc)
+        self.failures += 1
+        if kind == "throttled":
+            self.throttled += 1
+            if self.shared is not None:
+                self._background(self.shared.drain(self._shared_buckets(1, 0)[:1]))
+            else:
+                self.rpm.drain()
+            self._set_limit(self._limit / 2)
+        elif kind == "server":
+            self.server_errors += 1
+            self._set_limit(self._limit * 0.75)
+        if self.failures >= self.fail_threshold and not self.circuit_open:
+            self._open()
+        return kind
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "limit": self.limit,
+            "circuit_open": int(self.circuit_open),
+            "consecutive_failures": self.failures,
+            "successes": self.successes,
+            "throttled": self.throttled,
+            "server_errors": self.server_errors,
+            "circuit_opens": self.circuit_opens,
+            "avg_latency_seconds": self.avg_latency,
+            "rpm_tokens": self.rpm.tokens if self.rpm.enabled and self.shared is None else -1,
+            "tpm_tokens": self.tpm.tokens if self.tpm.enabled and self.shared is None else -1,
+        }
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+Metrics — registry Prometheus tối giản (counter / gauge / histogram) + trace span JSONL có lấy mẫu.
+Không phụ thuộc thư viện ngoài; render() trả về text exposition format cho /metrics.
+"""
+
+import contextvars
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger("ekko.metrics")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _fmt_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt_value(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, doc: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def labels(self, *values):
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _default(self):
+        return self.labels()
+
+    def collect(self) -> Iterable[str]:
+        raise NotImplementedError
+
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1.0):
+        self._default().inc(amount)
+
+    def collect(self):
+        for key, child in list(self._children.items()):
+            yield f"{self.name}{_fmt_labels(self.labelnames, key)} {_fmt_value(child.value)}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float):
+        self._default().set(value)
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        super().__init__(name, doc, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self._default().observe(value)
+
+    def totals(self, *values) -> Tuple[int, float]:
+        """(count, sum) for one label set without creating it."""
+        child = self._children.get(tuple(str(v) for v in values))
+        return (child.count, child.sum) if child is not None else (0, 0.0)
+
+    def collect(self):
+        for key, child in list(self._children.items()):
+            running = 0
+            for bound, n in zip(child.buckets, list(child.counts)):
+                running += n
+                le = f'le="{_fmt_value(bound)}"'
+                yield f"{self.name}_bucket{_fmt_labels(self.labelnames, key, le)} {running}"
+            yield f"{self.name}_sum{_fmt_labels(self.labelnames, key)} {_fmt_value(child.sum)}"
+            yield f"{self.name}_count{_fmt_labels(self.labelnames, key)} {child.count}"
+
+
+class CallbackMetric(_Metric):
+    """Values read at scrape time from fn() -> {label_value_tuple: value}; for stats() owned elsewhere."""
+
+    def __init__(self, name: str, doc: str, kind: str, fn: Callable[[], Dict[Tuple[str, ...], float]],
+                 labelnames: Sequence[str] = ()):
+        self.kind = kind
+        self.fn = fn
+        super().__init__(name, doc, labelnames)
+
+    def collect(self):
+        try:
+            values = self.fn()
+        except Exception:
+            logger.exception("Metric callback %s failed", self.name)
+            return
+        for key, value in values.items():
+            yield f"{self.name}{_fmt_labels(self.labelnames, key)} {_fmt_value(value)}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric):
+        self._metrics.append(metric)
+
+    def render(self) -> str:
+        lines = []
+        for m in list(self._metrics):
+            lines.append(f"# HELP {m.name} {m.doc}")
+            lines.append(f"# TYPE {m.name} {m.kind}")
+            lines.extend(m.collect())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def render() -> str:
+    return REGISTRY.render()
+
+
+# ---------------------------
+# Tracing — one JSONL line per sampled trace, spans as a list
+# ---------------------------
+_current_trace: "contextvars.ContextVar[Optional[dict]]" = contextvars.ContextVar("ekko_trace", default=None)
+
+
+class Tracer:
+    def __init__(self, path: str = "", sample_rate: float = 0.0):
+        self.path = path
+        self.sample_rate = sample_rate
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path) and self.sample_rate > 0
+
+    @contextmanager
+    def trace(self, name: str, **attrs):
+        """Root span; sampled traces collect every stage() under it."""
+        if not self.enabled or random.random() >= self.sample_rate:
+            yield None
+            return
+        trace = {"trace_id": uuid.uuid4().hex, "name": name, "start": time.time(), "attrs": attrs, "spans": []}
+        token = _current_trace.set(trace)
+        started = time.perf_counter()
+        try:
+            yield trace
+        finally:
+            trace["duration"] = time.perf_counter() - started
+            _current_trace.reset(token)
+            self._write(trace)
+
+    def _write(self, trace: dict):
+        line = json.dumps(trace, ensure_ascii=False, default=str)
+        try:
+            with self._lock, open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except OSError:
+            logger.exception("Could not write trace to %s", self.path)
+
+
+tracer = Tracer(os.getenv("TRACE_PATH", ""), float(os.getenv("TRACE_SAMPLE_RATE", "0")))
+
+STAGE_SECONDS = Histogram("ekko_stage_seconds", "Latency of each on_message stage", ["stage"])
+
+
+def add_span(name: str, start: float, duration: float, **attrs):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace["spans"].append({"name": name, "start": start, "duration": duration, **attrs})
+
+
+@contextmanager
+def stage(name: str, **attrs):
+    """Time a stage into ekko_stage_seconds and, when sampled, the current trace."""
+    wall = time.time()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - started
+        STAGE_SECONDS.labels(name).observe(duration)
+        add_span(name, wall, duration, **attrs)
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+ResponseCache — cache LRU + TTL cho câu trả lời Gemini, có tầng SQLite tùy chọn.
+Key = câu hỏi đã chuẩn hóa + persona + model.
+"""
+
+import hashlib
+import logging
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger("ekko.cache")
+
+# History policy — when a cached answer may be reused despite channel history:
+#   "off"        never cache
+#   "standalone" only questions that read on their own (no follow-up markers)
+#   "ignore"     always, history is never taken into account
+HISTORY_POLICIES = ("off", "standalone", "ignore")
+
+# words that make a question depend on the conversation before it
+_FOLLOW_UP_MARKERS = {
+    "còn", "vậy", "nó", "đó", "đấy", "kia", "tiếp", "nữa", "nãy",
+    "again", "it", "that", "this", "those", "them",
+}
+_MIN_STANDALONE_WORDS = 3
+
+_WS_RE = re.compile(r"\s+")
+
+
+def normalize_question(text: str) -> str:
+    text = unicodedata.normalize("NFC", (text or "").lower())
+    text = "".join(
+        " " if unicodedata.category(ch)[0] in ("P", "S") else ch
+        for ch in text
+    )
+    return _WS_RE.sub(" ", text).strip()
+
+
+def is_standalone(question: str) -> bool:
+    words = normalize_question(question).split()
+    if len(words) < _MIN_STANDALONE_WORDS:
+        return False
+    return not any(w in _FOLLOW_UP_MARKERS for w in words)
+
+
+class ResponseCache:
+    def __init__(self, max_entries: int = 500, ttl: float = 6 * 3600, db=None,
+                 history_policy: str = "standalone"):
+        if history_policy not in HISTORY_POLICIES:
+            logger.warning("Unknown cache history policy %r — using 'standalone'", history_policy)
+            history_policy = "standalone"
+        self.max_entries = max(0, max_entries)
+        self.ttl = ttl
+        self.db = db  # ChatDB for the persistent tier, or None
+        self.history_policy = history_policy
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._api_latency = 0.0  # EWMA of a real API round trip, seconds
+
+    @property
+    def enabled(self) -> bool:
+        return self.history_policy != "off" and self.max_entries > 0
+
+    @staticmethod
+    def key(question: str, persona: str, model: str) -> str:
+        raw = "\x1f".join((normalize_question(question), persona or "", model or ""))
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def cacheable(self, question: str) -> bool:
+        if not self.enabled:
+            return False
+        if self.history_policy == "ignore":
+            return True
+        return is_standalone(question)
+
+    async def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, text = entry
+            if expires_at > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return text
+            del self._entries[key]
+        if self.db is not None:
+            rows = await self.db.fetchall(
+                "SELECT response, expires_at FROM response_cache WHERE key = ? AND expires_at > ?",
+                (key, now),
+            )
+            if rows:
+                text, expires_at = rows[0]
+                self._remember(key, expires_at, text)
+                self.hits += 1
+                self.disk_hits += 1
+                return text
+        self.misses += 1
+        return None
+
+    def put(self, key: str, text: str):
+        expires_at = time.time() + self.ttl
+        self._remember(key, expires_at, text)
+        self.stores += 1
+        if self.db is not None:
+            self.db.enqueue(
+                "INSERT OR REPLACE INTO response_cache (key, response, expires_at) VALUES (?, ?, ?)",
+                (key, text, expires_at),
+            )
+
+    def purge_expired(self):
+        now = time.time()
+        for k in [k for k, (exp, _) in self._entries.items() if exp <= now]:
+            del self._entries[k]
+        if self.db is not None:
+            self.db.enqueue("DELETE FROM response_cache WHERE expires_at <= ?", (now,))
+
+    def record_api_latency(self, seconds: float):
+        self._api_latency = seconds if not self._api_latency else 0.8 * self._api_latency + 0.2 * seconds
+
+    def _remember(self, key: str, expires_at: float, text: str):
+        self._entries[key] = (expires_at, text)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "api_calls_saved": self.hits,
+            "latency_saved_seconds": self.hits * self._api_latency,
+        }
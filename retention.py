@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+ChatArchiver — bảo trì bảng chats chạy nền: dòng quá hạn (theo từng kênh) được chuyển
+sang file lưu trữ gzip JSONL theo tháng rồi mới xóa; sau đó incremental vacuum từng bước nhỏ
+để trả trang trống về hệ điều hành mà không chặn event loop hay luồng ghi.
+"""
+
+import asyncio
+import datetime
+import gzip
+import json
+import logging
+import os
+import sqlite3
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+logger = logging.getLogger("ekko.retention")
+
+ROW_COLUMNS = ("id", "user_id", "channel_id", "role", "persona", "content", "timestamp", "message_id", "rating")
+SIZE_TABLES = ("chats", "response_cache", "channel_summaries", "user_personas", "reply_messages", "reply_votes")
+AUTO_VACUUM_INCREMENTAL = 2
+
+# a user row is the question of a rated answer when it is that user's last row in the
+# channel before the answer (same rule as the knowledge index's RATED_ANSWERS_SQL)
+_QUESTION_OF_RATED = (
+    " AND NOT (role = 'user' AND EXISTS (SELECT 1 FROM chats b WHERE b.channel_id = chats.channel_id"
+    " AND b.user_id = chats.user_id AND b.role = 'bot' AND b.id > chats.id AND COALESCE(b.rating, 0) >= ?"
+    " AND NOT EXISTS (SELECT 1 FROM chats u WHERE u.channel_id = b.channel_id AND u.user_id = b.user_id"
+    " AND u.role = 'user' AND u.id > chats.id AND u.id < b.id)))"
+)
+
+
+def parse_retention(spec: str) -> Dict[int, float]:
+    """'123:30,456:0' -> {123: 30.0, 456: 0.0}; days per channel id, 0 keeps forever."""
+    out: Dict[int, float] = {}
+    for part in (spec or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            channel, days = part.split(":", 1)
+            out[int(channel)] = float(days)
+        except ValueError:
+            logger.warning("Ignoring bad retention entry %r (want channel_id:days)", part)
+    return out
+
+
+def _write_archive(directory: str, rows: List[Tuple]) -> Dict[str, int]:
+    # one gzip member per batch; gzip readers treat appended members as one stream
+    by_month: Dict[str, List[str]] = defaultdict(list)
+    for row in rows:
+        record = dict(zip(ROW_COLUMNS, row))
+        month = (record.get("timestamp") or "unknown")[:7]
+        by_month[month].append(json.dumps(record, ensure_ascii=False))
+    os.makedirs(directory, exist_ok=True)
+    written = {}
+    for month, lines in by_month.items():
+        path = os.path.join(directory, f"chats-{month}.jsonl.gz")
+        with gzip.open(path, "at", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        written[path] = len(lines)
+    return written
+
+
+class ChatArchiver:
+    def __init__(self, db, archive_dir: str, default_days: float = 0,
+                 per_channel: Optional[Dict[int, float]] = None,
+                 keep_min_rating: int = 0, batch_rows: int = 500,
+                 vacuum_pages: int = 256, pause: float = 0.05,
+                 on_archived: Optional[Callable[[Set[int]], None]] = None,
+                 convert_auto_vacuum: bool = False):
+        self.db = db
+        self.archive_dir = archive_dir
+        self.default_days = default_days
+        self.per_channel = dict(per_channel or {})
+        # rows rated at least this high stay with their question (they feed the knowledge index);
+        # 0 archives everything
+        self.keep_min_rating = keep_min_rating
+        self.batch_rows = max(1, batch_rows)
+        self.vacuum_pages = max(1, vacuum_pages)
+        self.pause = pause
+        self.on_archived = on_archived
+        # one-off full VACUUM that switches an old file to incremental mode; blocks the DB thread
+        self.convert_auto_vacuum = convert_auto_vacuum
+        # metrics
+        self.archived = 0
+        self.vacuumed_pages = 0
+        self.runs = 0
+        self.last_sizes: Dict[str, float] = {}
+
+    # ---------------------------
+    # policies
+    # ---------------------------
+    def _policies(self, now: datetime.datetime) -> Iterable[Tuple[str, tuple]]:
+        """(where clause, params) per retention rule; timestamps are utc isoformat strings."""
+        rating = " AND COALESCE(rating, 0) < ?" + _QUESTION_OF_RATED if self.keep_min_rating > 0 else ""
+        rating_params = (self.keep_min_rating,) * 2 if self.keep_min_rating > 0 else ()
+        for channel_id, days in self.per_channel.items():
+            if days > 0:
+                cutoff = (now - datetime.timedelta(days=days)).isoformat()
+                yield f"channel_id = ? AND timestamp < ?{rating}", (channel_id, cutoff) + rating_params
+        if self.default_days > 0:
+            cutoff = (now - datetime.timedelta(days=self.default_days)).isoformat()
+            where = f"timestamp < ?{rating}"
+            params: tuple = (cutoff,) + rating_params
+            if self.per_channel:
+                where += f" AND channel_id NOT IN ({','.join('?' * len(self.per_channel))})"
+                params += tuple(self.per_channel)
+            yield where, params
+
+    # ---------------------------
+    # maintenance pass
+    # ---------------------------
+    async def run_once(self) -> Dict[str, float]:
+        now = datetime.datetime.utcnow()
+        archived = 0
+        channels: Set[int] = set()
+        loop = asyncio.get_running_loop()
+        for where, params in self._policies(now):
+            while True:
+                query = f"SELECT {', '.join(ROW_COLUMNS)} FROM chats WHERE {where} ORDER BY id LIMIT ?"
+                rows = await self.db.fetchall(query, params + (self.batch_rows,))
+                if not rows:
+                    break
+                # archive before delete: a crash in between duplicates rows in the archive, never loses them
+                await loop.run_in_executor(None, _write_archive, self.archive_dir, rows)
+                ids = [r[0] for r in rows]
+                await self.db.execute(f"DELETE FROM chats WHERE id IN ({','.join('?' * len(ids))})", ids)
+                archived += len(rows)
+                channels.update(r[2] for r in rows)
+                if len(rows) < self.batch_rows:
+                    break
+                await asyncio.sleep(self.pause)
+        self.archived += archived
+        if archived:
+            logger.info("Archived %d chat rows from %d channels to %s", archived, len(channels), self.archive_dir)
+            if self.on_archived is not None:
+                self.on_archived(channels)
+        if self.convert_auto_vacuum:
+            await self.convert()
+        await self.vacuum()
+        self.last_sizes = await self.sizes()
+        self.runs += 1
+        return self.last_sizes
+
+    async def convert(self) -> bool:
+        """Switch the file to auto_vacuum=INCREMENTAL with one full VACUUM (no-op once converted).
+        Every read and write waits for the rewrite, which needs about twice the file size on disk."""
+        if await self.db.call(_auto_vacuum_mode) == AUTO_VACUUM_INCREMENTAL:
+            return False
+        logger.warning("Converting %s to incremental auto_vacuum — DB is blocked until VACUUM finishes", self.db.path)
+        await self.db.call(_convert_incremental)
+        logger.info("Incremental auto_vacuum enabled")
+        return True
+
+    async def vacuum(self, max_steps: int = 1000) -> int:
+        """Release free pages in small steps; each step is one short DB-thread call."""
+        freed = 0
+        if await self.db.call(_auto_vacuum_mode) != AUTO_VACUUM_INCREMENTAL:
+            # without incremental mode the pragma does nothing; free pages get reused by new rows
+            return 0
+        for _ in range(max_steps):
+            free = await self.db.call(_incremental_vacuum_step(self.vacuum_pages))
+            freed += free
+            if free < self.vacuum_pages:
+                break
+            await asyncio.sleep(self.pause)
+        self.vacuumed_pages += freed
+        return freed
+
+    async def sizes(self) -> Dict[str, float]:
+        stats = await self.db.call(_table_stats)
+        path = self.db.path
+        for suffix, key in (("", "db_file_bytes"), ("-wal", "wal_file_bytes")):
+            try:
+                stats[key] = os.path.getsize(path + suffix)
+            except OSError:
+                stats[key] = 0
+        stats["archive_bytes"] = _dir_size(self.archive_dir)
+        return stats
+
+    def stats(self) -> Dict[str, float]:
+        return {"archived_rows": self.archived, "vacuumed_pages": self.vacuumed_pages, "runs": self.runs}
+
+
+def _auto_vacuum_mode(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+
+
+def _convert_incremental(conn: sqlite3.Connection):
+    conn.commit()
+    conn.executescript("PRAGMA auto_vacuum = INCREMENTAL; VACUUM;")
+
+
+def _incremental_vacuum_step(pages: int):
+    def _run(conn: sqlite3.Connection) -> int:
+        before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if not before:
+            return 0
+        # executescript steps the pragma to completion; execute() frees a single page
+        conn.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+        return before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return _run
+
+
+def _table_stats(conn: sqlite3.Connection) -> Dict[str, float]:
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    stats: Dict[str, float] = {
+        "page_bytes": conn.execute("PRAGMA page_count").fetchone()[0] * page_size,
+        "free_bytes": conn.execute("PRAGMA freelist_count").fetchone()[0] * page_size,
+    }
+    existing = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    for table in SIZE_TABLES:
+        if table in existing:
+            stats[f"rows_{table}"] = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    return stats
+
+
+def _dir_size(directory: str) -> int:
+    total = 0
+    try:
+        for entry in os.scandir(directory):
+            if entry.is_file():
+                total += entry.stat().st_size
+    except OSError:
+        pass
+    return total
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+FairScheduler — thay cho asyncio.Semaphore toàn cục của API.
+Deficit round robin giữa các kênh, xoay vòng giữa các user trong một kênh;
+mỗi request có hạn chót (deadline), quá hạn thì bị bỏ, hàng đợi đầy thì từ chối sớm.
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, Optional
+
+logger = logging.getLogger("ekko.scheduler")
+
+
+class QueueFull(Exception):
+    """Raised when a request is shed because the queue is at its cap."""
+
+
+class RequestExpired(Exception):
+    """Raised when a request's deadline passes before it gets a slot."""
+
+
+class _Waiter:
+    __slots__ = ("future", "deadline", "cost", "enqueued_at", "user_id")
+
+    def __init__(self, future: asyncio.Future, deadline: float, cost: int, user_id: int):
+        self.future = future
+        self.deadline = deadline
+        self.cost = cost
+        self.enqueued_at = time.monotonic()
+        self.user_id = user_id
+
+
+class _ChannelFlow:
+    def __init__(self):
+        self.deficit = 0
+        self.users: "OrderedDict[int, Deque[_Waiter]]" = OrderedDict()
+
+    def peek(self) -> Optional[_Waiter]:
+        # skip waiters that gave up (cancelled / timed out) at the queue heads
+        while self.users:
+            uid, q = next(iter(self.users.items()))
+            while q and q[0].future.done():
+                q.popleft()
+            if q:
+                return q[0]
+            del self.users[uid]
+        return None
+
+    def pop(self) -> _Waiter:
+        uid, q = next(iter(self.users.items()))
+        w = q.popleft()
+        if q:
+            self.users.move_to_end(uid)
+        else:
+            del self.users[uid]
+        return w
+
+
+class FairScheduler:
+    def __init__(self, limit: int, max_queue: int = 50, max_per_user: int = 3, quantum: int = 1):
+        self.limit = max(1, limit)
+        self.max_queue = max_queue
+        self.max_per_user = max_per_user
+        self.quantum = max(1, quantum)
+        self._channels: "OrderedDict[int, _ChannelFlow]" = OrderedDict()
+        self._per_user: Dict[int, int] = {}
+        self.active = 0
+        self.depth = 0
+        # metrics
+        self.granted = 0
+        self.shed = 0
+        self.expired = 0
+        self.last_wait = 0.0
+        self.max_wait = 0.0
+        self.avg_wait = 0.0
+
+    # ---------------------------
+    # public API
+    # ---------------------------
+    @asynccontextmanager
+    async def slot(self, user_id: int, channel_id: int, deadline: float, cost: int = 1):
+        await self.acquire(user_id, channel_id, deadline, cost)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, user_id: int, channel_id: int, deadline: float, cost: int = 1):
+        now = time.monotonic()
+        if deadline <= now:
+            self.expired += 1
+            raise RequestExpired()
+        if self.active < self.limit and self.depth == 0:
+            self._grant_now(0.0)
+            return
+        if self.depth >= self.max_queue:
+            self.shed += 1
+            logger.warning("Scheduler queue full (%d) — shedding request", self.depth)
+            raise QueueFull()
+        if self._per_user.get(user_id, 0) >= self.max_per_user:
+            self.shed += 1
+            raise QueueFull()
+
+        fut = asyncio.get_running_loop().create_future()
+        waiter = _Waiter(fut, deadline, cost, user_id)
+        flow = self._channels.get(channel_id)
+        if flow is None:
+            flow = self._channels[channel_id] = _ChannelFlow()
+        flow.users.setdefault(user_id, deque()).append(waiter)
+        self.depth += 1
+        self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), timeout=deadline - now)
+        except asyncio.TimeoutError:
+            if not self._abandon(waiter):
+                if fut.exception() is not None:
+                    raise fut.exception()
+                return  # granted in the same tick the timer fired — keep the slot
+            self.expired += 1
+            raise RequestExpired()
+        except asyncio.CancelledError:
+            if not self._abandon(waiter) and fut.exception() is None:
+                self.release()  # the slot was granted but nobody will use it
+            raise
+
+    def release(self):
+        self.active -= 1
+        self._dispatch()
+
+    def set_limit(self, limit: int):
+        self.limit = max(1, int(limit))
+        self._dispatch()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "depth": self.depth,
+            "granted": self.granted,
+            "shed": self.shed,
+            "expired": self.expired,
+            "last_wait_seconds": self.last_wait,
+            "avg_wait_seconds": self.avg_wait,
+            "max_wait_seconds": self.max_wait,
+        }
+
+    # ---------------------------
+    # internals
+    # ---------------------------
+    def _grant_now(self, waited: float):
+        self.active += 1
+        self.granted += 1
+        self.last_wait = waited
+        self.max_wait = max(self.max_wait, waited)
+        self.avg_wait = waited if self.granted == 1 else 0.9 * self.avg_wait + 0.1 * waited
+
+    def _leave(self, waiter: _Waiter):
+        self.depth -= 1
+        left = self._per_user.get(waiter.user_id, 1) - 1
+        if left > 0:
+            self._per_user[waiter.user_id] = left
+        else:
+            self._per_user.pop(waiter.user_id, None)
+
+    def _abandon(self, waiter: _Waiter) -> bool:
+        """Drop a waiter that stopped waiting; False if it already holds a slot."""
+        if waiter.future.done():
+            return False
+        waiter.future.cancel()
+        self._leave(waiter)
+        return True
+
+    def _next(self) -> Optional[_Waiter]:
+        # deficit round robin over channels, plain round robin over users in a channel
+        while self._channels:
+            ch_id, flow = next(iter(self._channels.items()))
+            waiter = flow.peek()
+            if waiter is None:
+                del self._channels[ch_id]
+                continue
+            if flow.deficit < waiter.cost:
+                flow.deficit += self.quantum
+                self._channels.move_to_end(ch_id)
+                continue
+            flow.deficit -= waiter.cost
+            flow.pop()
+            if flow.peek() is None:
+                del self._channels[ch_id]
+            return waiter
+        return None
+
+    def _dispatch(self):
+        while self.active < self.limit:
+            waiter = self._next()
+            if waiter is None:
+                return
+            self._leave(waiter)
+            now = time.monotonic()
+            if waiter.deadline <= now:
+                self.expired += 1
+                waiter.future.set_exception(RequestExpired())
+                continue
+            self._grant_now(now - waiter.enqueued_at)
+            waiter.future.set_result(None)
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Sessions — dựng request Gemini dạng có cấu trúc: persona đi qua system_instruction,
+lịch sử kênh thành các lượt user/model, tiền tố tĩnh dùng context caching khi SDK + model hỗ trợ.
+Khả năng của SDK được dò một lần (detect), không thử lần lượt từng kiểu gọi ở mỗi request.
+"""
+
+import asyncio
+import datetime
+import hashlib
+import inspect
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from limiter import estimate_tokens
+
+logger = logging.getLogger("ekko.sessions")
+
+
+class SdkCapabilities(NamedTuple):
+    async_generate: bool = False     # model.generate_content_async (incl. stream=True)
+    system_instruction: bool = False  # GenerativeModel(..., system_instruction=...)
+    context_cache: bool = False       # genai.caching + GenerativeModel.from_cached_content
+    generate_text: bool = False       # legacy genai.generate_text
+    create_response: bool = False     # legacy genai.create_response
+
+
+def detect_capabilities(genai: Any, model: Any) -> SdkCapabilities:
+    cls = getattr(genai, "GenerativeModel", None) if genai is not None else None
+    system_instruction = False
+    # only for models we build ourselves; an injected model object is used as is
+    if cls is not None and isinstance(model, cls):
+        try:
+            system_instruction = "system_instruction" in inspect.signature(cls).parameters
+        except (TypeError, ValueError):
+            pass
+    return SdkCapabilities(
+        async_generate=model is not None and hasattr(model, "generate_content_async"),
+        system_instruction=system_instruction,
+        context_cache=(system_instruction and getattr(genai, "caching", None) is not None
+                       and hasattr(cls, "from_cached_content")),
+        generate_text=callable(getattr(genai, "generate_text", None)),
+        create_response=callable(getattr(genai, "create_response", None)),
+    )
+
+
+class GeminiRequest(NamedTuple):
+    system_text: str
+    contents: List[Dict[str, Any]]  # user/model turns, without the system text
+    tokens: int                     # estimate for the TPM bucket
+    prompt: str = ""                # flat text, only built for the legacy text APIs
+
+
+def clip(text: str, limit: int) -> str:
+    text = text or ""
+    return text if len(text) <= limit else text[:limit].rstrip() + "…"
+
+
+def turn_label(role: str, persona: Optional[str]) -> str:
+    """Speaker tag for a history turn in flat prompts and summaries."""
+    return "Đại hiệp" if role == "user" else (persona or "Bot")
+
+
+def drop_own_rows(history: Sequence[Tuple], own_rows: Sequence[str]) -> List[Tuple]:
+    """history without the rows the current request saved before the call (they are its final turn).
+    Each saved text takes out the newest user row with exactly that content; other users' messages
+    stay, even when they were posted after it or are a substring of the request."""
+    history = list(history or [])
+    for text in reversed(own_rows):
+        for i in range(len(history) - 1, -1, -1):
+            if history[i][0] == "user" and history[i][2] == text:
+                del history[i]
+                break
+    return history
+
+
+def _append(contents: List[Dict[str, Any]], role: str, text: str):
+    # consecutive turns of one role are merged; the API wants user/model to alternate
+    if contents and contents[-1]["role"] == role:
+        contents[-1]["parts"].append(text)
+    else:
+        contents.append({"role": role, "parts": [text]})
+
+
+class SessionManager:
+    def __init__(self, genai: Any, base_model: Callable[[str], Any], model_name: str, budget: int,
+                 turn_max_chars: int, summary_label: str = "Tóm tắt hội thoại trước", max_models: int = 16,
+                 cache_min_tokens: int = 32768, cache_ttl: float = 3600):
+        self.genai = genai
+        self.base_model = base_model
+        self.model_name = model_name
+        self.budget = budget
+        self.turn_max_chars = turn_max_chars
+        self.summary_label = summary_label
+        self.max_models = max(1, max_models)
+        self.cache_min_tokens = cache_min_tokens
+        self.cache_ttl = cache_ttl
+        self._caps: Optional[SdkCapabilities] = None
+        # (model_name, system hash) -> model with the system instruction baked in
+        self._models: "OrderedDict[Tuple[str, str], Any]" = OrderedDict()
+        # same key -> (model bound to a context cache, monotonic expiry)
+        self._cached: Dict[Tuple[str, str], Tuple[Any, float]] = {}
+        self._cache_tasks: Dict[Tuple[str, str], asyncio.Future] = {}
+        self.cache_hits = 0
+
+    # ---------------------------
+    # capabilities
+    # ---------------------------
+    def detect(self, model: Any) -> SdkCapabilities:
+        self._caps = detect_capabilities(self.genai, model)
+        self._models.clear()
+        self._cached.clear()
+        logger.info("Gemini SDK capabilities: %s", ", ".join(k for k, v in self._caps._asdict().items() if v) or "none")
+        return self._caps
+
+    @property
+    def caps(self) -> SdkCapabilities:
+        if self._caps is None:
+            self.detect(self.base_model(self.model_name))
+        return self._caps
+
+    # ---------------------------
+    # contents
+    # ---------------------------
+    def build(self, system_text: str, history: List[Tuple], user_text: str, summary: str = "") -> GeminiRequest:
+        """Current request + summary + newest turns that fit the token budget, as structured contents.
+        history must not hold the request's own rows (see drop_own_rows)."""
+        history = list(history or [])
+        used = estimate_tokens(system_text) + estimate_tokens(user_text)
+        summary_block = ""
+        if summary:
+            summary_block = f"[{self.summary_label}]\n{summary}"
+            cost = estimate_tokens(summary_block)
+            if used + cost <= self.budget:
+                used += cost
+            else:
+                summary_block = ""
+        turns = []
+        for role, _persona, content in reversed(history):
+            text = clip(content, self.turn_max_chars)
+            cost = estimate_tokens(text) + 1
+            if used + cost > self.budget:
+                break
+            turns.append(("user" if role == "user" else "model", text))
+            used += cost
+        contents: List[Dict[str, Any]] = []
+        if summary_block:
+            _append(contents, "user", summary_block)
+        for role, text in reversed(turns):
+            if not contents and role == "model":
+                continue  # contents must open with a user turn
+            _append(contents, role, text)
+        _append(contents, "user", user_text)
+        return GeminiRequest(system_text, contents, used)
+
+    # ---------------------------
+    # models
+    # ---------------------------
+    def prepare(self, model_name: str, request: GeminiRequest) -> Tuple[Any, List[Dict[str, Any]]]:
+        """(model, contents) for one call; the system text rides in the model when the SDK allows."""
+        if not self.caps.system_instruction or not request.system_text:
+            model = self.base_model(model_name)
+            if model is None:
+                raise RuntimeError(f"Gemini model {model_name} is unavailable")
+            contents = [dict(c, parts=list(c["parts"])) for c in request.contents]
+            if request.system_text:
+                contents[0]["parts"].insert(0, request.system_text)
+            return model, contents
+        key = (model_name, hashlib.sha1(request.system_text.encode("utf-8")).hexdigest())
+        cached = self._cached.get(key)
+        if cached is not None:
+            if cached[1] > time.monotonic():
+                self.cache_hits += 1
+                return cached[0], request.contents
+            del self._cached[key]
+        self._maybe_cache(key, model_name, request.system_text)
+        model = self._models.get(key)
+        if model is None:
+            model = self.genai.GenerativeModel(model_name, system_instruction=request.system_text)
+            self._models[key] = model
+            while len(self._models) > self.max_models:
+                self._models.popitem(last=False)
+        self._models.move_to_end(key)
+        return model, request.contents
+
+    def _maybe_cache(self, key: Tuple[str, str], model_name: str, system_text: str):
+        # the API only caches prefixes above a model-specific minimum (32k tokens for 1.5 models)
+        if (not self.caps.context_cache or key in self._cache_tasks
+                or estimate_tokens(system_text) < self.cache_min_tokens):
+            return
+        loop = asyncio.get_running_loop()
+        task = loop.run_in_executor(None, self._create_cache, model_name, system_text)
+        self._cache_tasks[key] = task
+        task.add_done_callback(lambda t, k=key: self._cache_done(k, t))
+
+    def _create_cache(self, model_name: str, system_text: str) -> Any:
+        name = model_name if model_name.startswith("models/") else f"models/{model_name}"
+        cache = self.genai.caching.CachedContent.create(
+            model=name, system_instruction=system_text, ttl=datetime.timedelta(seconds=self.cache_ttl))
+        return self.genai.GenerativeModel.from_cached_content(cached_content=cache)
+
+    def _cache_done(self, key: Tuple[str, str], task: asyncio.Future):
+        self._cache_tasks.pop(key, None)
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            logger.warning("Context cache for %s not created: %r", key[0], task.exception())
+            return
+        # refresh a little before the server drops it
+        self._cached[key] = (task.result(), time.monotonic() + self.cache_ttl * 0.9)
+        logger.info("Context cache ready for %s", key[0])
+
+    def stats(self) -> Dict[str, float]:
+        return {"models": len(self._models), "context_caches": len(self._cached), "cache_hits": self.cache_hits}
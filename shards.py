@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Shards — chạy bot ở chế độ AutoShardedBot trên nhiều tiến trình worker cùng một máy.
+Tiến trình chính chỉ làm supervisor: chia shard cho từng worker, khởi động lần lượt
+(tránh đụng giới hạn IDENTIFY của Discord), tự khởi động lại worker bị chết.
+"""
+
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+from typing import Dict, List, Optional
+
+logger = logging.getLogger("ekko.shards")
+
+# Discord allows one IDENTIFY per 5 seconds per concurrency bucket
+IDENTIFY_INTERVAL = 5.0
+
+
+def plan(shard_count: int, workers: int) -> List[List[int]]:
+    """Spread shard ids round-robin over workers; empty workers are dropped."""
+    workers = max(1, min(workers, shard_count))
+    return [list(range(i, shard_count, workers)) for i in range(workers)]
+
+
+def parse_shard_ids(spec: str) -> Optional[List[int]]:
+    ids = [int(x) for x in (spec or "").split(",") if x.strip()]
+    return ids or None
+
+
+def recommended_shards(token: str, timeout: float = 10.0) -> Optional[int]:
+    """Shard count Discord recommends for this bot (GET /gateway/bot)."""
+    req = urllib.request.Request("https://discord.com/api/v10/gateway/bot",
+                                 headers={"Authorization": f"Bot {token}", "User-Agent": "EkkoBot"})
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            return int(json.load(resp)["shards"])
+    except Exception:
+        logger.exception("Could not fetch the recommended shard count")
+        return None
+
+
+class Supervisor:
+    def __init__(self, argv: List[str], shard_count: int, workers: int,
+                 env: Optional[Dict[str, str]] = None, restart_delay: float = 5.0):
+        self.argv = argv
+        self.shard_count = shard_count
+        self.plans = plan(shard_count, workers)
+        self.env = dict(env if env is not None else os.environ)
+        self.restart_delay = restart_delay
+        self._procs: List[Optional[subprocess.Popen]] = [None] * len(self.plans)
+        self._stopping = False
+
+    def _spawn(self, index: int) -> subprocess.Popen:
+        env = dict(self.env)
+        env["EKKO_WORKER_INDEX"] = str(index)
+        env["EKKO_SHARD_IDS"] = ",".join(map(str, self.plans[index]))
+        env["SHARD_COUNT"] = str(self.shard_count)
+        proc = subprocess.Popen(self.argv, env=env)
+        logger.info("Worker %d started (pid %d, shards %s)", index, proc.pid, self.plans[index])
+        return proc
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+
+    def run(self) -> int:
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for i, shards in enumerate(self.plans):
+            if self._stopping:
+                break
+            self._procs[i] = self._spawn(i)
+            # shards inside a worker identify one after another; let this worker finish first
+            self._sleep(IDENTIFY_INTERVAL * len(shards))
+        while not self._stopping:
+            for i, proc in enumerate(self._procs):
+                if proc is not None and proc.poll() is not None and not self._stopping:
+                    logger.error("Worker %d exited with %s — restarting in %.0fs", i, proc.returncode, self.restart_delay)
+                    self._sleep(self.restart_delay)
+                    if not self._stopping:
+                        self._procs[i] = self._spawn(i)
+            self._sleep(1.0)
+        return self._shutdown()
+
+    def _sleep(self, seconds: float):
+        end = time.monotonic() + seconds
+        while not self._stopping and time.monotonic() < end:
+            time.sleep(max(0.0, min(0.5, end - time.monotonic())))
+
+    def _shutdown(self, grace: float = 30.0) -> int:
+        live = [p for p in self._procs if p is not None and p.poll() is None]
+        for proc in live:
+            # SIGINT lets bot.run close the gateway and drain the DB queue
+            proc.send_signal(signal.SIGINT)
+        deadline = time.monotonic() + grace
+        for proc in live:
+            try:
+                proc.wait(timeout=max(0.1, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        logger.info("All workers stopped")
+        return 0
+
+
+def run_supervisor(shard_count: int, workers: int, env: Optional[Dict[str, str]] = None) -> int:
+    argv = [sys.executable] + sys.argv
+    return Supervisor(argv, shard_count, workers, env).run()
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+SharedState — backend cho trạng thái cần chung giữa các worker (token bucket cho quota/cooldown,
+cờ circuit breaker). Mặc định LocalState (trong tiến trình); SQLiteState dùng một file SQLite chung
+để nhiều worker trên cùng máy tôn trọng chung một quota Gemini.
+"""
+
+import asyncio
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple, Optional, Sequence, Tuple
+
+from user_state import TTLCache
+
+logger = logging.getLogger("ekko.shared_state")
+
+
+class Bucket(NamedTuple):
+    key: str
+    rate: float  # tokens per second; <= 0 disables the bucket
+    capacity: float
+    n: float = 1.0
+
+
+def _level(item: Optional[Tuple[float, float]], b: Bucket, now: float) -> float:
+    # an unknown (or expired) bucket is full
+    if item is None:
+        return b.capacity
+    tokens, stamp = item
+    return min(b.capacity, tokens + max(0.0, now - stamp) * b.rate)
+
+
+def _refill_ttl(level: float, b: Bucket) -> float:
+    # once a bucket would be full again its row carries no information
+    return max(1.0, (b.capacity - level) / b.rate)
+
+
+class StateBackend:
+    """Token buckets and small expiring values. Timestamps are wall-clock so processes agree."""
+
+    name = "abstract"
+
+    async def acquire(self, buckets: Sequence[Bucket], consume: bool = True) -> float:
+        """Take n from every bucket at once, or nothing; returns seconds to wait (0 = taken).
+        consume=False only reports the wait."""
+        raise NotImplementedError
+
+    async def charge(self, buckets: Sequence[Bucket]):
+        """Take n unconditionally; buckets may go into debt (e.g. output tokens known afterwards)."""
+        raise NotImplementedError
+
+    async def drain(self, buckets: Sequence[Bucket]):
+        """Empty the buckets (a 429 means the real quota is already spent)."""
+        raise NotImplementedError
+
+    async def get(self, key: str) -> Optional[float]:
+        raise NotImplementedError
+
+    async def put(self, key: str, value: float, ttl: float):
+        raise NotImplementedError
+
+    def size(self) -> int:
+        return 0
+
+    def close(self):
+        pass
+
+    # shared bucket arithmetic; subclasses provide _load / _save inside one atomic section
+    def _load(self, key: str) -> Optional[Tuple[float, float]]:
+        raise NotImplementedError
+
+    def _save(self, key: str, tokens: float, stamp: float, ttl: float):
+        raise NotImplementedError
+
+    def _acquire_sync(self, buckets: Sequence[Bucket], consume: bool) -> float:
+        now = time.time()
+        live = [b for b in buckets if b.rate > 0]
+        levels = [_level(self._load(b.key), b, now) for b in live]
+        wait = 0.0
+        for b, level in zip(live, levels):
+            need = min(b.n, b.capacity)
+            if level < need:
+                wait = max(wait, (need - level) / b.rate)
+        if wait == 0.0 and consume:
+            for b, level in zip(live, levels):
+                left = level - min(b.n, b.capacity)
+                self._save(b.key, left, now, _refill_ttl(left, b))
+        return wait
+
+    def _charge_sync(self, buckets: Sequence[Bucket]):
+        now = time.time()
+        for b in buckets:
+            if b.rate > 0:
+                left = _level(self._load(b.key), b, now) - min(b.n, b.capacity)
+                self._save(b.key, left, now, _refill_ttl(left, b))
+
+    def _drain_sync(self, buckets: Sequence[Bucket]):
+        now = time.time()
+        for b in buckets:
+            if b.rate > 0:
+                left = min(0.0, _level(self._load(b.key), b, now))
+                self._save(b.key, left, now, _refill_ttl(left, b))
+
+
+class LocalState(StateBackend):
+    """In-process backend; bounded like the rest of the per-user state."""
+
+    name = "local"
+
+    def __init__(self, max_keys: int = 10000):
+        self._buckets: TTLCache[Tuple[float, float]] = TTLCache(max_keys, 3600)
+        self._values: TTLCache[float] = TTLCache(1000, 3600)
+
+    def _load(self, key):
+        return self._buckets.get(key)
+
+    def _save(self, key, tokens, stamp, ttl):
+        self._buckets.set(key, (tokens, stamp), ttl=ttl)
+
+    async def acquire(self, buckets, consume=True):
+        return self._acquire_sync(buckets, consume)
+
+    async def charge(self, buckets):
+        self._charge_sync(buckets)
+
+    async def drain(self, buckets):
+        self._drain_sync(buckets)
+
+    async def get(self, key):
+        return self._values.get(key)
+
+    async def put(self, key, value, ttl):
+        self._values.set(key, value, ttl=ttl)
+
+    def size(self) -> int:
+        return len(self._buckets) + len(self._values)
+
+
+class SQLiteState(StateBackend):
+    """Backend in a SQLite file shared by every worker on the host.
+    Each operation is one BEGIN IMMEDIATE transaction on a private thread, so the
+    read-modify-write of a bucket is atomic across processes and never blocks the loop."""
+
+    name = "sqlite"
+
+    def __init__(self, path: str, busy_timeout: float = 5.0, prune_every: int = 500):
+        self.path = path
+        self.prune_every = prune_every
+        self._ops = 0
+        self._rows = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ekko-state")
+        self._conn = sqlite3.connect(path, timeout=busy_timeout, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS state_buckets (key TEXT PRIMARY KEY, tokens REAL, stamp REAL, expires_at REAL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS state_values (key TEXT PRIMARY KEY, value REAL, expires_at REAL)")
+
+    def _load(self, key):
+        return self._conn.execute(
+            "SELECT tokens, stamp FROM state_buckets WHERE key = ? AND expires_at > ?", (key, time.time())).fetchone()
+
+    def _save(self, key, tokens, stamp, ttl):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO state_buckets (key, tokens, stamp, expires_at) VALUES (?, ?, ?, ?)",
+            (key, tokens, stamp, stamp + ttl))
+
+    def _tx(self, fn, *args):
+        conn = self._conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(*args)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        self._ops += 1
+        if self._ops % self.prune_every == 0:
+            self._prune()
+        return result
+
+    def _prune(self):
+        now = time.time()
+        conn = self._conn
+        conn.execute("DELETE FROM state_buckets WHERE expires_at <= ?", (now,))
+        conn.execute("DELETE FROM state_values WHERE expires_at <= ?", (now,))
+        self._rows = (conn.execute("SELECT COUNT(*) FROM state_buckets").fetchone()[0]
+                      + conn.execute("SELECT COUNT(*) FROM state_values").fetchone()[0])
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._tx, fn, *args)
+
+    async def acquire(self, buckets, consume=True):
+        return await self._run(self._acquire_sync, list(buckets), consume)
+
+    async def charge(self, buckets):
+        await self._run(self._charge_sync, list(buckets))
+
+    async def drain(self, buckets):
+        await self._run(self._drain_sync, list(buckets))
+
+    async def get(self, key):
+        def _get():
+            row = self._conn.execute(
+                "SELECT value FROM state_values WHERE key = ? AND expires_at > ?", (key, time.time())).fetchone()
+            return row[0] if row else None
+        return await self._run(_get)
+
+    async def put(self, key, value, ttl):
+        def _put():
+            self._conn.execute("INSERT OR REPLACE INTO state_values (key, value, expires_at) VALUES (?, ?, ?)",
+                               (key, value, time.time() + ttl))
+        await self._run(_put)
+
+    def size(self) -> int:
+        # refreshed on prune; counting on every scrape would take the shared lock
+        return self._rows
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._conn.close()
+
+
+class Cooldown:
+    """Per-user token bucket: `burst` messages back to back, then one per `period` seconds.
+    burst=1 is the old single-timestamp cooldown. A bucket that would be full again is
+    dropped, so idle users cost nothing."""
+
+    def __init__(self, period: float, burst: int = 1, backend: Optional[StateBackend] = None):
+        self.period = period
+        self.burst = max(1, burst)
+        self.backend = backend if backend is not None else LocalState()
+
+    def _bucket(self, uid: int) -> Bucket:
+        return Bucket(f"cooldown:{uid}", 1.0 / self.period, self.burst)
+
+    async def check(self, uid: int) -> Tuple[bool, float]:
+        """(on_cooldown, seconds until the next message is allowed)."""
+        if self.period <= 0:
+            return False, 0
+        wait = await self.backend.acquire([self._bucket(uid)], consume=False)
+        return wait > 0, wait
+
+    async def hit(self, uid: int):
+        if self.period > 0:
+            await self.backend.acquire([self._bucket(uid)])
+
+
+def open_backend(spec: str, max_keys: int = 10000) -> StateBackend:
+    """'local' or 'sqlite:<path>'."""
+    spec = (spec or "local").strip()
+    if spec == "local":
+        return LocalState(max_keys)
+    if spec.startswith("sqlite:"):
+        return SQLiteState(spec[len("sqlite:"):] or "ekko_shared.sqlite")
+    raise ValueError(f"Unknown shared state backend {spec!r} (want 'local' or 'sqlite:<path>')")
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import tempfile
+
+# the bot modules live at the repository root, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# bot.py reads its config at import; keep every file it touches out of the checkout
+_TMP = tempfile.mkdtemp(prefix="ekko-test-")
+for key, value in {
+    "DB_PATH": os.path.join(_TMP, "bot.sqlite"),
+    "KNOWLEDGE_INDEX_PATH": os.path.join(_TMP, "knowledge.idx"),
+    "CHAT_ARCHIVE_DIR": os.path.join(_TMP, "archive"),
+    "HTTP_HOST": "127.0.0.1",
+    "PORT": "0",
+    "COMMAND_SYNC": "off",
+    "GEMINI_API_KEY": "",
+}.items():
+    os.environ[key] = value
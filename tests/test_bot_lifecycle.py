@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""setup_hook()/close() without a gateway: discord.py's own client must survive both."""
+
+import asyncio
+
+import pytest
+
+bot = pytest.importorskip("bot")
+
+
+def test_setup_hook_and_close():
+    async def run():
+        client = bot.bot
+        http = client.http
+        await client.setup_hook()
+        assert client.http is http
+        assert hasattr(client.http, "ws_connect")
+        assert client.health_server is not None
+        assert bot.DB_READY
+        tasks = list(client._tasks)
+        assert tasks and not any(t.done() for t in tasks)
+        await client.close()
+        assert all(t.done() for t in tasks)
+        assert client.health_server is None
+        with pytest.raises(RuntimeError):
+            bot.chat_db.enqueue("SELECT 1")
+
+    asyncio.run(run())
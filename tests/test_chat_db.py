@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import threading
+
+import pytest
+
+from chat_db import ChatDB
+
+
+def test_writes_are_visible_to_later_reads(tmp_path):
+    async def run():
+        db = ChatDB(str(tmp_path / "c.sqlite"), flush_interval=10)
+        db.start()
+        await db.execute("CREATE TABLE t (x INTEGER)")
+        for i in range(5):
+            db.enqueue("INSERT INTO t VALUES (?)", (i,))
+        assert await db.fetchall("SELECT COUNT(*) FROM t") == [(5,)]
+        assert db.pending_writes == 0
+        await db.aclose()
+        with pytest.raises(RuntimeError):
+            db.enqueue("INSERT INTO t VALUES (1)")
+
+    asyncio.run(run())
+
+
+def test_pending_counter_survives_concurrent_writers(tmp_path):
+    db = ChatDB(str(tmp_path / "c.sqlite"), flush_interval=0, batch_size=7)
+    db.run(lambda conn: conn.execute("CREATE TABLE t (x INTEGER)")).result(5)
+
+    def writer():
+        for i in range(500):
+            db.enqueue("INSERT INTO t VALUES (?)", (i,))
+    threads = [threading.Thread(target=writer) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert db.run(lambda conn: conn.execute("SELECT COUNT(*) FROM t").fetchone()[0]).result(5) == 2000
+    assert db.pending_writes == 0
+    db.close()
+
+
+def test_failed_connect_fails_callers_instead_of_hanging(tmp_path):
+    db = ChatDB(str(tmp_path / "missing" / "c.sqlite"))
+    with pytest.raises(RuntimeError, match="failed to open"):
+        # either queued before the thread gave up, or refused right away
+        db.run(lambda conn: 1).result(5)
+    with pytest.raises(RuntimeError, match="failed to open"):
+        db.run(lambda conn: 1)
+    with pytest.raises(RuntimeError, match="failed to open"):
+        db.enqueue("INSERT INTO t VALUES (1)")
+    assert db.pending_writes == 0
+    db.close()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+
+import pytest
+
+bot = pytest.importorskip("bot")
+
+KEY = (1, 2)
+
+
+def test_fragments_are_merged_in_order():
+    async def run():
+        d = bot.Debouncer(0.05, 1.0, 5)
+        d.open(KEY, "một")
+        collect = asyncio.ensure_future(d.collect(KEY))
+        for text in ("hai", "ba"):
+            await asyncio.sleep(0.02)  # inside the window: each fragment extends it
+            assert d.join(KEY, text)
+        assert await collect == ["một", "hai", "ba"]
+        assert d.joined == 2
+        # the batch is closed once collected
+        assert not d.join(KEY, "bốn")
+
+    asyncio.run(run())
+
+
+def test_max_parts_closes_the_batch():
+    async def run():
+        d = bot.Debouncer(10, 10, 2)
+        d.open(KEY, "một")
+        assert d.join(KEY, "hai")
+        assert not d.join(KEY, "ba")
+        started = time.monotonic()
+        assert await d.collect(KEY) == ["một", "hai"]
+        assert time.monotonic() - started < 0.5  # full batch: no waiting for the window
+
+    asyncio.run(run())
+
+
+def test_batch_older_than_max_wait_is_not_joined():
+    async def run():
+        d = bot.Debouncer(0.03, 0.08, 10)
+        d.open(KEY, "một")
+        collect = asyncio.ensure_future(d.collect(KEY))
+        started = time.monotonic()
+        while time.monotonic() - started < 0.06:
+            assert d.join(KEY, "tiếp")  # keeps extending the window ...
+            await asyncio.sleep(0.02)
+        parts = await collect
+        # ... but max_wait caps the batch
+        assert time.monotonic() - started < 0.2
+        assert parts[:2] == ["một", "tiếp"]
+        d.open(KEY, "cũ")
+        d._open[KEY].started -= 1
+        assert not d.join(KEY, "mới")
+
+    asyncio.run(run())
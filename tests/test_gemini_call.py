@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import sqlite3
+import time
+
+import pytest
+
+bot = pytest.importorskip("bot")
+
+from hedging import ModelTier
+from sessions import SdkCapabilities
+
+
+class _Chunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class _Model:
+    """Streams `pieces`; with stall_after, hangs after that many pieces."""
+
+    def __init__(self, pieces, delay=0.0, stall_after=None):
+        self.pieces, self.delay, self.stall_after = pieces, delay, stall_after
+
+    async def generate_content_async(self, *args, stream=False, **kwargs):
+        await asyncio.sleep(self.delay)
+        if not stream:
+            return _Chunk("".join(self.pieces))
+
+        async def gen():
+            for i, piece in enumerate(self.pieces):
+                if self.stall_after is not None and i >= self.stall_after:
+                    await asyncio.sleep(3600)
+                yield _Chunk(piece)
+        return gen()
+
+
+@pytest.fixture
+def gemini(monkeypatch):
+    models = {}
+    monkeypatch.setattr(bot, "MODEL_TIERS", [ModelTier("main", 1.0), ModelTier("lite", 1.0)])
+    monkeypatch.setattr(bot, "GEMINI_OK", True)
+    monkeypatch.setattr(bot, "G_MODEL", object())
+    monkeypatch.setattr(bot, "MAX_RETRIES", 1)
+    monkeypatch.setattr(bot, "SUMMARY_ENABLED", False)
+    monkeypatch.setattr(bot, "HEDGE_MIN_DELAY", 0.05)
+    monkeypatch.setattr(bot.sessions, "_caps", SdkCapabilities(async_generate=True))
+    monkeypatch.setattr(bot.sessions, "base_model", models.get)
+    monkeypatch.setattr(bot, "_tier_latency", {})
+
+    async def no_history(channel_id):
+        return []
+    monkeypatch.setattr(bot, "fetch_history", no_history)
+    cached = []
+    monkeypatch.setattr(bot.response_cache, "put", lambda key, reply: cached.append((key, reply)))
+    successes = []
+    monkeypatch.setattr(bot.api_limiter, "on_success", successes.append)
+    return models, cached, successes
+
+
+def _call(on_chunk=None, seconds=0.5):
+    return bot._gemini_call("sys", "hỏi", 1, "key", on_chunk, 1, time.monotonic() + seconds)
+
+
+def test_complete_primary_answer_is_cached(gemini):
+    models, cached, successes = gemini
+    models["main"] = _Model(["Trả ", "lời."])
+    assert asyncio.run(_call()) == "Trả lời."
+    assert cached == [("key", "Trả lời.")] and len(successes) == 1
+
+
+def test_cut_off_stream_is_shown_but_not_cached(gemini):
+    models, cached, successes = gemini
+    models["main"] = _Model(["Phần đầu câu trả lời.", " Phần sau."], stall_after=1)
+    seen = []
+
+    async def on_chunk(text):
+        seen.append(text)
+    assert asyncio.run(_call(on_chunk)) == "Phần đầu câu trả lời."
+    assert seen == ["Phần đầu câu trả lời."]
+    assert cached == [] and successes == []
+
+
+def test_lower_tier_answer_is_not_cached(gemini):
+    models, cached, successes = gemini
+    models["main"] = _Model(["chậm"], delay=5)
+    models["lite"] = _Model(["nhanh"])
+    tracker = bot._tier_tracker("main", "generate")
+    for _ in range(50):
+        tracker.observe(0.01)
+    assert asyncio.run(_call(seconds=5)) == "nhanh"
+    assert cached == [] and len(successes) == 1
+
+
+def test_quota_backend_error_is_not_a_gemini_failure(gemini, monkeypatch):
+    models, cached, successes = gemini
+    models["main"] = _Model(["không tới"])
+    failures = []
+
+    async def locked(tokens, deadline):
+        raise sqlite3.OperationalError("database is locked")
+    monkeypatch.setattr(bot.api_limiter, "admit", locked)
+    monkeypatch.setattr(bot.api_limiter, "on_failure", failures.append)
+    reply = asyncio.run(_call())
+    assert reply and reply != "không tới"
+    assert failures == [] and successes == []
+
+
+class _NoText:
+    @property
+    def text(self):
+        raise ValueError("chunk has no parts")
+
+
+def test_textless_chunk_does_not_end_the_stream(gemini):
+    models, cached, successes = gemini
+
+    class Model(_Model):
+        async def generate_content_async(self, *args, stream=False, **kwargs):
+            async def gen():
+                yield _Chunk("Đầu, ")
+                yield _NoText()
+                yield _Chunk("cuối.")
+            return gen()
+    models["main"] = Model([])
+
+    async def on_chunk(text):
+        pass
+    assert asyncio.run(_call(on_chunk)) == "Đầu, cuối."
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+import pytest
+
+from hedging import HedgeBudget, LatencyTracker, ModelTier, hedged, parse_tiers
+
+
+def test_parse_tiers():
+    assert parse_tiers("a:20, b", "x", 30) == [ModelTier("a", 20.0), ModelTier("b", 30.0)]
+    assert parse_tiers("", "x", 30) == [ModelTier("x", 30)]
+    assert parse_tiers("a:slow", "x", 30) == [ModelTier("x", 30)]
+
+
+def test_latency_tracker_percentile():
+    tracker = LatencyTracker(window=100, min_samples=10)
+    for i in range(9):
+        tracker.observe(i)
+    assert tracker.percentile(0.9) is None
+    for i in range(9, 100):
+        tracker.observe(i)
+    assert tracker.percentile(0.9) == 90
+    assert tracker.percentile(1.0) == 99
+
+
+def test_hedge_budget():
+    budget = HedgeBudget(0.5, burst=1)
+    assert budget.try_spend()
+    assert not budget.try_spend()
+    budget.on_request()
+    budget.on_request()
+    assert budget.try_spend()
+    budget.refund()
+    assert budget.try_spend()
+
+
+async def _after(seconds, value, error=None):
+    await asyncio.sleep(seconds)
+    if error is not None:
+        raise error
+    return value
+
+
+async def _yes():
+    return True
+
+
+async def _no():
+    return False
+
+
+def test_no_delay_runs_primary_only():
+    result = asyncio.run(hedged(lambda: _after(0, "p"), lambda: _after(0, "b"), None, _yes))
+    assert result == ("p", "primary")
+
+
+def test_fast_primary_never_hedges():
+    async def run():
+        calls = []
+
+        async def may():
+            calls.append(1)
+            return True
+        result = await hedged(lambda: _after(0.01, "p"), lambda: _after(0, "b"), 0.2, may)
+        assert result == ("p", "primary") and not calls
+
+    asyncio.run(run())
+
+
+def test_backup_wins_and_primary_is_cancelled():
+    async def run():
+        cancelled = asyncio.Event()
+
+        async def slow():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+        result = await hedged(slow, lambda: _after(0.01, "b"), 0.02, _yes)
+        assert result == ("b", "backup")
+        await asyncio.sleep(0)
+        assert cancelled.is_set()
+
+    asyncio.run(run())
+
+
+def test_refused_hedge_waits_for_primary():
+    result = asyncio.run(hedged(lambda: _after(0.05, "p"), lambda: _after(0, "b"), 0.01, _no))
+    assert result == ("p", "primary")
+
+
+def test_failed_primary_falls_back_to_running_backup():
+    async def run():
+        result = await hedged(lambda: _after(0.05, None, RuntimeError("boom")),
+                              lambda: _after(0.1, "b"), 0.01, _yes)
+        assert result == ("b", "backup")
+        with pytest.raises(RuntimeError):
+            await hedged(lambda: _after(0.05, None, RuntimeError("p")),
+                         lambda: _after(0.02, None, RuntimeError("b")), 0.01, _yes)
+
+    asyncio.run(run())
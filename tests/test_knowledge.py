@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import json
+
+import knowledge
+
+
+def _write(path, text):
+    path.write_text(text, encoding="utf-8")
+
+
+def test_fold_and_tokenize():
+    assert knowledge.fold("Khinh Công Đạp Tuyết") == "khinh cong dap tuyet"
+    # stopwords dropped, adjacent syllables paired
+    assert knowledge.tokenize("khinh công là gì") == ["khinh", "cong", "khinh_cong"]
+
+
+def test_load_corpus(tmp_path):
+    _write(tmp_path / "game.md", "# Khinh công\nBay qua mái nhà.\n\n"
+                                 "# Hỏi bot\n<!-- direct: false -->\nNêu rõ nhiệm vụ.\n\n# Trống\n")
+    _write(tmp_path / "_draft.md", "# Nháp\nKhông nạp.\n")
+    (tmp_path / "faq.json").write_text(json.dumps([
+        {"question": "Kiếm pháp", "answer": "Luyện ở núi."},
+        {"title": "Meta", "text": "Cách hỏi.", "direct": False},
+    ]), encoding="utf-8")
+    docs = knowledge.load_corpus(str(tmp_path))
+    assert [d["title"] for d in docs] == ["Khinh công", "Hỏi bot", "Kiếm pháp", "Meta"]
+    assert docs[1]["text"] == "Nêu rõ nhiệm vụ." and docs[1]["direct"] is False
+    assert "direct" not in docs[0] and docs[3]["direct"] is False
+
+
+def test_build_and_search(tmp_path):
+    docs = [
+        {"title": "Học khinh công", "text": "Khinh công mở khóa ở chương hai tại Thanh Hà."},
+        {"title": "Kiếm pháp", "text": "Kiếm pháp luyện tại núi Hoa Sơn với sư phụ."},
+        {"title": "Câu cá", "text": "Câu cá ở bờ sông, cần mồi giun."},
+    ]
+    path = str(tmp_path / "k.idx")
+    knowledge.build_index(docs, path, "sig")
+    index = knowledge.KnowledgeIndex(path)
+    try:
+        hit = index.search("học khinh công ở đâu", k=1)[0]
+        assert hit.doc["title"] == "Học khinh công"
+        assert hit.confidence == 1.0 and hit.matched == 3
+        partial = index.search("khinh công rồng lửa", k=1)[0]
+        assert partial.confidence < 1.0 and partial.matched == 2
+        assert index.search("", k=1) == []
+        assert [h.doc["title"] for h in index.search("kiếm pháp hoa sơn câu cá", k=3)][:2] == ["Kiếm pháp", "Câu cá"]
+    finally:
+        index.close()
+
+
+def test_open_or_build_rebuilds_on_signature_change(tmp_path):
+    path = str(tmp_path / "k.idx")
+    builds = []
+
+    def docs():
+        builds.append(1)
+        return [{"title": "Khinh công", "text": f"bản {len(builds)}"}]
+    for sig in ("a", "a", "b"):
+        index = knowledge.open_or_build(path, docs, sig)
+        assert index.signature == sig
+        index.close()
+    assert len(builds) == 2
+    assert knowledge.open_or_build(str(tmp_path / "empty.idx"), lambda: [], "x") is None
+
+
+def test_snippet():
+    text = "Câu một. Câu hai dài hơn! Câu ba?"
+    assert knowledge.snippet(text, 20) == "Câu một."
+    assert knowledge.snippet(text, 100) == text
+    assert knowledge.snippet("x" * 50, 10) == "x" * 10 + "…"
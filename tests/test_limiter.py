@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+
+from limiter import GeminiLimiter, TokenBucket, classify_error, estimate_tokens
+
+
+class _ApiError(Exception):
+    def __init__(self, code, message=""):
+        super().__init__(message)
+        self.code = code
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("") == 1
+    assert estimate_tokens("a" * 30) == 10
+
+
+def test_classify_error():
+    assert classify_error(_ApiError(429)) == "throttled"
+    assert classify_error(Exception("Quota exceeded for model")) == "throttled"
+    assert classify_error(_ApiError(503)) == "server"
+    assert classify_error(asyncio.TimeoutError()) == "server"
+    assert classify_error(_ApiError(lambda: 500)) == "server"
+    assert classify_error(ValueError("bad prompt")) == "other"
+
+
+def test_token_bucket():
+    bucket = TokenBucket(60)  # one per second, burst 60
+    assert bucket.wait_time(60) == 0
+    bucket.take(60)
+    assert 0.9 < bucket.wait_time(1) <= 1.0
+    assert TokenBucket(0).wait_time(10**6) == 0
+
+
+def test_aimd_grows_on_fast_success_and_shrinks_on_slow():
+    changes = []
+    lim = GeminiLimiter(2, min_limit=1, max_limit=4, latency_target=1.0, on_limit_change=changes.append)
+    for _ in range(10):
+        lim.on_success(0.1)
+    assert lim.limit == 4
+    lim.on_success(5.0)
+    assert lim.limit == 3
+    assert changes == [3, 4, 3]
+
+
+def test_throttling_halves_limit_and_drains_rpm():
+    lim = GeminiLimiter(8, max_limit=8, rpm=60)
+    assert lim.on_failure(_ApiError(429)) == "throttled"
+    assert lim.limit == 4
+    assert lim.rpm.wait_time(1) > 0
+
+
+def test_circuit_opens_then_half_opens():
+    lim = GeminiLimiter(4, fail_threshold=3, open_seconds=0.05)
+    for _ in range(3):
+        lim.on_failure(_ApiError(503))
+    assert lim.circuit_open and not lim.allow()
+    time.sleep(0.06)
+    assert lim.allow()
+    # half-open: a single failure re-opens
+    lim.on_failure(_ApiError(503))
+    assert lim.circuit_open
+    lim.open_until = 0.0
+    lim.allow()
+    lim.on_success(0.1)
+    assert lim.failures == 0
+
+
+def test_admit_respects_deadline():
+    async def run():
+        lim = GeminiLimiter(1, rpm=60, tpm=0)
+        lim.rpm.tokens = 0
+        assert not await lim.admit(10, time.monotonic() + 0.1)
+        assert await lim.admit(10, time.monotonic() + 2)
+
+    asyncio.run(run())
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+import pytest
+
+bot = pytest.importorskip("bot")
+
+from chat_db import ChatDB
+
+
+def test_db_hits_are_cached_again(tmp_path):
+    async def run():
+        db = ChatDB(str(tmp_path / "c.sqlite"))
+        db.start()
+        await db.execute("CREATE TABLE reply_messages (message_id INTEGER PRIMARY KEY, reply_id INTEGER,"
+                         " channel_id INTEGER, user_id INTEGER, created_at REAL)")
+        owners = bot.ReplyOwners(db, max_entries=3)
+        owners.record([10, 11], 7, 42)
+        owners.record([20, 21, 22], 7, 43)  # pushes the first reply out of the LRU
+        assert 10 not in owners._owners
+        queries = []
+        fetchall = db.fetchall
+
+        async def counting(query, params=()):
+            queries.append(query)
+            return await fetchall(query, params)
+        db.fetchall = counting
+        assert await owners.lookup(11) == (10, 7, 42)
+        # the whole reply came back into the cache with that one query
+        assert await owners.lookup(10) == (10, 7, 42)
+        assert await owners.group(10) == [10, 11]
+        assert len(queries) == 1
+        assert await owners.group(20) == [20, 21, 22]
+        assert await owners.lookup(99) is None
+        assert await owners.group(99) == [99]
+        await db.aclose()
+
+    asyncio.run(run())
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import datetime
+import glob
+import gzip
+import json
+import os
+
+from chat_db import ChatDB
+from retention import ChatArchiver, parse_retention
+
+NOW = datetime.datetime.utcnow()
+
+
+def _ago(days: float) -> str:
+    return (NOW - datetime.timedelta(days=days)).isoformat()
+
+
+# (user_id, channel_id, role, content, days old, rating)
+ROWS = [
+    (1, 100, "user", "hỏi cũ", 60, None),
+    (1, 100, "bot", "đáp cũ", 60, 0),
+    (2, 100, "user", "hỏi trước đó", 50, None),
+    (2, 100, "user", "hỏi được khen", 50, None),
+    (3, 100, "user", "người khác chen vào", 50, None),
+    (2, 100, "bot", "đáp được khen", 50, 2),
+    (1, 100, "user", "hỏi mới", 1, None),
+    (1, 200, "user", "kênh giữ mãi", 400, None),
+    (1, 300, "user", "kênh 10 ngày, quá hạn", 20, None),
+    (1, 300, "user", "kênh 10 ngày, còn hạn", 5, None),
+]
+
+
+def _archived(directory):
+    records = []
+    for path in sorted(glob.glob(os.path.join(directory, "chats-*.jsonl.gz"))):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            records += [json.loads(line) for line in f if line.strip()]
+    return records
+
+
+def test_parse_retention():
+    assert parse_retention("123:30, 456:0,bad,") == {123: 30.0, 456: 0.0}
+
+
+def test_run_once_archives_expired_rows_and_keeps_rated_answers(tmp_path):
+    async def run():
+        db = ChatDB(str(tmp_path / "c.sqlite"))
+        db.start()
+        await db.execute(
+            "CREATE TABLE chats (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, channel_id INTEGER,"
+            " role TEXT, persona TEXT, content TEXT, timestamp TEXT, message_id INTEGER, rating INTEGER)")
+        for user_id, channel_id, role, content, days, rating in ROWS:
+            db.enqueue("INSERT INTO chats (user_id, channel_id, role, persona, content, timestamp, rating)"
+                       " VALUES (?, ?, ?, 'ekko', ?, ?, ?)", (user_id, channel_id, role, content, _ago(days), rating))
+        touched = []
+        archiver = ChatArchiver(db, str(tmp_path / "archive"), default_days=30,
+                                per_channel={200: 0, 300: 10}, keep_min_rating=1, batch_rows=2,
+                                pause=0, on_archived=touched.append)
+        sizes = await archiver.run_once()
+        kept = [r[0] for r in await db.fetchall("SELECT content FROM chats ORDER BY id")]
+        await db.aclose()
+        return archiver, sizes, kept, touched
+
+    archiver, sizes, kept, touched = asyncio.run(run())
+    gone = ["hỏi cũ", "đáp cũ", "hỏi trước đó", "người khác chen vào", "kênh 10 ngày, quá hạn"]
+    assert kept == [c for _, _, _, c, _, _ in ROWS if c not in gone]
+    assert "hỏi được khen" in kept and "đáp được khen" in kept  # the rated answer keeps its question
+    assert "kênh giữ mãi" in kept  # 0 days keeps the channel forever
+    records = _archived(str(tmp_path / "archive"))
+    assert sorted(r["content"] for r in records) == sorted(gone)
+    months = {os.path.basename(p) for p in glob.glob(str(tmp_path / "archive" / "*.gz"))}
+    assert months == {f"chats-{_ago(d)[:7]}.jsonl.gz" for d in (60, 50, 20)}
+    assert archiver.archived == 5 and touched == [{100, 300}]
+    assert sizes["rows_chats"] == len(kept)
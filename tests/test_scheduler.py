@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+
+import pytest
+
+from scheduler import FairScheduler, QueueFull, RequestExpired
+
+
+def _deadline(seconds: float = 5.0) -> float:
+    return time.monotonic() + seconds
+
+
+def test_grants_immediately_below_limit():
+    async def run():
+        s = FairScheduler(2)
+        await s.acquire(1, 1, _deadline())
+        await s.acquire(2, 1, _deadline())
+        assert s.active == 2 and s.depth == 0
+        s.release()
+        assert s.active == 1
+
+    asyncio.run(run())
+
+
+def test_sheds_when_queue_or_user_share_is_full():
+    async def run():
+        s = FairScheduler(1, max_queue=2, max_per_user=1)
+        await s.acquire(1, 1, _deadline())
+        waiting = asyncio.ensure_future(s.acquire(2, 1, _deadline()))
+        await asyncio.sleep(0)
+        with pytest.raises(QueueFull):
+            await s.acquire(2, 1, _deadline())  # user 2 already has one queued
+        other = asyncio.ensure_future(s.acquire(3, 1, _deadline()))
+        await asyncio.sleep(0)
+        with pytest.raises(QueueFull):
+            await s.acquire(4, 1, _deadline())  # queue at max_queue
+        for task in (waiting, other):
+            task.cancel()
+        await asyncio.gather(waiting, other, return_exceptions=True)
+        assert s.depth == 0 and s.shed == 2
+
+    asyncio.run(run())
+
+
+def test_round_robin_across_channels():
+    async def run():
+        s = FairScheduler(1, max_queue=10, max_per_user=10)
+        await s.acquire(0, 0, _deadline())
+        order = []
+
+        async def want(user, channel):
+            await s.acquire(user, channel, _deadline())
+            order.append(channel)
+
+        # a busy channel queues first, a quiet one after it
+        tasks = [asyncio.ensure_future(want(u, 1)) for u in (1, 2, 3)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.ensure_future(want(4, 2)))
+        await asyncio.sleep(0)
+        for _ in range(4):
+            s.release()
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        assert order[:2] == [1, 2]
+
+    asyncio.run(run())
+
+
+def test_request_expires_in_queue():
+    async def run():
+        s = FairScheduler(1)
+        await s.acquire(1, 1, _deadline())
+        with pytest.raises(RequestExpired):
+            await s.acquire(2, 1, _deadline(0.05))
+        assert s.depth == 0 and s.expired == 1
+        with pytest.raises(RequestExpired):
+            await s.acquire(3, 1, time.monotonic() - 1)
+
+    asyncio.run(run())
+
+
+def test_cancelled_waiter_does_not_leak_a_slot():
+    async def run():
+        s = FairScheduler(1)
+        await s.acquire(1, 1, _deadline())
+        task = asyncio.ensure_future(s.acquire(2, 1, _deadline()))
+        await asyncio.sleep(0)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        s.release()
+        assert s.active == 0 and s.depth == 0
+
+    asyncio.run(run())
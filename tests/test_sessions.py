@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from sessions import SessionManager, clip, drop_own_rows, turn_label
+
+
+def test_clip_and_turn_label():
+    assert clip("abc", 5) == "abc"
+    assert clip("abcdef ", 4) == "abcd…"
+    assert clip(None, 4) == ""
+    assert turn_label("user", "Ekko") == "Đại hiệp"
+    assert turn_label("bot", "Ekko") == "Ekko"
+    assert turn_label("bot", None) == "Bot"
+
+
+def test_drop_own_rows_removes_exactly_the_saved_rows():
+    history = [
+        ("user", None, "boss"),              # another player, a substring of the request
+        ("user", None, "đánh boss thế nào"),  # this request
+        ("user", None, "ở đâu"),             # this request, second fragment
+        ("user", None, "chào cả nhà"),        # someone typing during the debounce window
+    ]
+    left = drop_own_rows(history, ["đánh boss thế nào", "ở đâu"])
+    assert left == [("user", None, "boss"), ("user", None, "chào cả nhà")]
+    # an identical earlier question is only dropped once: the newest row is this request's
+    repeated = [("user", None, "hỏi"), ("bot", "Ekko", "đáp"), ("user", None, "hỏi")]
+    assert drop_own_rows(repeated, ["hỏi"]) == repeated[:2]
+    assert drop_own_rows(history, []) == history
+
+
+def test_build_keeps_other_players_turns():
+    sessions = SessionManager(None, lambda name: None, "m", budget=10000, turn_max_chars=100)
+    history = drop_own_rows([("user", None, "boss"), ("user", None, "đánh boss thế nào")], ["đánh boss thế nào"])
+    request = sessions.build("sys", history, "đánh boss thế nào")
+    assert request.contents == [{"role": "user", "parts": ["boss", "đánh boss thế nào"]}]
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+import pytest
+
+from shared_state import Bucket, Cooldown, LocalState, SQLiteState, open_backend
+
+SLOW = 0.001  # refill rate low enough that nothing refills during a test
+
+
+@pytest.fixture(params=["local", "sqlite"])
+def backend(request, tmp_path):
+    state = LocalState() if request.param == "local" else SQLiteState(str(tmp_path / "s.sqlite"))
+    yield state
+    state.close()
+
+
+def test_two_sqlite_backends_share_one_bucket(tmp_path):
+    path = str(tmp_path / "s.sqlite")
+    a, b = SQLiteState(path), SQLiteState(path)
+
+    async def run():
+        quota = [Bucket("gemini:rpm", SLOW, 10)]
+        # both "workers" race for the same 10 tokens
+        waits = await asyncio.gather(*(s.acquire(quota) for s in (a, b) for _ in range(8)))
+        assert sum(1 for w in waits if w == 0) == 10
+        assert await a.acquire(quota, consume=False) > 0
+        assert await b.acquire(quota, consume=False) > 0
+
+    try:
+        asyncio.run(run())
+    finally:
+        a.close()
+        b.close()
+
+
+def test_acquire_is_all_or_nothing(backend):
+    async def run():
+        def quota(requests, tokens):
+            return [Bucket("rpm", SLOW, 2, requests), Bucket("tpm", SLOW, 10, tokens)]
+        assert await backend.acquire(quota(1, 8)) == 0
+        # tpm is short: the request token must not be taken either
+        assert await backend.acquire(quota(1, 5)) > 0
+        assert await backend.acquire(quota(1, 0)) == 0
+        assert await backend.acquire(quota(1, 0)) > 0
+
+    asyncio.run(run())
+
+
+def test_charge_and_drain_put_buckets_in_debt(backend):
+    async def run():
+        tpm = [Bucket("tpm", 1.0, 10, 10)]
+        await backend.charge(tpm)
+        await backend.charge(tpm)
+        # 10 tokens of debt: a full bucket is ~20s away at 1 token/s
+        assert await backend.acquire(tpm, consume=False) > 15
+        rpm = [Bucket("rpm", SLOW, 5)]
+        await backend.drain(rpm)
+        assert await backend.acquire(rpm) > 0
+        # disabled buckets never wait
+        assert await backend.acquire([Bucket("off", 0, 0, 100)]) == 0
+
+    asyncio.run(run())
+
+
+def test_cooldown_burst(backend):
+    async def run():
+        cd = Cooldown(10, burst=3, backend=backend)
+        for _ in range(3):
+            assert await cd.check(1) == (False, 0)
+            await cd.hit(1)
+        on_cooldown, wait = await cd.check(1)
+        assert on_cooldown and 9 < wait <= 10
+        assert not (await cd.check(2))[0]  # per user
+        assert await Cooldown(0, backend=backend).check(1) == (False, 0)
+
+    asyncio.run(run())
+
+
+def test_cooldown_refills_one_message_per_period(backend):
+    async def run():
+        cd = Cooldown(0.05, burst=2, backend=backend)
+        await cd.hit(1)
+        await cd.hit(1)
+        assert (await cd.check(1))[0]
+        await asyncio.sleep(0.06)
+        assert not (await cd.check(1))[0]
+        await cd.hit(1)
+        assert (await cd.check(1))[0]
+
+    asyncio.run(run())
+
+
+def test_open_backend(tmp_path):
+    assert isinstance(open_backend(""), LocalState)
+    state = open_backend(f"sqlite:{tmp_path / 's.sqlite'}")
+    assert isinstance(state, SQLiteState)
+    state.close()
+    with pytest.raises(ValueError):
+        open_backend("redis://x")
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+bot = pytest.importorskip("bot")
+
+
+def test_short_text_is_one_page():
+    assert bot.split_reply("ngắn gọn", 100) == ["ngắn gọn"]
+
+
+def test_prefers_sentence_boundaries():
+    text = "Câu thứ nhất khá dài. Câu thứ hai cũng dài. Câu ba."
+    pages = bot.split_reply(text, 30)
+    assert pages[0] == "Câu thứ nhất khá dài."
+    assert all(len(p) <= 30 for p in pages)
+    assert " ".join(pages) == text
+
+
+def test_falls_back_to_words_then_hard_cut():
+    pages = bot.split_reply("một hai ba bốn năm sáu bảy tám", 10)
+    assert all(len(p) <= 10 for p in pages) and " ".join(pages) == "một hai ba bốn năm sáu bảy tám"
+    assert bot.split_reply("x" * 25, 10) == ["x" * 10, "x" * 10, "x" * 5]
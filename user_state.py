@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+UserState — trạng thái theo user có giới hạn: TTL + trần số phần tử (LRU),
+và persona ghi thẳng xuống SQLite, nạp lười theo từng user (không quét cả bảng khi khởi động).
+Cooldown nằm ở shared_state vì có thể cần chung giữa các worker.
+"""
+
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Generic, Hashable, Optional, Tuple, TypeVar
+
+logger = logging.getLogger("ekko.user_state")
+
+V = TypeVar("V")
+_MISSING = object()
+
+
+class TTLCache(Generic[V]):
+    """Dict with per-entry expiry and a hard size cap; least recently used goes first."""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, Tuple[float, V]]" = OrderedDict()
+        self.evicted = 0
+        self.expired = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.expired += 1
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: V, ttl: Optional[float] = None):
+        now = time.monotonic()
+        self._data[key] = (now + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        self._prune(now)
+
+    def pop(self, key: Hashable, default: Any = None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def _prune(self, now: float):
+        # expired entries cluster at the LRU end; stop at the first live one
+        while self._data:
+            key, (expires_at, _) = next(iter(self._data.items()))
+            if expires_at > now:
+                break
+            del self._data[key]
+            self.expired += 1
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+            self.evicted += 1
+
+
+class PersonaStore:
+    """Write-through persona choices: memory is a bounded cache, SQLite is the source of truth."""
+
+    def __init__(self, db, default: str, max_users: int = 10000, ttl: float = 3600):
+        self.db = db
+        self.default = default
+        self._cache: TTLCache[Optional[str]] = TTLCache(max_users, ttl)
+        self.loads = 0
+
+    async def get(self, uid: int) -> str:
+        value = self._cache.get(uid, _MISSING)
+        if value is _MISSING:
+            rows = await self.db.fetchall("SELECT persona FROM user_personas WHERE user_id = ?", (uid,))
+            self.loads += 1
+            value = rows[0][0] if rows else None
+            # misses are cached too, most users never pick a persona
+            self._cache.set(uid, value)
+        return value or self.default
+
+    def set(self, uid: int, persona: str):
+        self._cache.set(uid, persona)
+        self.db.enqueue(
+            "INSERT INTO user_personas (user_id, persona, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET persona = excluded.persona, updated_at = excluded.updated_at",
+            (uid, persona, time.time()),
+        )
+
+    def clear(self, uid: int):
+        self._cache.set(uid, None)
+        self.db.enqueue("DELETE FROM user_personas WHERE user_id = ?", (uid,))
+
+    def stats(self) -> Dict[str, float]:
+        return {"cached": len(self._cache), "loads": self.loads, "evicted": self._cache.evicted}